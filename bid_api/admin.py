@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
+from django.db.models import Count, Min
+from django.utils.timesince import timesince
 
-from . import models
+from . import metrics, models
 
 from bid_main.admin_decorators import short_description
 
@@ -16,19 +18,59 @@ def enable_webhook(modeladmin, request, queryset):
     queryset.update(enabled=True)
 
 
+@short_description('Reset circuit breaker of selected webhooks')
+def reset_breaker(modeladmin, request, queryset):
+    for hook in queryset:
+        hook.reset_breaker()
+
+
 @admin.register(models.Webhook)
 class WebhookAdmin(ModelAdmin):
-    list_display = ('name', 'hook_type', 'url', 'enabled', 'queue_size', 'last_flush_attempt')
+    list_display = ('name', 'hook_type', 'url', 'enabled', 'queue_size', 'oldest_queued',
+                    'deliveries', 'mean_latency', 'last_flush_attempt', 'breaker_state')
     list_display_links = ('name', 'hook_type', 'url')
     list_filter = ('hook_type', 'enabled')
     search_fields = ('name', 'hook_type', 'url')
     ordering = ('name',)
-    actions = [disable_webhook, enable_webhook]
-    readonly_fields = ('queue_size', 'last_flush_attempt')
+    actions = [disable_webhook, enable_webhook, reset_breaker]
+    readonly_fields = ('queue_size', 'last_flush_attempt', 'claimed_by', 'claimed_until',
+                       'postponed_until', 'breaker_state', 'breaker_opened_at',
+                       'breaker_window_start', 'breaker_window_attempts', 'breaker_window_failures')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request) \
+            .annotate(queue_depth=Count('queue'), oldest_queued_at=Min('queue__created'))
 
     def queue_size(self, item: models.Webhook) -> str:
         """The queue size of the webhook, or '-' when empty."""
-        return str(item.queue_size() or '-')
+        return str(item.queue_depth or '-')
+
+    @short_description('Oldest queued')
+    def oldest_queued(self, item: models.Webhook) -> str:
+        """How long the oldest queued call has been waiting, or '-' when the queue is empty."""
+        if item.oldest_queued_at is None:
+            return '-'
+        return timesince(item.oldest_queued_at)
+
+    def _counters(self, item: models.Webhook) -> dict:
+        # The admin shows all webhooks at once, so don't read the cache for every row.
+        return metrics.aggregate(max_age=5).get(item.id) or {}
+
+    @short_description('Deliveries (ok/total)')
+    def deliveries(self, item: models.Webhook) -> str:
+        """Successful and total delivery attempts, over all processes."""
+        counters = self._counters(item)
+        if not counters.get('attempts'):
+            return '-'
+        return f'{counters["successes"]}/{counters["attempts"]}'
+
+    @short_description('Mean latency')
+    def mean_latency(self, item: models.Webhook) -> str:
+        counters = self._counters(item)
+        latency = counters.get('latency')
+        if not latency or not latency['count']:
+            return '-'
+        return f'{latency["sum"] / latency["count"] * 1000:.0f} ms'
 
 
 @short_description('Flush entire queue now')
@@ -38,8 +80,25 @@ def flush_queue_now(modeladmin, request, queryset):
 
 @admin.register(models.WebhookQueuedCall)
 class WebhookQueueAdmin(ModelAdmin):
-    list_display = ('webhook', 'error_code', 'error_msg', 'created', 'updated')
+    list_display = ('webhook', 'error_code', 'error_msg', 'attempts', 'next_attempt_at',
+                    'created', 'updated')
     list_display_links = ('error_code', 'error_msg', 'created', 'updated')
     list_filter = ('webhook', 'error_code', 'created', 'updated')
     ordering = ('updated',)
     actions = [flush_queue_now]
+
+
+@short_description('Replay selected dead letters')
+def replay_dead_letters(modeladmin, request, queryset):
+    count = models.WebhookDeadLetter.replay(queryset)
+    modeladmin.message_user(request, f'Queued {count} dead letters for delivery.')
+
+
+@admin.register(models.WebhookDeadLetter)
+class WebhookDeadLetterAdmin(ModelAdmin):
+    list_display = ('webhook', 'subject_id', 'error_code', 'error_msg', 'attempts', 'queued',
+                    'created')
+    list_display_links = ('error_code', 'error_msg', 'queued', 'created')
+    list_filter = ('webhook', 'error_code', 'created')
+    ordering = ('queued',)
+    actions = [replay_dead_letters]
@@ -0,0 +1,31 @@
+"""Checkpoint files of resumable management commands.
+
+A checkpoint is a JSON object with the parameters of a run and how far it
+got. A run only continues from a checkpoint with the same parameters.
+"""
+
+import json
+import pathlib
+
+from django.core.management.base import CommandError
+
+
+def load(path: pathlib.Path, params: dict) -> dict:
+    """Returns the checkpoint, after checking that it is for a run with these parameters."""
+    with path.open() as infile:
+        checkpoint = json.load(infile)
+    for key, value in params.items():
+        if checkpoint.get(key) != value:
+            raise CommandError(f'Checkpoint {path} is for a run with different parameters '
+                               f'({key}={checkpoint.get(key)!r})')
+    return checkpoint
+
+
+def save(path: pathlib.Path, checkpoint: dict):
+    """Writes the checkpoint, replacing the file atomically."""
+    # Write to a temporary file first, so that an interruption cannot
+    # leave a half-written checkpoint.
+    tmp_path = path.with_name(path.name + '~')
+    with tmp_path.open('w') as outfile:
+        json.dump(checkpoint, outfile)
+    tmp_path.replace(path)
@@ -0,0 +1,156 @@
+"""Webhook delivery daemon.
+
+Every enabled webhook with queued calls gets its own lane. Lanes run
+concurrently on a thread pool, so that one slow or unreachable webhook does
+not hold up the others. Within a lane, queued calls are delivered strictly in
+order of creation (see `Webhook.flush`), and there is never more than one
+lane per webhook.
+
+Multiple daemons, also on different hosts, can run at the same time. A lane
+only delivers while its worker holds the lease on the webhook (see
+`Webhook.claim`), so no call is delivered twice or out of order.
+"""
+
+import concurrent.futures
+import datetime
+import logging
+import threading
+import typing
+
+from django.conf import settings
+from django.db import connection, close_old_connections
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from . import metrics, models
+
+log = logging.getLogger(__name__)
+
+
+class DeliveryDaemon:
+    """Delivers queued webhook calls until stopped."""
+
+    log = log.getChild('DeliveryDaemon')
+
+    def __init__(self, *,
+                 concurrency: int = None,
+                 poll_interval: float = None,
+                 shutdown_timeout: float = None):
+        self.concurrency = concurrency or settings.WEBHOOK_DELIVERY_CONCURRENCY
+        self.poll_interval = poll_interval or settings.WEBHOOK_DELIVERY_POLL_INTERVAL
+        if shutdown_timeout is None:
+            shutdown_timeout = settings.WEBHOOK_DELIVERY_SHUTDOWN_TIMEOUT
+        self.shutdown_timeout = shutdown_timeout
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix='webhook-lane')
+        self._lanes: typing.Dict[int, concurrent.futures.Future] = {}
+        self._next_attempt_at: typing.Optional[datetime.datetime] = None
+        self._stop = threading.Event()
+
+    def run(self):
+        """Keeps delivering until stop() is called."""
+        self.log.info('starting webhook delivery with %d lanes', self.concurrency)
+        try:
+            while not self._stop.is_set():
+                self.tick()
+                metrics.publish()
+                self._stop.wait(self.next_wait())
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        """Makes run() return after the current iteration. Safe to call from signal handlers."""
+        self._stop.set()
+
+    def tick(self) -> typing.List[int]:
+        """Starts a lane for every enabled webhook that has due calls and no running lane.
+
+        :return: the IDs of the webhooks for which a lane was started.
+        """
+        self._forget_finished_lanes()
+        close_old_connections()
+        models.session_registry.prune()
+
+        # Query the enabled hooks every time, since they can have been
+        # enabled/disabled since our last iteration. Hooks leased by other
+        # workers are skipped. This is a single range query on the
+        # (webhook, next_attempt_at) index.
+        now = timezone.now()
+        unclaimed = Q(webhook__claimed_until__isnull=True) | Q(webhook__claimed_until__lt=now)
+        first_attempts = models.WebhookQueuedCall.objects \
+            .filter(unclaimed, webhook__enabled=True) \
+            .values_list('webhook_id', 'webhook__postponed_until') \
+            .annotate(first_attempt=Min('next_attempt_at')) \
+            .order_by()
+
+        started = []
+        self._next_attempt_at = None
+        for hook_id, postponed_until, first_attempt in first_attempts:
+            if hook_id in self._lanes:
+                continue
+            if postponed_until is not None:
+                first_attempt = max(first_attempt, postponed_until)
+            if first_attempt > now:
+                if self._next_attempt_at is None or first_attempt < self._next_attempt_at:
+                    self._next_attempt_at = first_attempt
+                continue
+            self._lanes[hook_id] = self._executor.submit(self._run_lane, hook_id)
+            started.append(hook_id)
+        if started:
+            self.log.debug('started lanes for webhooks %s', started)
+        return started
+
+    def next_wait(self) -> float:
+        """Returns the number of seconds until the next tick.
+
+        This is until the earliest next attempt, as seen by the last tick,
+        but never more than the poll interval, so that calls queued by
+        other processes and lanes that finished are picked up.
+        """
+        if self._next_attempt_at is None:
+            return self.poll_interval
+        secs = (self._next_attempt_at - timezone.now()).total_seconds()
+        return max(0.0, min(secs, self.poll_interval))
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits for all running lanes to finish.
+
+        :return: True when all lanes finished, False on timeout.
+        """
+        running = list(self._lanes.values())
+        if not running:
+            return True
+        _, not_done = concurrent.futures.wait(running, timeout=timeout)
+        self._forget_finished_lanes()
+        return not not_done
+
+    def shutdown(self):
+        """Waits for running lanes for at most shutdown_timeout seconds, then stops."""
+        if not self.wait(self.shutdown_timeout):
+            self.log.warning('%d webhook lanes still running after %s seconds, '
+                             'abandoning them', len(self._lanes), self.shutdown_timeout)
+        self._executor.shutdown(wait=False)
+        self.log.info('webhook delivery stopped')
+
+    def _forget_finished_lanes(self):
+        for hook_id, future in list(self._lanes.items()):
+            if future.done():
+                del self._lanes[hook_id]
+
+    def _run_lane(self, hook_id: int):
+        """Delivers the queued calls of a single webhook, in order."""
+        try:
+            try:
+                hook = models.Webhook.objects.get(id=hook_id, enabled=True)
+            except models.Webhook.DoesNotExist:
+                self.log.debug('webhook %d disappeared or was disabled', hook_id)
+                return
+
+            hook.flush()
+        except Exception:
+            self.log.exception('error delivering to webhook %d', hook_id)
+        finally:
+            # Lanes run in their own threads, which each have their own
+            # database connection.
+            connection.close()
@@ -0,0 +1,65 @@
+import json
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bid_api import models
+
+ROLES = ['cloud_subscriber', 'cloud_has_subscription', 'cloud_demo', 'network_member',
+         'bfct_trainer', 'conference_speaker']
+
+
+def fake_user_modified(user_id: int) -> bytes:
+    """Returns a USER_MODIFIED payload like the ones sent for real users."""
+    payload = {
+        'id': user_id,
+        'old_email': f'user{user_id}@example.com',
+        'full_name': f'Example User {user_id}',
+        'email': f'user{user_id}@example.com',
+        'roles': sorted(random.sample(ROLES, random.randint(0, 3))),
+        'avatar_changed': random.random() < 0.1,
+    }
+    return json.dumps(payload).encode()
+
+
+class Command(BaseCommand):
+    help = 'Measures bytes on the wire and CPU time of compressing webhook request bodies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', '-n',
+                            type=int,
+                            default=10000,
+                            help='Number of USER_MODIFIED events to send')
+        parser.add_argument('--batch-sizes', '-b',
+                            default='1,10,100',
+                            help='Comma-separated batch sizes to measure')
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        events = [fake_user_modified(user_id) for user_id in range(1, options['events'] + 1)]
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+        compressions = [value for value, _ in models.COMPRESSION_CHOICES]
+
+        self.stdout.write(f'{len(events)} events, bodies of at least '
+                          f'{settings.WEBHOOK_COMPRESSION_MIN_SIZE} bytes are compressed')
+        self.stdout.write(f'{"batch":>6} {"encoding":>8} {"bytes/event":>12} '
+                          f'{"ratio":>6} {"CPU µs/event":>13}')
+
+        for batch_size in batch_sizes:
+            bodies = [b'[' + b','.join(events[idx:idx + batch_size]) + b']'
+                      if batch_size > 1 else events[idx]
+                      for idx in range(0, len(events), batch_size)]
+            uncompressed = sum(len(body) for body in bodies)
+
+            for compression in compressions:
+                hook = models.Webhook(compression=compression)
+                start = time.process_time()
+                on_the_wire = sum(len(hook.encode_body(body)[0]) for body in bodies)
+                cpu_secs = time.process_time() - start
+
+                self.stdout.write(f'{batch_size:6d} {compression or "none":>8} '
+                                  f'{on_the_wire / len(events):12.1f} '
+                                  f'{on_the_wire / uncompressed:6.2f} '
+                                  f'{cpu_secs / len(events) * 1e6:13.2f}')
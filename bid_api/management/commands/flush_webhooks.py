@@ -1,10 +1,9 @@
 import logging
-import time
+import signal
 
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 
-from bid_api import models
+from bid_api import delivery, models
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +21,16 @@ class Command(BaseCommand):
                             action='store_true',
                             default=False,
                             help='Continually monitors the webhook queues.')
+        parser.add_argument('--concurrency', '-c',
+                            type=int,
+                            default=None,
+                            help='Number of webhooks to deliver to concurrently when monitoring; '
+                                 'defaults to settings.WEBHOOK_DELIVERY_CONCURRENCY.')
+        parser.add_argument('--shutdown-timeout',
+                            type=float,
+                            default=None,
+                            help='Seconds to wait for running deliveries when shutting down; '
+                                 'defaults to settings.WEBHOOK_DELIVERY_SHUTDOWN_TIMEOUT.')
 
     def handle(self, *args, **options):
         do_flush = options['flush']
@@ -37,7 +46,7 @@ class Command(BaseCommand):
         logging.getLogger('bid_api').setLevel(level)
         logging.disable(level - 1)
         if options['monitor']:
-            return self.monitor()
+            return self.monitor(options.get('concurrency'), options.get('shutdown_timeout'))
 
         queue = models.WebhookQueuedCall.objects
 
@@ -69,42 +78,13 @@ class Command(BaseCommand):
             else:
                 self.stdout.write(self.style.WARNING(f'There are still {new_count} items queued.'))
 
-    def monitor(self):
-        """Keeps monitoring the queues."""
+    def monitor(self, concurrency: int = None, shutdown_timeout: float = None):
+        """Keeps delivering queued calls until interrupted."""
 
+        daemon = delivery.DeliveryDaemon(concurrency=concurrency,
+                                         shutdown_timeout=shutdown_timeout)
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
         try:
-            while True:
-                self._monitor_iteration()
-                time.sleep(1)
+            daemon.run()
         except KeyboardInterrupt:
             log.info('shutting down webhook queue monitor')
-
-    def _monitor_iteration(self):
-        """Single iteration of queue monitor."""
-
-        # Quick check to see if any hook got anything queued.
-        queue_size = models.WebhookQueuedCall.objects.count()
-        if queue_size == 0:
-            log.debug('nothing queued')
-            return
-
-        # Investigate the hook status every time, since they can have been
-        # enabled/disabled since our last iteration.
-        hooks = models.Webhook.objects.filter(enabled=True)
-        if not hooks:
-            log.debug('no enabled hooks')
-            return
-
-        # Flush all hooks that have to be flushed now.
-        for flush_hook in hooks:
-            flush_time = flush_hook.flush_time()
-
-            if flush_time is None:  # Means that there is nothing queued.
-                continue
-            secs_in_future = (flush_time - timezone.now()).total_seconds()
-            if secs_in_future > 1:
-                log.debug('skipping %s, flush time is %d seconds in future',
-                          flush_hook, secs_in_future)
-                continue
-
-            flush_hook.flush()
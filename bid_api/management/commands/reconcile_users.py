@@ -1,72 +1,196 @@
 #!/usr/bin/env python3
 
-"""Simple command for one-time use after making Blender ID owner of subscription status."""
+"""Reconciles role memberships with a desired-state file.
 
+For example, to make the subscription roles match what the Store knows:
+
+    ./manage.py reconcile_users badger@example.com subscribers.ndjson \\
+        --role cloud_subscriber --role cloud_has_subscription \\
+        --dry-run --report diff.ndjson
+
+See bid_api.reconcile for the file formats.
+"""
+
+import collections
 import json
 import logging
+import pathlib
+import typing
 
-from django.db.transaction import atomic
 from django.contrib.auth import get_user_model
-from django.http import HttpRequest
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from bid_api.views.badger import BadgerView
+from bid_api import checkpoints, reconcile, roles as role_changes
 
 log = logging.getLogger(__name__)
 UserModel = get_user_model()
 
 
 class Command(BaseCommand):
-    managed_roles = {'cloud_subscriber', 'cloud_has_subscription'}
-    help = 'Reconciles subscription status based on info in reconcile_subscribers.json'
+    default_roles = ['cloud_subscriber', 'cloud_has_subscription']
+    help = 'Reconciles the memberships of managed roles with a desired-state file'
 
     def add_arguments(self, parser):
         parser.add_argument('email', help='Email address of badger user')
+        parser.add_argument('input',
+                            nargs='?',
+                            type=pathlib.Path,
+                            default=pathlib.Path('reconcile_subscribers.json'),
+                            help='Desired-state file, JSON or NDJSON')
+        parser.add_argument('--format',
+                            choices=reconcile.FORMATS,
+                            help='Format of the input; by default determined by its extension')
+        parser.add_argument('--role',
+                            action='append',
+                            default=[],
+                            help='Managed role; can be given multiple times. Defaults to '
+                                 + ' and '.join(self.default_roles))
+        parser.add_argument('--revoke-unlisted',
+                            action='store_true',
+                            help='Also revoke the managed roles from users not in the input')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=1000,
+                            help='Number of users to reconcile per transaction')
+        parser.add_argument('--workers',
+                            type=int,
+                            default=1,
+                            help='Number of chunks to reconcile in parallel')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Only report what would change')
+        parser.add_argument('--report',
+                            type=pathlib.Path,
+                            help='NDJSON file to write the changes and unknown users to')
+        parser.add_argument('--checkpoint',
+                            type=pathlib.Path,
+                            help='JSON file that records progress. When it exists, '
+                                 'reconciliation continues where it left off.')
 
     def handle(self, *args, **options):
-        """Pass email address of badger user as first arg."""
-
         try:
-            self.api_user = UserModel.objects.get(email=options['email'])
+            api_user = UserModel.objects.get(email=options['email'])
         except UserModel.DoesNotExist:
-            self.stdout.write(self.style.ERROR(f'User {options["email"]} does not exist!'))
-            raise SystemExit()
-
-        with open('reconcile_subscribers.json') as infile:
-            email_to_roles = json.load(infile)
-
-        with open('reconcile_subscribers_errors.txt', 'w') as errfile:
-            for email, roles in email_to_roles.items():
-                try:
-                    self.do_user(email, roles)
-                except KeyboardInterrupt:
-                    raise SystemExit('Stopping')
-                except Exception as ex:
-                    log.exception('Error updating user %s', email)
-                    print(email, file=errfile)
-
-    @atomic()
-    def do_user(self, email, roles):
-        to_grant = set(roles)
-        to_revoke = self.managed_roles - to_grant
-
-        request = HttpRequest()
-        request.user = self.api_user
-
-        view = BadgerView()
-        view.action = 'grant'
-
-        for role in to_grant:
-            resp = view.do_badger(request, role, email)
-            if resp.status_code == 422:
-                return
-            if resp.status_code != 200:
-                raise ValueError('Error %s for email %s' % (resp.status_code, email))
-
-        view.action = 'revoke'
-        for role in to_revoke:
-            resp = view.do_badger(request, role, email)
-            if resp.status_code == 422:
-                return
-            if resp.status_code != 200:
-                raise ValueError('Error %s for email %s' % (resp.status_code, email))
+            raise CommandError(f'User {options["email"]} does not exist!')
+
+        input_path: pathlib.Path = options['input']
+        if not input_path.exists():
+            raise CommandError(f'{input_path} does not exist')
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be positive')
+        checkpoint_path: typing.Optional[pathlib.Path] = options['checkpoint']
+        dry_run = options['dry_run']
+        if dry_run and checkpoint_path:
+            raise CommandError('--checkpoint cannot be used with --dry-run')
+
+        role_names = sorted(set(options['role'] or self.default_roles))
+        try:
+            reconciler = reconcile.Reconciler(api_user, role_names, dry_run=dry_run)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        params = {
+            'input': str(input_path.absolute()),
+            'roles': role_names,
+            'chunk_size': chunk_size,
+            'revoke_unlisted': options['revoke_unlisted'],
+        }
+        checkpoint = {'chunks_done': 0, 'last_unlisted_user_id': 0}
+        if checkpoint_path and checkpoint_path.exists():
+            checkpoint = checkpoints.load(checkpoint_path, params)
+            checkpoint = {key: checkpoint[key] for key in ('chunks_done', 'last_unlisted_user_id')}
+            self.stdout.write(f'Resuming after {checkpoint["chunks_done"]} chunks')
+
+        self.totals = {
+            'entries': 0,
+            'unknown': 0,
+            'changed': 0,
+            'granted': collections.Counter(),
+            'revoked': collections.Counter(),
+            'unmanaged': collections.Counter(),
+        }
+        report = options['report'].open('a' if checkpoint['chunks_done'] else 'w') \
+            if options['report'] else None
+        try:
+            listed: typing.Set[str] = set()
+            entries = reconcile.read_desired_state(input_path, options['format'] or '')
+            if options['revoke_unlisted']:
+                entries = self.remember(entries, listed)
+            chunks = reconcile.chunked(entries, chunk_size)
+            chunks = self.skip(chunks, checkpoint['chunks_done'])
+
+            # Chunks can finish out of order; the checkpoint only moves past
+            # chunks for which all earlier chunks have finished too.
+            finished = set()
+            for result in reconciler.reconcile_all(chunks,
+                                                   workers=options['workers'],
+                                                   first_index=checkpoint['chunks_done']):
+                self.add_result(result, report, options['verbosity'])
+                finished.add(result.index)
+                while checkpoint['chunks_done'] in finished:
+                    finished.remove(checkpoint['chunks_done'])
+                    checkpoint['chunks_done'] += 1
+                if checkpoint_path:
+                    checkpoints.save(checkpoint_path, {**params, **checkpoint})
+
+            if options['revoke_unlisted']:
+                pages = reconciler.unlisted(listed,
+                                            after_user_id=checkpoint['last_unlisted_user_id'],
+                                            page_size=chunk_size)
+                for last_user_id, unlisted in pages:
+                    self.add_result(reconciler.reconcile(unlisted), report,
+                                    options['verbosity'])
+                    checkpoint['last_unlisted_user_id'] = last_user_id
+                    if checkpoint_path:
+                        checkpoints.save(checkpoint_path, {**params, **checkpoint})
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        finally:
+            if report:
+                report.close()
+
+        self.write_summary(dry_run)
+
+    def remember(self, entries: typing.Iterable[reconcile.Entry], listed: typing.Set[str]) \
+            -> typing.Iterator[reconcile.Entry]:
+        for entry in entries:
+            listed.add(role_changes.lookup_key(entry[0]))
+            yield entry
+
+    def skip(self, chunks: typing.Iterable[list], count: int) -> typing.Iterator[list]:
+        """Skips the first chunks, which were reconciled before."""
+        for index, chunk in enumerate(chunks):
+            if index >= count:
+                yield chunk
+
+    def add_result(self, result: reconcile.ChunkResult, report, verbosity: int):
+        totals = self.totals
+        totals['entries'] += result.entries
+        totals['unknown'] += len(result.unknown_users)
+        totals['changed'] += len(result.diffs)
+        totals['granted'].update(result.granted)
+        totals['revoked'].update(result.revoked)
+        totals['unmanaged'].update(result.unmanaged)
+
+        if report:
+            for diff in result.diffs:
+                print(json.dumps(diff), file=report)
+            for email_or_uid in result.unknown_users:
+                print(json.dumps({'user': email_or_uid, 'error': 'unknown-user'}), file=report)
+            report.flush()
+        if verbosity > 1:
+            self.stdout.write(f'Chunk {result.index}: {len(result.diffs)} users changed, '
+                              f'{len(result.unknown_users)} unknown')
+
+    def write_summary(self, dry_run: bool):
+        totals = self.totals
+        verb = 'would be' if dry_run else 'were'
+        self.stdout.write(f'{totals["entries"]} users listed, {totals["unknown"]} unknown')
+        for role_name in sorted(totals['granted'].keys() | totals['revoked'].keys()):
+            self.stdout.write(f'  {role_name}: {totals["granted"][role_name]} granted, '
+                              f'{totals["revoked"][role_name]} revoked')
+        for role_name, count in sorted(totals['unmanaged'].items()):
+            self.stdout.write(self.style.WARNING(
+                f'  {role_name} is not managed, ignored for {count} users'))
+        self.stdout.write(self.style.SUCCESS(f'{totals["changed"]} users {verb} changed'))
@@ -0,0 +1,202 @@
+"""Queues the current state of users for delivery to a webhook.
+
+Useful when a new webhook is registered, or when its receiver lost data.
+Only users the webhook wants to hear about, according to its event types and
+role filter, are queued.
+"""
+
+import datetime
+import json
+import logging
+import pathlib
+import time
+import typing
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import dateparse, timezone
+
+from bid_api import checkpoints, models, outbox, payloads, signals
+
+log = logging.getLogger(__name__)
+UserModel = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Queues USER_MODIFIED calls with the current state of users for a webhook'
+    # The avatar is not marked as changed, as that would make receivers
+    # download every avatar.
+    changed_fields = ('email', 'full_name', 'public_roles_as_string')
+
+    def add_arguments(self, parser):
+        parser.add_argument('hook', help='ID or name of the webhook')
+        parser.add_argument('--since',
+                            help='Only users modified at or after this date/time (ISO 8601)')
+        parser.add_argument('--role',
+                            action='append',
+                            default=[],
+                            help='Only users with this role; can be given multiple times')
+        parser.add_argument('--page-size',
+                            type=int,
+                            default=500,
+                            help='Number of users to queue per transaction')
+        parser.add_argument('--rate',
+                            type=float,
+                            default=100,
+                            help='Maximum number of users to queue per second; 0 for no limit')
+        parser.add_argument('--max-queue',
+                            type=int,
+                            default=1000,
+                            help='Wait while the webhook has more than this many queued calls, '
+                                 'so that live changes are not stuck behind the backfill')
+        parser.add_argument('--checkpoint',
+                            type=pathlib.Path,
+                            help='JSON file that records progress. When it exists, the backfill '
+                                 'continues where it left off.')
+
+    def handle(self, *args, **options):
+        hook = self.find_hook(options['hook'])
+        since = self.parse_since(options['since'])
+        roles = sorted(set(options['role']))
+        checkpoint_path: typing.Optional[pathlib.Path] = options['checkpoint']
+        page_size = options['page_size']
+        rate = options['rate']
+        max_queue = options['max_queue']
+        if page_size < 1:
+            raise CommandError('--page-size must be positive')
+
+        params = self.checkpoint_params(hook, since, roles)
+        last_id = 0
+        if checkpoint_path and checkpoint_path.exists():
+            last_id = checkpoints.load(checkpoint_path, params)['last_user_id']
+            self.stdout.write(f'Resuming after user {last_id}')
+
+        users = self.user_queryset(since, roles)
+        start_time = time.monotonic()
+        queued_total = 0
+        while True:
+            self.wait_for_queue(hook, max_queue)
+
+            checked, queued, last_id = self.queue_page(hook, users, last_id, page_size)
+            if not checked:
+                break
+            queued_total += queued
+            if checkpoint_path:
+                checkpoints.save(checkpoint_path, {**params, 'last_user_id': last_id})
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Queued {queued_total} users, up to user {last_id}')
+
+            if rate > 0:
+                # Sleep until we're back under the rate limit.
+                ahead = queued_total / rate - (time.monotonic() - start_time)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        self.stdout.write(self.style.SUCCESS(f'Queued {queued_total} users for {hook}'))
+
+    def find_hook(self, hook_arg: str) -> models.Webhook:
+        hooks = models.Webhook.objects.all()
+        try:
+            if hook_arg.isdigit():
+                return hooks.get(id=int(hook_arg))
+            return hooks.get(name=hook_arg)
+        except models.Webhook.DoesNotExist:
+            raise CommandError(f'Webhook {hook_arg!r} does not exist')
+        except models.Webhook.MultipleObjectsReturned:
+            raise CommandError(f'Multiple webhooks are named {hook_arg!r}; use the ID')
+
+    def parse_since(self, since_arg: typing.Optional[str]) -> typing.Optional[datetime.datetime]:
+        if not since_arg:
+            return None
+        since = dateparse.parse_datetime(since_arg)
+        if since is None:
+            date = dateparse.parse_date(since_arg)
+            if date is None:
+                raise CommandError(f'Unable to parse --since {since_arg!r}')
+            since = datetime.datetime.combine(date, datetime.time.min)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def user_queryset(self, since, roles: typing.List[str]):
+        users = UserModel.objects.all()
+        if since is not None:
+            users = users.filter(last_update__gte=since)
+        if roles:
+            # A subquery instead of a join, so that every user is returned once
+            # and the rows can be locked.
+            has_role = UserModel.roles.through.objects \
+                .filter(user_id=OuterRef('pk'), role__name__in=roles)
+            users = users.annotate(has_role=Exists(has_role)).filter(has_role=True)
+        return users
+
+    def queue_page(self, hook: models.Webhook, users, last_id: int, page_size: int) \
+            -> typing.Tuple[int, int, int]:
+        """Queues the next page of users after last_id.
+
+        :returns: the number of users checked, the number of users queued,
+            and the ID of the last user in the page.
+        """
+        # Lock the users until their calls are queued. A user saved in the
+        # meantime is queued after our call, so that the receiver ends up with
+        # the latest state, and never with our older copy.
+        with transaction.atomic():
+            page = users \
+                .select_for_update() \
+                .filter(id__gt=last_id) \
+                .order_by('id') \
+                .values_list('id', 'email', 'full_name')[:page_size]
+            # A server-side cursor, where the database supports it.
+            page = list(page.iterator(chunk_size=page_size))
+            if not page:
+                return 0, 0, last_id
+
+            user_ids = [user_id for user_id, _, _ in page]
+            roles = self.public_roles(user_ids)
+            to_queue = []
+            for user_id, email, full_name in page:
+                # Everything is sent as changed, as the receiver may know nothing.
+                user_roles = roles.get(user_id, set())
+                events = signals.user_events(set(self.changed_fields), set(), user_roles)
+                if not hook.wants(events, user_roles, user_roles):
+                    continue
+                payload = payloads.user_modified(
+                    hook.payload_version,
+                    user_id=user_id,
+                    old_email=email,
+                    email=email,
+                    full_name=full_name.strip(),
+                    roles=sorted(user_roles),
+                    changed_fields=self.changed_fields,
+                )
+                to_queue.append((user_id, json.dumps(payload).encode()))
+            if to_queue:
+                outbox.enqueue_many(hook, to_queue)
+        return len(page), len(to_queue), user_ids[-1]
+
+    def public_roles(self, user_ids: typing.List[int]) -> typing.Dict[int, typing.Set[str]]:
+        """Returns the public role names of the users, in a single query."""
+        user_roles = UserModel.roles.through.objects \
+            .filter(user_id__in=user_ids, role__is_public=True, role__is_active=True) \
+            .values_list('user_id', 'role__name')
+        roles: typing.Dict[int, typing.Set[str]] = {}
+        for user_id, role_name in user_roles:
+            roles.setdefault(user_id, set()).add(role_name)
+        return roles
+
+    def wait_for_queue(self, hook: models.Webhook, max_queue: int):
+        """Waits until the webhook's queue is small enough for another page."""
+        if max_queue <= 0:
+            return
+        while hook.queue_size() > max_queue:
+            log.debug('%s has more than %d queued calls, waiting', hook, max_queue)
+            time.sleep(1)
+
+    def checkpoint_params(self, hook: models.Webhook, since, roles: typing.List[str]) -> dict:
+        return {
+            'hook': hook.id,
+            'since': since.isoformat() if since else None,
+            'roles': roles,
+        }
@@ -0,0 +1,284 @@
+"""Webhook delivery metrics.
+
+Every process counts its own deliveries, per webhook: attempts, successes,
+responses per HTTP status class, and a histogram of the delivery latency.
+These counters are cheap to update, as they only live in memory.
+
+To combine the counters of all processes (uWSGI workers, delivery daemons,
+possibly on multiple hosts), every process regularly publishes its counters
+to the cache in settings.WEBHOOK_METRICS_CACHE, under a key of its own. They
+are summed when the metrics are read. The counters of processes that stopped
+stay in the cache for settings.WEBHOOK_METRICS_TTL seconds, so that the totals
+don't drop when a worker is restarted.
+
+The state of the queues (depth, age of the oldest call) and of the circuit
+breakers is read from the database when the metrics are collected.
+"""
+
+import copy
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Min
+from django.utils import timezone
+
+log = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = 'webhook-metrics'
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ('2xx', '3xx', '4xx', '5xx', 'error')
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_counters: typing.Dict[int, dict] = {}
+_last_publish = 0.0
+_aggregated: typing.Tuple[float, typing.Dict[int, dict]] = (float('-inf'), {})
+
+
+def _new_counters() -> dict:
+    return {
+        'attempts': 0,
+        'successes': 0,
+        'failures': 0,
+        'events': 0,
+        'status_classes': {status_class: 0 for status_class in STATUS_CLASSES},
+        'latency': {
+            # Not cumulative; the last bucket counts everything above the last bound.
+            'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+            'sum': 0.0,
+            'count': 0,
+        },
+    }
+
+
+def status_class(status_code: int) -> str:
+    """Returns '2xx' etc. for the status code, or 'error' when there was no response."""
+    if not status_code:
+        return 'error'
+    return f'{min(max(status_code // 100, 2), 5)}xx'
+
+
+def _check_fork():
+    """Makes sure that a forked process only counts its own deliveries."""
+    global _lock, _pid, _last_publish
+
+    if _pid != os.getpid():
+        _lock = threading.Lock()
+        _pid = os.getpid()
+        _counters.clear()
+        _last_publish = 0.0
+
+
+def record_delivery(hook_id: int, status_code: int, duration: float, *, events: int = 1):
+    """Records an attempt to deliver to the webhook.
+
+    :param status_code: the HTTP status code, or 0 when there was no response.
+    :param duration: the time it took, in seconds.
+    :param events: the number of queued calls in the request.
+    """
+    _check_fork()
+    success = 0 < status_code < 400
+    with _lock:
+        counters = _counters.get(hook_id)
+        if counters is None:
+            counters = _counters[hook_id] = _new_counters()
+        counters['attempts'] += 1
+        if success:
+            counters['successes'] += 1
+            counters['events'] += events
+        else:
+            counters['failures'] += 1
+        counters['status_classes'][status_class(status_code)] += 1
+
+        latency = counters['latency']
+        bucket = next((idx for idx, bound in enumerate(LATENCY_BUCKETS) if duration <= bound),
+                      len(LATENCY_BUCKETS))
+        latency['buckets'][bucket] += 1
+        latency['sum'] += duration
+        latency['count'] += 1
+
+
+def snapshot() -> typing.Dict[int, dict]:
+    """Returns a copy of the counters of this process."""
+    _check_fork()
+    with _lock:
+        return copy.deepcopy(_counters)
+
+
+def reset():
+    """Forgets the counters of this process."""
+    with _lock:
+        _counters.clear()
+
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _cache():
+    return caches[settings.WEBHOOK_METRICS_CACHE]
+
+
+def publish(*, force=False, worker: str = None):
+    """Stores the counters of this process in the shared cache.
+
+    Does nothing when they were published less than
+    settings.WEBHOOK_METRICS_PUBLISH_INTERVAL seconds ago, unless forced.
+    """
+    global _last_publish
+
+    _check_fork()
+    now = time.monotonic()
+    if not force and now - _last_publish < settings.WEBHOOK_METRICS_PUBLISH_INTERVAL:
+        return
+    _last_publish = now
+
+    counters = snapshot()
+    if not counters:
+        return
+
+    worker = worker or worker_id()
+    cache = _cache()
+    ttl = settings.WEBHOOK_METRICS_TTL
+    cache.set(f'{CACHE_KEY_PREFIX}:worker:{worker}', counters, timeout=ttl)
+
+    # The list of workers is not updated atomically, so a concurrent publish
+    # can lose our entry. It is added again the next time we publish.
+    index_key = f'{CACHE_KEY_PREFIX}:workers'
+    workers = cache.get(index_key) or {}
+    expired_before = time.time() - ttl
+    workers = {name: published for name, published in workers.items()
+               if published >= expired_before}
+    workers[worker] = time.time()
+    cache.set(index_key, workers, timeout=ttl)
+
+
+def _add_counters(total: dict, counters: dict):
+    for key in ('attempts', 'successes', 'failures', 'events'):
+        total[key] += counters[key]
+    for key, count in counters['status_classes'].items():
+        total['status_classes'][key] = total['status_classes'].get(key, 0) + count
+    latency = total['latency']
+    latency['buckets'] = [a + b for a, b in zip(latency['buckets'],
+                                                counters['latency']['buckets'])]
+    latency['sum'] += counters['latency']['sum']
+    latency['count'] += counters['latency']['count']
+
+
+def aggregate(*, max_age: float = 0) -> typing.Dict[int, dict]:
+    """Returns the counters of all processes, summed per webhook ID.
+
+    :param max_age: return the previous result when it is at most this
+        many seconds old, instead of reading the cache again.
+    """
+    global _aggregated
+
+    if max_age:
+        aggregated_at, totals = _aggregated
+        if time.monotonic() - aggregated_at <= max_age:
+            return totals
+
+    cache = _cache()
+    workers = cache.get(f'{CACHE_KEY_PREFIX}:workers') or {}
+    keys = [f'{CACHE_KEY_PREFIX}:worker:{worker}' for worker in workers]
+    totals: typing.Dict[int, dict] = {}
+    for worker_counters in cache.get_many(keys).values():
+        for hook_id, counters in worker_counters.items():
+            total = totals.get(hook_id)
+            if total is None:
+                total = totals[hook_id] = _new_counters()
+            _add_counters(total, counters)
+    _aggregated = (time.monotonic(), totals)
+    return totals
+
+
+def collect() -> typing.List[dict]:
+    """Returns the metrics of all webhooks, combining all processes."""
+    from . import models
+
+    publish(force=True)
+    totals = aggregate()
+    now = timezone.now()
+
+    hooks = models.Webhook.objects \
+        .annotate(queue_depth=Count('queue'), oldest_queued=Min('queue__created')) \
+        .order_by('name', 'id')
+    collected = []
+    for hook in hooks:
+        oldest_age = (now - hook.oldest_queued).total_seconds() if hook.oldest_queued else 0.0
+        info = {
+            'id': hook.id,
+            'name': hook.name,
+            'enabled': hook.enabled,
+            'breaker_state': hook.breaker_state,
+            'queue_depth': hook.queue_depth,
+            'oldest_queued_seconds': max(0.0, oldest_age),
+        }
+        info.update(totals.get(hook.id) or _new_counters())
+        collected.append(info)
+    return collected
+
+
+def _escape(label_value: str) -> str:
+    return label_value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def prometheus_text(collected: typing.List[dict]) -> str:
+    """Formats collected metrics in the Prometheus text exposition format."""
+    from . import models
+
+    lines = []
+
+    def metric(name: str, metric_type: str, help_text: str, values):
+        lines.append(f'# HELP blender_id_webhook_{name} {help_text}')
+        lines.append(f'# TYPE blender_id_webhook_{name} {metric_type}')
+        for suffix, labels, value in values:
+            label_str = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+            lines.append(f'blender_id_webhook_{name}{suffix}{{{label_str}}} {value}')
+
+    def per_hook(getter):
+        return [('', {'webhook': info['name'], 'id': info['id']}, getter(info))
+                for info in collected]
+
+    metric('attempts_total', 'counter', 'Delivery attempts.',
+           per_hook(lambda info: info['attempts']))
+    metric('successes_total', 'counter', 'Successful deliveries.',
+           per_hook(lambda info: info['successes']))
+    metric('events_delivered_total', 'counter', 'Queued calls delivered.',
+           per_hook(lambda info: info['events']))
+    metric('responses_total', 'counter', 'Responses per HTTP status class.',
+           [('', {'webhook': info['name'], 'id': info['id'], 'class': status_class_},
+             info['status_classes'].get(status_class_, 0))
+            for info in collected for status_class_ in STATUS_CLASSES])
+
+    histogram = []
+    for info in collected:
+        labels = {'webhook': info['name'], 'id': info['id']}
+        latency = info['latency']
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), latency['buckets']):
+            cumulative += count
+            histogram.append(('_bucket', dict(labels, le=bound), cumulative))
+        histogram.append(('_sum', labels, latency['sum']))
+        histogram.append(('_count', labels, latency['count']))
+    metric('delivery_seconds', 'histogram', 'Duration of delivery attempts.', histogram)
+
+    metric('queue_depth', 'gauge', 'Queued calls.',
+           per_hook(lambda info: info['queue_depth']))
+    metric('oldest_queued_seconds', 'gauge', 'Age of the oldest queued call.',
+           per_hook(lambda info: info['oldest_queued_seconds']))
+    metric('breaker_state', 'gauge', 'Circuit breaker state; 1 for the current state.',
+           [('', {'webhook': info['name'], 'id': info['id'], 'state': state},
+             int(info['breaker_state'] == state))
+            for info in collected for state, _ in models.BREAKER_STATES])
+    metric('enabled', 'gauge', 'Whether the webhook is enabled.',
+           per_hook(lambda info: int(info['enabled'])))
+
+    return '\n'.join(lines) + '\n'
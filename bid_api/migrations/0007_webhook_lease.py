@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0006_webhookqueuedcall_defaults'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', help_text='The worker that is delivering to this webhook', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, help_text='When the lease of the worker expires', null=True),
+        ),
+    ]
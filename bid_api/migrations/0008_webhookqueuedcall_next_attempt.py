@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:29
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0007_webhook_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookqueuedcall',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Number of failed delivery attempts'),
+        ),
+        migrations.AddField(
+            model_name='webhookqueuedcall',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Do not try to deliver before this time'),
+        ),
+        migrations.AddIndex(
+            model_name='webhookqueuedcall',
+            index=models.Index(fields=['webhook', 'next_attempt_at'], name='bid_api_web_webhook_cbafed_idx'),
+        ),
+    ]
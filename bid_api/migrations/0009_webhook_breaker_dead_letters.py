@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0008_webhookqueuedcall_next_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='breaker_opened_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='breaker_state',
+            field=models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half-open', 'Half-open')], default='closed', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='breaker_window_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='breaker_window_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='breaker_window_start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='WebhookDeadLetter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField(help_text='The payload to POST to the webhook')),
+                ('error_code', models.IntegerField(blank=True, default=0, help_text='The HTTP status code received when last POSTing')),
+                ('error_msg', models.TextField(blank=True, default='', help_text='The HTTP response received when last POSTing')),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Number of failed delivery attempts')),
+                ('queued', models.DateTimeField(help_text='When the call was originally queued')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('webhook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dead_letters', to='bid_api.Webhook')),
+            ],
+            options={
+                'verbose_name': 'Webhook Dead Letter',
+                'verbose_name_plural': 'Webhook dead letters',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0009_webhook_breaker_dead_letters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='coalesce_events',
+            field=models.BooleanField(default=False, help_text='Replace undelivered calls about a user with a single call about its latest state, instead of sending every intermediate state.'),
+        ),
+        migrations.AddField(
+            model_name='webhookqueuedcall',
+            name='subject_id',
+            field=models.IntegerField(blank=True, help_text='ID of the object the payload is about', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='webhookqueuedcall',
+            index=models.Index(fields=['webhook', 'subject_id'], name='bid_api_web_webhook_25b80b_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0010_webhook_coalesce_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='max_batch_size',
+            field=models.PositiveIntegerField(default=1, help_text='When larger than 1, up to this many queued calls are sent in one POST, as JSON array. The receiver has to support this.'),
+        ),
+    ]
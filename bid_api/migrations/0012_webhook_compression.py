@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0011_webhook_max_batch_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='compression',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('gzip', 'gzip'), ('deflate', 'deflate')], default='', help_text='Compress request bodies of at least settings.WEBHOOK_COMPRESSION_MIN_SIZE bytes. The HMAC is always computed over the uncompressed body.', max_length=16),
+        ),
+    ]
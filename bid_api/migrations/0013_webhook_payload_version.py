@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0012_webhook_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='payload_version',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Version 1: full user state'), (2, 'Version 2: changed fields only')], default=1, help_text='What USER_MODIFIED calls contain; see bid_api/payloads.py.'),
+        ),
+    ]
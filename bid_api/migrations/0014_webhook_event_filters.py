@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0013_webhook_payload_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='event_types',
+            field=models.CharField(blank=True, default='', help_text='Space-separated events this webhook is called for; empty for all events. Possible events: user_modified, email_changed, role_granted, role_revoked, deletion_requested.', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='webhook',
+            name='role_filter',
+            field=models.CharField(blank=True, default='', help_text='Space-separated role names. When given, this webhook is only called for users that have (or had) one of these roles, and only for grants and revocations of these roles.', max_length=255),
+        ),
+    ]
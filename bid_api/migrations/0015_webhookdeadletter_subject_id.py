@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0014_webhook_event_filters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookdeadletter',
+            name='subject_id',
+            field=models.IntegerField(blank=True, help_text='ID of the object the payload is about', null=True),
+        ),
+    ]
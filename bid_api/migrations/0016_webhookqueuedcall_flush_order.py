@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0015_webhookdeadletter_subject_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='webhookqueuedcall',
+            index=models.Index(fields=['webhook', 'created', 'id'], name='bid_api_web_webhook_107e75_idx'),
+        ),
+    ]
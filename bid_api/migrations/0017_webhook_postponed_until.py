@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 15:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bid_api', '0016_webhookqueuedcall_flush_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='postponed_until',
+            field=models.DateTimeField(blank=True, help_text='No queued call is attempted before this time, as an earlier one failed', null=True),
+        ),
+    ]
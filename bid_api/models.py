@@ -1,37 +1,121 @@
 import datetime
+import gzip
 import hashlib
 import hmac
+import json
 import logging
+import os
+import random
+import socket
+import threading
+import time
 import typing
+import zlib
 
-from django.db import models
+from django.conf import settings
+from django.db import DatabaseError, models, transaction
+from django.db.models import F, Q
 from django.utils import timezone
 import requests
 
+from . import metrics, payloads, sessions
+
 WEBHOOK_TYPES = [
     ('USER_MODIFIED', 'User Modified'),
 ]
 WEBHOOK_RETRY_COUNT = 5
+# Number of queued calls read per query when flushing.
+FLUSH_PAGE_SIZE = 100
+
+EVENT_USER_MODIFIED = 'user_modified'
+EVENT_EMAIL_CHANGED = 'email_changed'
+EVENT_ROLE_GRANTED = 'role_granted'
+EVENT_ROLE_REVOKED = 'role_revoked'
+EVENT_DELETION_REQUESTED = 'deletion_requested'
+WEBHOOK_EVENTS = [
+    (EVENT_USER_MODIFIED, 'Other user information changed (name, avatar)'),
+    (EVENT_EMAIL_CHANGED, 'Email address changed'),
+    (EVENT_ROLE_GRANTED, 'Public role granted'),
+    (EVENT_ROLE_REVOKED, 'Public role revoked'),
+    (EVENT_DELETION_REQUESTED, 'Deletion of the user was requested'),
+]
 
-# List of (max age of oldest queued item, delay before flushing again) tuples.
-# if age >= tuple[0] → flush after tuple[1]
-WEBHOOK_FLUSH_INTERVALS = [
-    (datetime.timedelta(minutes=30), datetime.timedelta(seconds=15)),
-    (datetime.timedelta(minutes=2), datetime.timedelta(seconds=10)),
-    (datetime.timedelta(seconds=30), datetime.timedelta(seconds=5)),
-    (datetime.timedelta(seconds=5), datetime.timedelta(seconds=2)),
-    (datetime.timedelta(seconds=0), datetime.timedelta(seconds=1)),
+PAYLOAD_VERSIONS = [
+    (payloads.PAYLOAD_FULL, 'Version 1: full user state'),
+    (payloads.PAYLOAD_DELTA, 'Version 2: changed fields only'),
+]
+
+COMPRESSION_NONE = ''
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_CHOICES = [
+    (COMPRESSION_NONE, 'None'),
+    (COMPRESSION_GZIP, 'gzip'),
+    (COMPRESSION_DEFLATE, 'deflate'),
+]
+# Fast, and compresses JSON nearly as well as the maximum level.
+COMPRESSION_LEVEL = 6
+
+BREAKER_FIELDS = {'breaker_state', 'breaker_opened_at', 'breaker_window_start',
+                  'breaker_window_attempts', 'breaker_window_failures'}
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+BREAKER_STATES = [
+    (BREAKER_CLOSED, 'Closed'),
+    (BREAKER_OPEN, 'Open'),
+    (BREAKER_HALF_OPEN, 'Half-open'),
 ]
 
 
 def webhook_session() -> requests.Session:
-    """Creates a Requests session for sending to webhooks."""
-    import requests.adapters
+    """Creates a Requests session for sending to webhooks.
+
+    Webhook delivery uses the long-lived sessions of `session_registry`
+    instead; only use this when you need a session of your own.
+    """
+    return sessions.new_session(max_retries=WEBHOOK_RETRY_COUNT)
+
+
+# Keeps HTTP connections to webhook hosts alive between flushes.
+session_registry = sessions.SessionRegistry(max_retries=WEBHOOK_RETRY_COUNT)
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    """Returns how long to wait before the next attempt, after 'attempts' failed ones.
+
+    The delay grows exponentially from WEBHOOK_RETRY_BASE_DELAY up to
+    WEBHOOK_RETRY_MAX_DELAY seconds. Half of it is random, so that the retries
+    of calls that failed at the same time are spread out.
+    """
+    base = settings.WEBHOOK_RETRY_BASE_DELAY
+    max_delay = settings.WEBHOOK_RETRY_MAX_DELAY
+    # Limit the exponent to prevent overflow.
+    delay = min(max_delay, base * 2 ** min(max(attempts - 1, 0), 32))
+    return datetime.timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
 
-    sess = requests.Session()
-    sess.mount('https://', requests.adapters.HTTPAdapter(max_retries=WEBHOOK_RETRY_COUNT))
-    sess.mount('http://', requests.adapters.HTTPAdapter(max_retries=WEBHOOK_RETRY_COUNT))
-    return sess
+def compress(payload: bytes, encoding: str) -> bytes:
+    """Compresses the payload for the given HTTP Content-Encoding."""
+    if encoding == COMPRESSION_GZIP:
+        return gzip.compress(payload, compresslevel=COMPRESSION_LEVEL)
+    if encoding == COMPRESSION_DEFLATE:
+        # HTTP 'deflate' is the zlib format, not raw deflate.
+        return zlib.compress(payload, COMPRESSION_LEVEL)
+    raise ValueError(f'unknown compression {encoding!r}')
+
+
+def truncate_error_msg(error_msg: str) -> str:
+    """Limits the length of error messages, as responses can be arbitrarily large."""
+    max_length = settings.WEBHOOK_ERROR_MSG_MAX_LENGTH
+    if len(error_msg) <= max_length:
+        return error_msg
+    return error_msg[:max_length - 1] + '…'
+
+
+def default_worker_id() -> str:
+    """Identifies the current thread of the current process on the current host."""
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
 
 
 def create_random_secret() -> str:
@@ -51,64 +135,221 @@ class Webhook(models.Model):
                                    help_text='Description of this webhook, for staff-eyes only.')
     timeout = models.IntegerField(default=3,
                                   help_text='Timeout for HTTP calls to this webhook, in seconds.')
+    max_batch_size = models.PositiveIntegerField(
+        default=1,
+        help_text='When larger than 1, up to this many queued calls are sent in one POST, '
+                  'as JSON array. The receiver has to support this.')
+    compression = models.CharField(
+        max_length=16, blank=True, default=COMPRESSION_NONE, choices=COMPRESSION_CHOICES,
+        help_text='Compress request bodies of at least settings.WEBHOOK_COMPRESSION_MIN_SIZE '
+                  'bytes. The HMAC is always computed over the uncompressed body.')
+    payload_version = models.PositiveSmallIntegerField(
+        choices=PAYLOAD_VERSIONS, default=payloads.PAYLOAD_FULL,
+        help_text='What USER_MODIFIED calls contain; see bid_api/payloads.py.')
+    event_types = models.CharField(
+        max_length=255, blank=True, default='',
+        help_text='Space-separated events this webhook is called for; empty for all events. '
+                  'Possible events: ' + ', '.join(event for event, _ in WEBHOOK_EVENTS) + '.')
+    role_filter = models.CharField(
+        max_length=255, blank=True, default='',
+        help_text='Space-separated role names. When given, this webhook is only called for '
+                  'users that have (or had) one of these roles, and only for grants and '
+                  'revocations of these roles.')
+    coalesce_events = models.BooleanField(
+        default=False,
+        help_text='Replace undelivered calls about a user with a single call about its latest '
+                  'state, instead of sending every intermediate state.')
     last_flush_attempt = models.DateTimeField(
         null=True,
         help_text='Records when we last tried to flush this queue')
 
+    # Only the worker holding the lease may deliver queued calls to this webhook.
+    # Leasing the entire webhook, rather than individual calls, keeps the calls
+    # in order when multiple workers are running.
+    claimed_by = models.CharField(max_length=255, blank=True, default='',
+                                  help_text='The worker that is delivering to this webhook')
+    claimed_until = models.DateTimeField(null=True, blank=True,
+                                         help_text='When the lease of the worker expires')
+    postponed_until = models.DateTimeField(
+        null=True, blank=True,
+        help_text='No queued call is attempted before this time, as an earlier one failed')
+
+    # Circuit breaker. When too many recent calls failed, the breaker opens and
+    # nothing is sent for a while. After that it is half-open, and the next call
+    # decides whether it closes again or re-opens.
+    breaker_state = models.CharField(max_length=16, choices=BREAKER_STATES,
+                                     default=BREAKER_CLOSED)
+    breaker_opened_at = models.DateTimeField(null=True, blank=True)
+    breaker_window_start = models.DateTimeField(null=True, blank=True)
+    breaker_window_attempts = models.PositiveIntegerField(default=0)
+    breaker_window_failures = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         return self.name
 
-    def queue_size(self) -> int:
-        """Returns the number of queued calls to this webhook."""
-        return self.queue.count()
+    def clean(self):
+        from django.core.exceptions import ValidationError
 
-    def flush_time(self, *, now: datetime.datetime = None) -> typing.Optional[datetime.datetime]:
-        """Returns the datetime at which this queue should be flushed.
+        known_events = {event for event, _ in WEBHOOK_EVENTS}
+        unknown = set(self.event_types.split()) - known_events
+        if unknown:
+            raise ValidationError({'event_types': 'Unknown events: ' + ', '.join(sorted(unknown))})
 
-        :returns: the datetime when should be flushed, or None when the queue is empty.
-        """
-        if self.queue_size() == 0:
-            return None
+    def subscribed_events(self) -> typing.Set[str]:
+        """Returns the events this webhook should be called for."""
+        return set(self.event_types.split()) or {event for event, _ in WEBHOOK_EVENTS}
 
-        if self.last_flush_attempt is None:
-            if now is not None:
-                return now
-            return timezone.now()
+    def wants(self, events: typing.Set[str], user_roles: typing.Set[str],
+              changed_roles: typing.Set[str]) -> bool:
+        """Returns whether this webhook should be called for a change to a user.
 
-        delay = self.flush_delay()
-        if delay is None:
-            return None
-        return self.last_flush_attempt + delay
+        :param events: the events of the change.
+        :param user_roles: the public roles the user had before or after the change.
+        :param changed_roles: the public roles that were granted or revoked.
+        """
+        events = events & self.subscribed_events()
+        if not events:
+            return False
+
+        role_filter = set(self.role_filter.split())
+        if not role_filter:
+            return True
+        role_events = {EVENT_ROLE_GRANTED, EVENT_ROLE_REVOKED}
+        if events & role_events and changed_roles & role_filter:
+            return True
+        return bool(events - role_events and user_roles & role_filter)
 
-    def flush_delay(self, *, now: datetime.datetime = None) -> typing.Optional[datetime.timedelta]:
-        """Returns the delay after which this queue should be flushed.
+    def queue_size(self) -> int:
+        """Returns the number of queued calls to this webhook."""
+        return self.queue.count()
 
-        Add this to last_flush_attempt to have an absolute datetime.
+    def worst_send_duration(self) -> datetime.timedelta:
+        """Returns how long sending one call can take, including retries."""
+        return datetime.timedelta(seconds=self.timeout * (WEBHOOK_RETRY_COUNT + 1))
 
-        :returns: the timedelta after it should be flushed, or None when the queue is empty.
-        """
-        if self.queue_size() == 0:
-            return None
+    def lease_duration(self) -> datetime.timedelta:
+        """Returns how long a lease lasts; longer than the worst case of sending one call."""
+        return max(datetime.timedelta(seconds=settings.WEBHOOK_LEASE_SECONDS),
+                   self.worst_send_duration())
 
-        if now is None:
-            now = timezone.now()
+    def claim(self, worker_id: str) -> bool:
+        """Leases this webhook to the worker, or renews its lease.
 
-        oldest = self.queue.order_by('created').first()
-        if oldest is None:
-            # Last item got flushed since we checked the queue size.
+        :returns: True when the worker holds the lease, False when another
+            worker does.
+        """
+        now = timezone.now()
+        claimable = Q(claimed_by=worker_id) | Q(claimed_until__isnull=True) \
+            | Q(claimed_until__lt=now)
+        claimed_until = now + self.lease_duration()
+        updated = Webhook.objects \
+            .filter(claimable, id=self.id) \
+            .update(claimed_by=worker_id, claimed_until=claimed_until)
+        if not updated:
+            return False
+        self.claimed_by = worker_id
+        self.claimed_until = claimed_until
+        return True
+
+    def renew_claim(self, worker_id: str) -> bool:
+        """Renews the lease of the worker when it could expire during the next send.
+
+        :returns: True when the worker holds the lease, False when it lost it.
+        """
+        if self.claimed_by == worker_id and self.claimed_until is not None \
+                and self.claimed_until - timezone.now() > 2 * self.worst_send_duration():
+            return True
+        return self.claim(worker_id)
+
+    def release(self, worker_id: str):
+        """Gives up the lease, if the worker still holds it."""
+        Webhook.objects \
+            .filter(id=self.id, claimed_by=worker_id) \
+            .update(claimed_by='', claimed_until=None)
+        if self.claimed_by == worker_id:
+            self.claimed_by = ''
+            self.claimed_until = None
+
+    def breaker_closes_at(self) -> typing.Optional[datetime.datetime]:
+        """Returns when the open breaker becomes half-open, or None when it isn't open."""
+        if self.breaker_state != BREAKER_OPEN or self.breaker_opened_at is None:
             return None
-
-        age = now - oldest.created
-        for agelimit, delay in WEBHOOK_FLUSH_INTERVALS:
-            if age >= agelimit:
-                return delay
-
-        # Fall back to rapid re-flushing.
-        return datetime.timedelta(seconds=1)
+        cooldown = datetime.timedelta(seconds=settings.WEBHOOK_BREAKER_COOLDOWN)
+        return self.breaker_opened_at + cooldown
+
+    def breaker_allows(self, now: datetime.datetime) -> bool:
+        """Returns whether a call may be sent, moving an open breaker to half-open if it is time."""
+        if self.breaker_state != BREAKER_OPEN:
+            return True
+        if now < self.breaker_closes_at():
+            return False
+        self.breaker_state = BREAKER_HALF_OPEN
+        self.save(update_fields={'breaker_state'})
+        return True
+
+    def breaker_record(self, success: bool, now: datetime.datetime):
+        """Records the result of a call, opening or closing the breaker when necessary.
+
+        Only changes of the breaker state are saved immediately. The counts of
+        the window are saved by `breaker_save()`, which flush() calls when
+        it is done, so that not every delivery costs a write.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook.breaker_record')
+        old_state = self.breaker_state
+
+        window = datetime.timedelta(seconds=settings.WEBHOOK_BREAKER_WINDOW)
+        if self.breaker_window_start is None or now - self.breaker_window_start > window:
+            self.breaker_window_start = now
+            self.breaker_window_attempts = 0
+            self.breaker_window_failures = 0
+        self.breaker_window_attempts += 1
+        if not success:
+            self.breaker_window_failures += 1
+
+        if self.breaker_state == BREAKER_HALF_OPEN:
+            if success:
+                log.info('closing circuit breaker of %s', self)
+                self.breaker_state = BREAKER_CLOSED
+                self.breaker_window_start = now
+                self.breaker_window_attempts = 0
+                self.breaker_window_failures = 0
+            else:
+                log.warning('re-opening circuit breaker of %s', self)
+                self.breaker_state = BREAKER_OPEN
+                self.breaker_opened_at = now
+        elif self.breaker_state == BREAKER_CLOSED \
+                and self.breaker_window_attempts >= settings.WEBHOOK_BREAKER_MIN_ATTEMPTS:
+            failure_rate = self.breaker_window_failures / self.breaker_window_attempts
+            if failure_rate >= settings.WEBHOOK_BREAKER_FAILURE_RATE:
+                log.warning('opening circuit breaker of %s, %d of the last %d calls failed',
+                            self, self.breaker_window_failures, self.breaker_window_attempts)
+                self.breaker_state = BREAKER_OPEN
+                self.breaker_opened_at = now
+
+        self._breaker_unsaved = True
+        if self.breaker_state != old_state:
+            self.breaker_save()
+
+    def breaker_save(self):
+        """Saves the breaker, if breaker_record() changed it since it was last saved."""
+        if not getattr(self, '_breaker_unsaved', False):
+            return
+        self.save(update_fields=BREAKER_FIELDS)
+        self._breaker_unsaved = False
+
+    def reset_breaker(self):
+        """Closes the breaker and forgets about recent failures."""
+        self.breaker_state = BREAKER_CLOSED
+        self.breaker_opened_at = None
+        self.breaker_window_start = None
+        self.breaker_window_attempts = 0
+        self.breaker_window_failures = 0
+        self.save(update_fields=BREAKER_FIELDS)
+        self._breaker_unsaved = False
 
     def send(self, payload: bytes, session: requests.Session,
-             *, queued: 'WebhookQueuedCall' = None):
-        """Sends a message to the webhook.
+             *, queued: 'WebhookQueuedCall'):
+        """Sends a queued call to the webhook.
 
         The payload has to be encoded as bytes already. This is a performance
         thing; it allows one to encode the payload once and then send it to
@@ -118,114 +359,330 @@ class Webhook(models.Model):
         :param session: the Requests session to use for sending. This allows
             multiple webhooks to the same host to share a TCP/IP connection,
             and allows the caller control over the number of retries.
-        :param queued: the WebhookQueuedCall that's being sent now. When None
-            (the default) a failure to send will create a new item in the
-            queue. When not None, a failure will be recorded on 'queued'
-            instead.
+        :param queued: the WebhookQueuedCall that's being sent now. It is
+            removed from the queue on success, and a failure is recorded on it.
         """
         log = logging.getLogger(f'{__name__}.Webhook.send')
 
         def record_error(status_code: int, error_msg: str):
-            """Records an error by either creating a new queued call or updating one."""
-            nonlocal queued
-
-            if queued is None:
-                # We re-decode the JSON payload, so that we can show it in the admin while queued.
-                queued = WebhookQueuedCall(
-                    webhook=self,
-                    payload=payload.decode(),
-                    error_code=status_code,
-                    error_msg=error_msg,
-                )
-            else:
-                queued.error_code = status_code
-                queued.error_msg = error_msg
-            queued.save()
-
-        queue_size = self.queue_size()
-        if queue_size > 0 and queued is None:
-            # Refuse sending new items when there are items already queued.
-            # Sending out queued items is okay, though.
-            log.warning('immediately queueing webhook "%s" payload because we already '
-                        'have %d items queued.', self, queue_size)
-            record_error(0, f'queueing because we already have {queue_size} items queued')
+            """Records an error on the queued call."""
+            queued.error_code = status_code
+            queued.error_msg = truncate_error_msg(error_msg)
+            queued.attempts += 1
+            queued.next_attempt_at = timezone.now() + retry_delay(queued.attempts)
+            try:
+                # Never re-insert a call that was removed while we were sending it,
+                # for example because it was coalesced into a newer one.
+                queued.save(force_update=True)
+            except DatabaseError:
+                log.info('queued call %d to %s was removed while sending', queued.id, self)
+
+        error = self._post(payload, session)
+        if error is not None:
+            record_error(*error)
             return
 
+        # If we're here, the send was a success.
+        log.info('dequeueing webhook call to %s', self.url)
+        queued.delete()
+
+    def send_batch(self, batch: typing.List['WebhookQueuedCall'],
+                   session: requests.Session) -> bool:
+        """Sends multiple queued calls as one JSON array, in the given order.
+
+        On success the calls are removed from the queue, and on failure the
+        error is recorded on all of them.
+
+        :returns: whether sending was successful.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook.send_batch')
+
+        # The payloads are JSON already, so they can be joined without re-encoding.
+        payload = b'[' + b','.join(item.payload.encode() for item in batch) + b']'
+        error = self._post(payload, session, events=len(batch))
+        call_ids = [item.id for item in batch]
+        if error is None:
+            log.info('dequeueing %d webhook calls to %s', len(batch), self.url)
+            WebhookQueuedCall.objects.filter(id__in=call_ids).delete()
+            for item in batch:
+                item.id = None
+            return True
+
+        status_code, error_msg = error
+        error_msg = truncate_error_msg(error_msg)
+        next_attempt_at = timezone.now() + retry_delay(batch[0].attempts + 1)
+        WebhookQueuedCall.objects.filter(id__in=call_ids).update(
+            error_code=status_code,
+            error_msg=error_msg,
+            attempts=F('attempts') + 1,
+            next_attempt_at=next_attempt_at,
+            updated=timezone.now(),
+        )
+        for item in batch:
+            item.error_code = status_code
+            item.error_msg = error_msg
+            item.attempts += 1
+            item.next_attempt_at = next_attempt_at
+        return False
+
+    def _post(self, payload: bytes, session: requests.Session, *, events: int = 1) \
+            -> typing.Optional[typing.Tuple[int, str]]:
+        """POSTs the payload to the webhook.
+
+        :param events: the number of queued calls in the payload, for the metrics.
+        :returns: None on success, or a (status code, error message) tuple.
+            The status code is 0 when there was no HTTP response at all.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook._post')
+
         mac = hmac.new(self.secret.encode(), payload, hashlib.sha256)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Webhook-HMAC': mac.hexdigest(),
+        }
+        body, content_encoding = self.encode_body(payload)
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        start = time.monotonic()
         try:
-            log.debug('sending to %s', self.url)
+            log.debug('sending %d bytes to %s', len(body), self.url)
             resp = session.post(
                 self.url,
-                data=payload,
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-Webhook-HMAC': mac.hexdigest(),
-                },
+                data=body,
+                headers=headers,
                 timeout=self.timeout,
             )
-            if resp.status_code >= 400:
-                log.warning('error calling hook "%s", HTTP %s, queueing', self, resp.status_code)
-                record_error(resp.status_code, resp.text or '')
-                return
         except (IOError, OSError) as ex:
+            metrics.record_delivery(self.id, 0, time.monotonic() - start, events=events)
             log.warning('error calling hook "%s", queueing: %s', self, ex)
-            record_error(0, str(ex))
-            return
+            return 0, str(ex)
 
-        # If we're here, the send was a success.
-        if queued:
-            log.info('dequeueing webhook call to %s', self.url)
-            queued.delete()
+        metrics.record_delivery(self.id, resp.status_code, time.monotonic() - start,
+                                events=events)
+        if resp.status_code >= 400:
+            log.warning('error calling hook "%s", HTTP %s, queueing', self, resp.status_code)
+            return resp.status_code, resp.text or ''
+        return None
 
-    def flush(self):
-        """Tries to deliver all queued calls of this webhook."""
-        log = logging.getLogger(f'{__name__}.Webhook.flush')
+    def encode_body(self, payload: bytes) -> typing.Tuple[bytes, str]:
+        """Returns the request body for the payload and its Content-Encoding.
+
+        Small payloads are sent as-is, as compressing them gains little.
+        """
+        if not self.compression or len(payload) < settings.WEBHOOK_COMPRESSION_MIN_SIZE:
+            return payload, ''
+        return compress(payload, self.compression), self.compression
 
-        self.last_flush_attempt = timezone.now()
-        self.save(update_fields={'last_flush_attempt'})
+    def flush(self, *, worker_id: str = None, force=False):
+        """Tries to deliver all queued calls of this webhook.
 
-        queued_count = self.queue.count()
-        if queued_count == 0:
-            log.debug('nothing to flush')
+        Does nothing when another worker holds the lease on this webhook.
+
+        :param force: also deliver calls whose next attempt is still in the
+            future, for example when flushing manually.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook.flush')
+
+        if worker_id is None:
+            worker_id = default_worker_id()
+        if not self.claim(worker_id):
+            log.debug('%s is being flushed by %s', self, self.claimed_by or 'another worker')
             return
 
-        log.info('flushing %d queued item(s) to %s', queued_count, self.url)
+        try:
+            self.last_flush_attempt = timezone.now()
+            self.save(update_fields={'last_flush_attempt'})
+
+            queued_count = self.queue.count()
+            if queued_count == 0:
+                log.debug('nothing to flush')
+                return
+
+            log.info('flushing %d queued item(s) to %s', queued_count, self.url)
+
+            with session_registry.session(self.url) as sess:
+                self._flush_queue(sess, worker_id, force)
+        finally:
+            self.breaker_save()
+            self.release(worker_id)
+            metrics.publish()
 
+    def _flush_queue(self, sess: requests.Session, worker_id: str, force: bool):
+        """Delivers queued calls until the queue is empty or a call cannot be delivered now.
+
+        The queue is read in pages of FLUSH_PAGE_SIZE calls. Every page
+        continues after the last call of the previous one, so that draining a
+        long queue does not read it from the start for every delivered call.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook.flush')
+
+        if not force and self.postponed_until is not None \
+                and self.postponed_until > timezone.now():
+            log.debug('%s is postponed until %s', self, self.postponed_until)
+            return
+
+        batch_size = max(1, self.max_batch_size)
         # Order by 'created' to keep items in the correct order. This is important
         # for subscription statuses for example (the store takes away the subscription
         # role when payment is due, and gives it back when paid, and those should be
         # handled in the correct order).
-        sess = webhook_session()
-        for item in self.queue.order_by('created'):
-            payload = item.payload.encode()
-            item.webhook.send(payload, sess, queued=item)
+        queue = self.queue.order_by('created', 'id')
+        last_key = None
+        while True:
+            page = queue
+            if last_key is not None:
+                last_created, last_id = last_key
+                page = page.filter(Q(created__gt=last_created)
+                                   | Q(created=last_created, id__gt=last_id))
+            page = list(page[:max(batch_size, FLUSH_PAGE_SIZE)])
+            if not page:
+                return
+            # Delivered calls lose their ID, so remember it now.
+            last_key = page[-1].created, page[-1].id
+
+            batch = []
+            for item in page:
+                now = timezone.now()
+                if item.is_expired(now):
+                    log.warning('giving up on call %d to %s after %d attempts',
+                                item.id, self, item.attempts)
+                    item.to_dead_letter()
+                    continue
+                if not force and item.next_attempt_at > now:
+                    if batch and not self._deliver_due(batch, sess, worker_id, force):
+                        return
+                    log.debug('next attempt for %s is at %s', self, item.next_attempt_at)
+                    self.postpone_queue(item.next_attempt_at)
+                    return
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not self._deliver_due(batch, sess, worker_id, force):
+                        return
+                    batch = []
+            if batch and not self._deliver_due(batch, sess, worker_id, force):
+                return
+
+    def _deliver_due(self, batch: typing.List['WebhookQueuedCall'], sess: requests.Session,
+                     worker_id: str, force: bool) -> bool:
+        """Delivers calls that are due, unless the breaker is open or the lease was lost.
+
+        :returns: whether the flush can continue with the next calls.
+        """
+        log = logging.getLogger(f'{__name__}.Webhook.flush')
+
+        if not force and not self.breaker_allows(timezone.now()):
+            # Don't even try; the webhook is known to be broken.
+            log.debug('circuit breaker of %s is open', self)
+            self.postpone_queue(self.breaker_closes_at())
+            return False
+
+        # Make sure the lease cannot expire while sending.
+        if not self.renew_claim(worker_id):
+            log.warning('lost lease on %s, stopping flush', self)
+            return False
+        return self._deliver(batch, sess)
+
+    def _deliver(self, batch: typing.List['WebhookQueuedCall'], sess: requests.Session) -> bool:
+        """Sends queued calls, in the format this webhook expects.
+
+        :returns: whether sending was successful.
+        """
+        if self.max_batch_size > 1:
+            success = self.send_batch(batch, sess)
+        else:
+            item = batch[0]
+            item.webhook = self
+            self.send(item.payload.encode(), sess, queued=item)
+            success = item.pk is None
+
+        self.breaker_record(success, timezone.now())
+        if success:
+            if self.postponed_until is not None:
+                self.postponed_until = None
+                self.save(update_fields={'postponed_until'})
+            return True
+
+        # Sending failed; retry later to keep the remaining items in order.
+        head = batch[0]
+        if head.is_expired(timezone.now()):
+            head.to_dead_letter()
+        self.postpone_queue(head.next_attempt_at)
+        return False
+
+    def postpone_queue(self, next_attempt_at: datetime.datetime):
+        """Makes sure no queued call is attempted before 'next_attempt_at'.
+
+        The queue is delivered in order, so later calls cannot be delivered
+        before the first one anyway. Postponing the webhook, rather than each
+        of its queued calls, keeps it from being seen as having due calls
+        with a single write.
+        """
+        if self.postponed_until is not None and self.postponed_until >= next_attempt_at:
+            return
+        self.postponed_until = next_attempt_at
+        self.save(update_fields={'postponed_until'})
 
 
 class WebhookQueuedCall(models.Model):
     """Queued call to a webhook.
 
-    Ordinarily webhooks are called immediately, but when that fails the
-    POST request is stored in this queue.
+    Calls are queued in the same transaction as the change that triggers
+    them, and removed from the queue once they have been delivered.
     """
 
     webhook = models.ForeignKey(Webhook, on_delete=models.CASCADE, related_name='queue')
     payload = models.TextField(help_text='The payload to POST to the webhook')
+    subject_id = models.IntegerField(null=True, blank=True,
+                                     help_text='ID of the object the payload is about')
 
     error_code = models.IntegerField(blank=True, default=0,
                                      help_text='The HTTP status code received when POSTing')
     error_msg = models.TextField(blank=True, default='',
                                  help_text='The HTTP response received when POSTing')
 
+    attempts = models.PositiveIntegerField(default=0,
+                                           help_text='Number of failed delivery attempts')
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           help_text='Do not try to deliver before this time')
+
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Webhook Queued Call'
         verbose_name_plural = 'Webhook queue'
+        indexes = [
+            models.Index(fields=['webhook', 'next_attempt_at']),
+            models.Index(fields=['webhook', 'subject_id']),
+            models.Index(fields=['webhook', 'created', 'id']),
+        ]
+
+    def is_expired(self, now: datetime.datetime) -> bool:
+        """Returns whether we should give up on this call."""
+        max_age = datetime.timedelta(seconds=settings.WEBHOOK_MAX_AGE)
+        return self.attempts >= settings.WEBHOOK_MAX_ATTEMPTS or now - self.created > max_age
+
+    def to_dead_letter(self) -> 'WebhookDeadLetter':
+        """Moves this call from the queue to the dead letters."""
+        with transaction.atomic():
+            dead_letter = WebhookDeadLetter.objects.create(
+                webhook=self.webhook,
+                payload=self.payload,
+                subject_id=self.subject_id,
+                error_code=self.error_code,
+                error_msg=truncate_error_msg(self.error_msg),
+                attempts=self.attempts,
+                queued=self.created,
+            )
+            self.delete()
+        return dead_letter
 
     @classmethod
     def flush_all(cls):
-        """Tries to deliver all queued calls."""
+        """Tries to deliver all queued calls, including those that are not due yet.
+
+        Webhooks that are being flushed by another worker are skipped.
+        """
         log = logging.getLogger(f'{__name__}.WebhookQueuedCall.flush_all')
         queued_count = cls.objects.count()
         if queued_count == 0:
@@ -233,11 +690,89 @@ class WebhookQueuedCall(models.Model):
             return
 
         log.info('flushing %d queued item(s)', queued_count)
-        # Order by 'created' to keep items in the correct order. This is important
-        # for subscription statuses for example (the store takes away the subscription
-        # role when payment is due, and gives it back when paid, and those should be
-        # handled in the correct order).
-        sess = webhook_session()
-        for item in cls.objects.order_by('created'):
-            payload = item.payload.encode()
-            item.webhook.send(payload, sess, queued=item)
+        for hook in Webhook.objects.filter(queue__isnull=False).distinct():
+            hook.flush(force=True)
+
+
+class WebhookDeadLetter(models.Model):
+    """Call to a webhook that could not be delivered, even after retrying.
+
+    Dead letters are not retried automatically; they can be put back into
+    the queue via the admin.
+    """
+
+    webhook = models.ForeignKey(Webhook, on_delete=models.CASCADE, related_name='dead_letters')
+    payload = models.TextField(help_text='The payload to POST to the webhook')
+    subject_id = models.IntegerField(null=True, blank=True,
+                                     help_text='ID of the object the payload is about')
+
+    error_code = models.IntegerField(blank=True, default=0,
+                                     help_text='The HTTP status code received when last POSTing')
+    error_msg = models.TextField(blank=True, default='',
+                                 help_text='The HTTP response received when last POSTing')
+    attempts = models.PositiveIntegerField(default=0,
+                                           help_text='Number of failed delivery attempts')
+
+    queued = models.DateTimeField(help_text='When the call was originally queued')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Webhook Dead Letter'
+        verbose_name_plural = 'Webhook dead letters'
+
+    @classmethod
+    def replay(cls, dead_letters: models.QuerySet) -> int:
+        """Puts the dead letters back into the queue, in their original order.
+
+        A dead letter about a subject that has newer calls queued would, when
+        delivered after those calls, leave the receiver with an old state.
+        Instead it is merged into the first of those calls, for webhook types
+        that support merging (see `outbox.COALESCERS`), and dropped otherwise.
+
+        :returns: the number of replayed dead letters.
+        """
+        from . import outbox
+
+        log = logging.getLogger(f'{__name__}.WebhookDeadLetter.replay')
+
+        with transaction.atomic():
+            dead_letters = list(dead_letters.select_for_update().order_by('queued', 'id'))
+
+            # The first queued call per (webhook ID, subject ID).
+            newer_calls = {}
+            subject_ids = {dead_letter.subject_id for dead_letter in dead_letters} - {None}
+            if subject_ids:
+                queued = WebhookQueuedCall.objects \
+                    .select_for_update() \
+                    .select_related('webhook') \
+                    .filter(webhook_id__in={dead_letter.webhook_id for dead_letter in dead_letters},
+                            subject_id__in=subject_ids) \
+                    .order_by('created', 'id')
+                for call in queued:
+                    newer_calls.setdefault((call.webhook_id, call.subject_id), call)
+
+            to_queue = []
+            to_merge = {}
+            for dead_letter in dead_letters:
+                newer_call = newer_calls.get((dead_letter.webhook_id, dead_letter.subject_id))
+                if newer_call is None:
+                    to_queue.append(WebhookQueuedCall(webhook_id=dead_letter.webhook_id,
+                                                      payload=dead_letter.payload,
+                                                      subject_id=dead_letter.subject_id))
+                    continue
+                to_merge.setdefault(newer_call, []).append(dead_letter)
+
+            for newer_call, older in to_merge.items():
+                coalescer = outbox.COALESCERS.get(newer_call.webhook.hook_type)
+                if coalescer is None:
+                    log.info('dropping %d dead letters to %s about %d, newer calls are queued',
+                             len(older), newer_call.webhook, newer_call.subject_id)
+                    continue
+                merged = coalescer([json.loads(dead_letter.payload) for dead_letter in older],
+                                   json.loads(newer_call.payload))
+                newer_call.payload = json.dumps(merged)
+                newer_call.save(update_fields={'payload', 'updated'})
+
+            WebhookQueuedCall.objects.bulk_create(to_queue)
+            cls.objects.filter(id__in=[dead_letter.id for dead_letter in dead_letters]).delete()
+        return len(dead_letters)
@@ -0,0 +1,186 @@
+"""Transactional outbox for webhook calls.
+
+Webhook calls are never made while saving the change that triggers them.
+Instead, the payload is written to the WebhookQueuedCall table, in the same
+database transaction as the change itself. This means that a rolled-back
+change is never announced, and that slow webhook consumers cannot slow down
+the saving of users.
+
+After the transaction commits, the queued calls are delivered by a
+background thread (when settings.WEBHOOK_FLUSH_ON_COMMIT is True) and/or by
+the `flush_webhooks` management command.
+"""
+
+import concurrent.futures
+import json
+import logging
+import threading
+import typing
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import models, payloads
+
+log = logging.getLogger(__name__)
+
+_executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def coalesce_user_modified(older: typing.List[dict], newer: dict) -> dict:
+    """Merges USER_MODIFIED payloads of the same user into one.
+
+    The newest payload describes the current state of the user, but the
+    receiver should still be able to find the user by the email address it
+    knew, and still learn about the events in between. Boolean flags, such as
+    `avatar_changed` and `deletion_requested`, are true when they are true in
+    any of the payloads.
+
+    Payloads that only contain changes (version 2) are merged into one
+    with all changed fields and their latest values.
+    """
+    all_payloads = older + [newer]
+    if newer.get('version') == payloads.PAYLOAD_DELTA:
+        merged = {}
+        changed_fields = set()
+        for payload in all_payloads:
+            merged.update(payload)
+            changed_fields.update(payload.get('changed_fields', ()))
+        merged['changed_fields'] = sorted(changed_fields)
+    else:
+        merged = dict(newer)
+        flags = {key for payload in all_payloads
+                 for key, value in payload.items() if isinstance(value, bool)}
+        for flag in flags:
+            merged[flag] = any(payload.get(flag, False) for payload in all_payloads)
+    if older:
+        merged['old_email'] = older[0].get('old_email', newer.get('old_email'))
+    return merged
+
+
+# Mapping from hook type to the function that merges its payloads.
+COALESCERS = {
+    'USER_MODIFIED': coalesce_user_modified,
+}
+
+
+@transaction.atomic(savepoint=False)
+def enqueue(hooks: typing.Iterable[models.Webhook], payload: bytes,
+            *, subject_id: int = None) -> typing.List[models.WebhookQueuedCall]:
+    """Queues the payload for delivery to the given webhooks.
+
+    Call this inside the transaction that makes the change; the calls are
+    only delivered after it has been committed.
+
+    :param subject_id: the ID of the object the payload is about (the user
+        for USER_MODIFIED). For webhooks that coalesce events, undelivered
+        calls about the same subject are replaced by a single merged call.
+    """
+    decoded = payload.decode()
+    to_queue = []
+    for hook in hooks:
+        if subject_id is not None and hook.coalesce_events and hook.hook_type in COALESCERS:
+            to_queue.append(_coalesce(hook, subject_id, decoded))
+        else:
+            to_queue.append(models.WebhookQueuedCall(webhook=hook, payload=decoded,
+                                                     subject_id=subject_id))
+
+    return _queue(to_queue)
+
+
+@transaction.atomic(savepoint=False)
+def enqueue_many(hook: models.Webhook, payloads: typing.Iterable[typing.Tuple[int, bytes]],
+                 *, coalesce=False) -> typing.List[models.WebhookQueuedCall]:
+    """Queues multiple payloads for delivery to one webhook, in the given order.
+
+    This is meant for sending many payloads at once, such as a backfill, so
+    by default the payloads are not coalesced with queued calls.
+
+    :param payloads: (subject ID, encoded payload) tuples.
+    :param coalesce: coalesce with queued calls about the same subjects, when
+        the webhook coalesces events. This costs queries per payload.
+    """
+    coalesce = coalesce and hook.coalesce_events and hook.hook_type in COALESCERS
+    to_queue = []
+    for subject_id, payload in payloads:
+        decoded = payload.decode()
+        if coalesce:
+            to_queue.append(_coalesce(hook, subject_id, decoded))
+        else:
+            to_queue.append(models.WebhookQueuedCall(webhook=hook, payload=decoded,
+                                                     subject_id=subject_id))
+    return _queue(to_queue)
+
+
+def _queue(to_queue: typing.List[models.WebhookQueuedCall]) \
+        -> typing.List[models.WebhookQueuedCall]:
+    queued = models.WebhookQueuedCall.objects.bulk_create(to_queue)
+    if queued and getattr(settings, 'WEBHOOK_FLUSH_ON_COMMIT', False):
+        hook_ids = {call.webhook_id for call in queued}
+        transaction.on_commit(lambda: flush_in_background(hook_ids))
+    return queued
+
+
+def _coalesce(hook: models.Webhook, subject_id: int, payload: str) -> models.WebhookQueuedCall:
+    """Removes undelivered calls about the subject, returning the merged call.
+
+    The merged call is queued at the end, so it keeps its position relative
+    to calls about other subjects. It takes over the delivery attempts of
+    the calls it replaces, so that coalescing does not reset their backoff.
+
+    The queued calls are locked, so that concurrent enqueues about the same
+    subject cannot both merge and remove them.
+    """
+    older_calls = list(hook.queue
+                       .select_for_update()
+                       .filter(subject_id=subject_id)
+                       .order_by('created', 'id'))
+    call = models.WebhookQueuedCall(webhook=hook, payload=payload, subject_id=subject_id)
+    if not older_calls:
+        return call
+
+    log.debug('coalescing %d queued calls to %s about %d',
+              len(older_calls), hook, subject_id)
+    older = [json.loads(older_call.payload) for older_call in older_calls]
+    call.payload = json.dumps(COALESCERS[hook.hook_type](older, json.loads(payload)))
+
+    # The most-attempted call is the one that failed last.
+    attempted = max(older_calls, key=lambda older_call: older_call.attempts)
+    call.attempts = attempted.attempts
+    call.error_code = attempted.error_code
+    call.error_msg = attempted.error_msg
+    call.next_attempt_at = max(older_call.next_attempt_at for older_call in older_calls)
+
+    models.WebhookQueuedCall.objects \
+        .filter(id__in=[older_call.id for older_call in older_calls]) \
+        .delete()
+    return call
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            # A single thread, so that calls to the same webhook are sent in order.
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='webhook-outbox')
+        return _executor
+
+
+def flush_in_background(hook_ids: typing.Iterable[int]) -> concurrent.futures.Future:
+    """Delivers the queued calls of the given webhooks in a background thread."""
+    return _get_executor().submit(_flush, frozenset(hook_ids))
+
+
+def _flush(hook_ids: typing.FrozenSet[int]):
+    try:
+        for hook in models.Webhook.objects.filter(id__in=hook_ids, enabled=True):
+            hook.flush()
+    except Exception:
+        log.exception('error flushing webhooks %s', sorted(hook_ids))
+    finally:
+        # Every thread gets its own database connection, which won't be
+        # closed by the request/response cycle.
+        connection.close()
@@ -0,0 +1,73 @@
+"""Payloads of USER_MODIFIED webhook calls.
+
+Webhooks choose the version of the payload they receive:
+
+1. The full state of the user, plus the email address it had before the
+   change and whether the avatar changed.
+2. Only what changed. `changed_fields` lists the names of the changed fields,
+   and the payload only contains the new values of those. The avatar itself
+   is never included; when it changed, fetch it from the avatar API. The
+   user's ID and old email address are always included, for matching.
+
+When deletion of the user was requested, version 1 payloads contain
+`"deletion_requested": true`, and version 2 payloads list it as changed field.
+Both are kept when later changes are coalesced into the same call.
+"""
+
+import typing
+
+PAYLOAD_FULL = 1
+PAYLOAD_DELTA = 2
+
+# Mapping from tracked User field (see User.TRACKED_FIELDS) to its name in payloads.
+FIELD_NAMES = {
+    'email': 'email',
+    'full_name': 'full_name',
+    'public_roles_as_string': 'roles',
+    'avatar': 'avatar',
+    'deletion_requested': 'deletion_requested',
+}
+
+
+def user_modified(version: int, *,
+                  user_id: int,
+                  old_email: str,
+                  email: str,
+                  full_name: str,
+                  roles: typing.List[str],
+                  changed_fields: typing.Iterable[str]) -> dict:
+    """Returns the USER_MODIFIED payload of the given version.
+
+    :param changed_fields: names of the User fields that changed.
+    """
+    changed_fields = set(changed_fields)
+    if version == PAYLOAD_FULL:
+        payload = {
+            'id': user_id,
+            'old_email': old_email,
+            'full_name': full_name,
+            'email': email,
+            'roles': roles,
+            'avatar_changed': 'avatar' in changed_fields,
+        }
+        if 'deletion_requested' in changed_fields:
+            payload['deletion_requested'] = True
+        return payload
+    if version != PAYLOAD_DELTA:
+        raise ValueError(f'unknown payload version {version!r}')
+
+    values = {
+        'email': email,
+        'full_name': full_name,
+        'roles': roles,
+        'deletion_requested': True,
+    }
+    changed = sorted(FIELD_NAMES[field] for field in changed_fields)
+    payload = {
+        'version': PAYLOAD_DELTA,
+        'id': user_id,
+        'old_email': old_email,
+        'changed_fields': changed,
+    }
+    payload.update((name, values[name]) for name in changed if name in values)
+    return payload
@@ -0,0 +1,271 @@
+"""Reconciles the roles of users with a desired state.
+
+The desired state lists, per user, which of a set of managed roles the user
+should have. Users are processed in chunks; for every chunk the users are
+found with one query and their memberships of the managed roles with
+another, and the difference is applied with bulk inserts and deletes on the
+User.roles through-table (see `roles.apply_changes()`). Every changed user
+gets a single webhook call.
+
+Chunks are independent, and each is reconciled in its own transaction, so
+multiple chunks can be reconciled in parallel.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import pathlib
+import typing
+
+from django.contrib.admin.models import LogEntry, ADDITION, DELETION
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from bid_main import badger
+from . import roles as role_changes
+
+log = logging.getLogger(__name__)
+UserModel = get_user_model()
+
+# (email address or user ID, names of the roles the user should have)
+Entry = typing.Tuple[str, typing.FrozenSet[str]]
+
+FORMATS = ('json', 'ndjson')
+
+
+def read_desired_state(path: pathlib.Path, file_format: str = '') -> typing.Iterator[Entry]:
+    """Yields the entries of a desired-state file.
+
+    Two formats are supported:
+
+    - JSON: an object mapping email address or user ID to a list of role
+      names. This is read into memory entirely.
+    - NDJSON: one `{"user": "email address or user ID", "roles": [...]}`
+      object per line. This is streamed, so it can be arbitrarily large.
+
+    :param file_format: 'json' or 'ndjson'; when empty, it is determined by
+        the file extension, '.ndjson' and '.jsonl' meaning NDJSON.
+    """
+    if not file_format:
+        file_format = 'ndjson' if path.suffix in {'.ndjson', '.jsonl'} else 'json'
+    if file_format not in FORMATS:
+        raise ValueError(f'unknown format {file_format!r}')
+
+    with path.open() as infile:
+        if file_format == 'json':
+            doc = json.load(infile)
+            if not isinstance(doc, dict):
+                raise ValueError(f'{path} should contain a JSON object')
+            for email_or_uid, role_names in doc.items():
+                yield _entry(email_or_uid, role_names, path)
+            return
+
+        for line_nr, line in enumerate(infile, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                doc = json.loads(line)
+                email_or_uid, role_names = doc['user'], doc['roles']
+            except (ValueError, TypeError, KeyError) as ex:
+                raise ValueError(f'{path}:{line_nr}: invalid line: {ex}')
+            yield _entry(email_or_uid, role_names, f'{path}:{line_nr}')
+
+
+def _entry(email_or_uid, role_names, location) -> Entry:
+    if not isinstance(role_names, list) or \
+            not all(isinstance(role_name, str) for role_name in role_names):
+        raise ValueError(f'{location}: roles of {email_or_uid} should be a list of names')
+    return str(email_or_uid), frozenset(role_names)
+
+
+def chunked(entries: typing.Iterable[Entry], chunk_size: int) \
+        -> typing.Iterator[typing.List[Entry]]:
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ChunkResult:
+    """What was (or, in a dry run, would be) changed in a chunk."""
+
+    def __init__(self, index: int, entries: int):
+        self.index = index
+        self.entries = entries
+        self.unknown_users: typing.List[str] = []
+        # Per changed user: {'user': ..., 'id': ..., 'grant': [...], 'revoke': [...]}
+        self.diffs: typing.List[dict] = []
+        self.granted: typing.Counter[str] = collections.Counter()
+        self.revoked: typing.Counter[str] = collections.Counter()
+        self.unmanaged: typing.Counter[str] = collections.Counter()
+
+
+class Reconciler:
+    """Reconciles the memberships of the managed roles.
+
+    :param actor: the user performing the changes, who must be allowed to
+        manage the roles (see bid_main.badger); used for the admin log.
+    :param role_names: the managed roles. Other roles are left alone.
+    :param dry_run: only determine what would change.
+    """
+
+    log = log.getChild('Reconciler')
+
+    def __init__(self, actor: UserModel, role_names: typing.Iterable[str], *, dry_run=False):
+        self.actor = actor
+        self.dry_run = dry_run
+
+        may_manage = badger.may_manage(actor)
+        self.roles = {}
+        for role_name in sorted(set(role_names)):
+            role = may_manage.get(role_name)
+            if role is None:
+                raise ValueError(f'{actor} is not allowed to manage role {role_name!r}')
+            if not role.is_active:
+                raise ValueError(f'role {role_name!r} is not active')
+            self.roles[role_name] = role
+        self.role_names = {role.id: role_name for role_name, role in self.roles.items()}
+
+    def reconcile(self, entries: typing.List[Entry], index: int = 0) -> ChunkResult:
+        """Reconciles a chunk of entries in a single transaction.
+
+        When a user is listed more than once, the last entry counts.
+        """
+        with transaction.atomic():
+            return self._reconcile(entries, index)
+
+    def _reconcile(self, entries: typing.List[Entry], index: int) -> ChunkResult:
+        result = ChunkResult(index, len(entries))
+        desired_names = dict(entries)
+        users = role_changes.find_users(desired_names.keys(), lock=not self.dry_run)
+
+        desired: typing.Dict[int, typing.Set[int]] = {}
+        keys: typing.Dict[int, str] = {}
+        for email_or_uid, role_names in desired_names.items():
+            user = users.get(email_or_uid)
+            if user is None:
+                result.unknown_users.append(email_or_uid)
+                continue
+            for role_name in role_names - self.roles.keys():
+                result.unmanaged[role_name] += 1
+            desired[user.id] = {self.roles[role_name].id for role_name in role_names
+                                if role_name in self.roles}
+            keys[user.id] = email_or_uid
+
+        current = role_changes.memberships(desired.keys(), self.role_names.keys())
+        wanted = {(user_id, role_id)
+                  for user_id, role_ids in desired.items() for role_id in role_ids}
+        to_add = wanted - current
+        to_remove = current - wanted
+        if not to_add and not to_remove:
+            return result
+
+        grants = collections.defaultdict(list)
+        revokes = collections.defaultdict(list)
+        for user_id, role_id in sorted(to_add):
+            grants[user_id].append(self.role_names[role_id])
+        for user_id, role_id in sorted(to_remove):
+            revokes[user_id].append(self.role_names[role_id])
+        for role_names in itertools.chain(grants.values(), revokes.values()):
+            role_names.sort()
+
+        users_by_id = {user.id: user for user in users.values()}
+        log_entries = []
+        for user_id in sorted(grants.keys() | revokes.keys()):
+            user = users_by_id[user_id]
+            result.diffs.append({
+                'user': keys[user_id],
+                'id': user_id,
+                'grant': grants[user_id],
+                'revoke': revokes[user_id],
+            })
+            result.granted.update(grants[user_id])
+            result.revoked.update(revokes[user_id])
+            if self.dry_run:
+                continue
+            log_entries.extend(role_changes.log_entry(self.actor, user, ADDITION,
+                                                      f'Granted role {role_name}.')
+                               for role_name in grants[user_id])
+            log_entries.extend(role_changes.log_entry(self.actor, user, DELETION,
+                                                      f'Revoked role {role_name}.')
+                               for role_name in revokes[user_id])
+
+        if self.dry_run:
+            return result
+
+        self.log.debug('chunk %d: granting %d and revoking %d roles of %d users',
+                       index, len(to_add), len(to_remove), len(result.diffs))
+        role_changes.apply_changes(to_add, to_remove, users_by_id.values())
+        LogEntry.objects.bulk_create(log_entries)
+        return result
+
+    def reconcile_all(self, chunks: typing.Iterable[typing.List[Entry]], *,
+                      workers: int = 1, first_index: int = 0) -> typing.Iterator[ChunkResult]:
+        """Reconciles the chunks, yielding their results as they finish.
+
+        With multiple workers, chunks are reconciled in parallel threads, and
+        the results are not necessarily yielded in order. Chunks are read
+        from the iterable only as workers become available, so that large
+        desired states don't have to fit in memory.
+
+        :param first_index: the index of the first chunk, for resuming.
+        """
+        indexed = enumerate(chunks, start=first_index)
+        if workers <= 1:
+            for index, chunk in indexed:
+                yield self.reconcile(chunk, index)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='reconcile') as executor:
+            running = set()
+            for index, chunk in indexed:
+                running.add(executor.submit(self._reconcile_in_thread, chunk, index))
+                if len(running) < workers * 2:
+                    continue
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            for future in concurrent.futures.as_completed(running):
+                yield future.result()
+
+    def _reconcile_in_thread(self, entries: typing.List[Entry], index: int) -> ChunkResult:
+        try:
+            return self.reconcile(entries, index)
+        finally:
+            # Every thread has its own database connection, which would otherwise stay open.
+            connection.close()
+
+    def unlisted(self, listed: typing.Set[str], *, after_user_id: int = 0, page_size: int = 1000) \
+            -> typing.Iterator[typing.Tuple[int, typing.List[Entry]]]:
+        """Yields the users that have managed roles but are not listed.
+
+        Yields (last user ID of the page, entries) tuples, where every entry
+        says that the user should have none of the managed roles. Users are
+        in order of ID, so the ID can be used to resume.
+
+        :param listed: the `roles.lookup_key()` of the email addresses and
+            user IDs that are listed in the desired state.
+        """
+        through = UserModel.roles.through
+        while True:
+            user_ids = list(through.objects
+                            .filter(role_id__in=self.role_names.keys(), user_id__gt=after_user_id)
+                            .order_by('user_id')
+                            .values_list('user_id', flat=True)
+                            .distinct()[:page_size])
+            if not user_ids:
+                return
+            emails = UserModel.objects.filter(id__in=user_ids).values_list('id', 'email')
+            entries = [(str(user_id), frozenset()) for user_id, email in sorted(emails)
+                       if str(user_id) not in listed and email.lower() not in listed]
+            after_user_id = user_ids[-1]
+            yield after_user_id, entries
@@ -0,0 +1,141 @@
+"""Bulk changes to the roles of users.
+
+Used by the bulk badger API and the reconcile_users management command.
+Role memberships are inserted into and deleted from the User.roles
+through-table directly, instead of per user through `user.roles.add()`.
+As that sends no m2m_changed signals, `apply_changes()` takes care of what
+those signals would do: updating public_roles_as_string, calling the
+webhooks, and invalidating the badger permission cache.
+"""
+
+import typing
+
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import timezone
+
+from bid_main import badger
+from . import signals
+
+UserModel = get_user_model()
+Membership = typing.Tuple[int, int]  # (user ID, role ID)
+
+
+def lookup_key(email_or_uid: str) -> str:
+    """Returns the key under which find_users() finds the user.
+
+    Email addresses are matched whatever their case, and user IDs whatever
+    their leading zeros.
+    """
+    try:
+        return str(int(email_or_uid, 10))
+    except ValueError:
+        return email_or_uid.lower()
+
+
+def find_users(emails_or_uids: typing.Iterable[str], *, lock=True) \
+        -> typing.Dict[str, UserModel]:
+    """Returns the users by email address or user ID (as string), in a single query.
+
+    Unknown users are not included.
+
+    :param lock: lock the users until the end of the transaction, so that
+        concurrent changes to their roles cannot get lost.
+    """
+    emails_or_uids = set(emails_or_uids)
+    if not emails_or_uids:
+        return {}
+    user_ids = set()
+    emails = set()
+    for email_or_uid in emails_or_uids:
+        key = lookup_key(email_or_uid)
+        if key.isdigit():
+            user_ids.add(int(key))
+        else:
+            # Depending on the database collation, the email address may
+            # only match as given or only in lower case.
+            emails.update((email_or_uid, key))
+
+    users = UserModel.objects.filter(Q(id__in=user_ids) | Q(email__in=emails))
+    if lock:
+        users = users.select_for_update()
+    found = {}
+    for user in users:
+        found[str(user.id)] = user
+        found[user.email.lower()] = user
+    result = {}
+    for email_or_uid in emails_or_uids:
+        user = found.get(lookup_key(email_or_uid))
+        if user is not None:
+            result[email_or_uid] = user
+    return result
+
+
+def memberships(user_ids: typing.Iterable[int], role_ids: typing.Iterable[int]) \
+        -> typing.Set[Membership]:
+    """Returns which of the users have which of the roles, in a single query."""
+    return set(UserModel.roles.through.objects
+               .filter(user_id__in=user_ids, role_id__in=role_ids)
+               .values_list('user_id', 'role_id'))
+
+
+def apply_changes(to_add: typing.Set[Membership], to_remove: typing.Set[Membership],
+                  users: typing.Iterable[UserModel]) -> typing.List[UserModel]:
+    """Writes the role changes, and updates the users whose roles changed.
+
+    Every changed user is updated once, and gets at most one webhook call.
+    Call this in a transaction, with the users locked.
+
+    :param users: the users involved; may include users without changes.
+    :return: the changed users, with their new public_roles_as_string.
+    """
+    if not to_add and not to_remove:
+        return []
+    through = UserModel.roles.through
+
+    through.objects.bulk_create([through(user_id=user_id, role_id=role_id)
+                                 for user_id, role_id in sorted(to_add)],
+                                ignore_conflicts=True)
+    remove_per_role: typing.Dict[int, typing.Set[int]] = {}
+    for user_id, role_id in to_remove:
+        remove_per_role.setdefault(role_id, set()).add(user_id)
+    for role_id, user_ids in remove_per_role.items():
+        through.objects.filter(role_id=role_id, user_id__in=user_ids).delete()
+
+    changed_ids = {user_id for user_id, _ in to_add | to_remove}
+    changed_users = {user.id: user
+                     for user in sorted(users, key=lambda u: u.id)
+                     if user.id in changed_ids}
+    public_roles: typing.Dict[int, typing.Set[str]] = {user_id: set() for user_id in changed_users}
+    for user_id, role_name in through.objects \
+            .filter(user_id__in=changed_users, role__is_public=True, role__is_active=True) \
+            .values_list('user_id', 'role__name'):
+        public_roles[user_id].add(role_name)
+
+    now = timezone.now()
+    webhook_changes = []
+    for user_id, user in changed_users.items():
+        old_roles = set(user.public_roles_as_string.split())
+        user.public_roles_as_string = ' '.join(sorted(public_roles[user_id]))
+        user.last_update = now
+        if public_roles[user_id] != old_roles:
+            webhook_changes.append((user, old_roles))
+    UserModel.objects.bulk_update(changed_users.values(),
+                                  ['public_roles_as_string', 'last_update'])
+    badger.roles_changed(changed_users.keys(), {role_id for _, role_id in to_add | to_remove})
+    signals.roles_changed_to_webhooks(webhook_changes)
+    return list(changed_users.values())
+
+
+def log_entry(actor: UserModel, user: UserModel, action_flag: int, change_message: str) \
+        -> LogEntry:
+    """Returns an unsaved admin log entry about the user, for use with bulk_create()."""
+    return LogEntry(
+        user_id=actor.id,
+        content_type_id=ContentType.objects.get_for_model(UserModel).pk,
+        object_id=str(user.id),
+        object_repr=str(user)[:200],
+        action_flag=action_flag,
+        change_message=change_message)
@@ -0,0 +1,209 @@
+"""Process-wide HTTP sessions for webhook delivery.
+
+A new Requests session for every flush means a new TCP connection, and for
+HTTPS a new TLS handshake, for every delivery. Instead, this module keeps one
+session per host for the lifetime of the process, so that connections are
+kept alive between flushes and shared by all webhooks on the same host.
+
+- Every host gets a bounded connection pool; when all its connections are in
+  use, senders wait for one to become available.
+- Sessions that have not been used for settings.WEBHOOK_HTTP_IDLE_TIMEOUT
+  seconds are closed, as servers close idle connections anyway.
+- After a fork (for example by uWSGI) the child process starts with fresh
+  sessions, as sockets cannot be shared between processes.
+
+The time spent connecting (including the TLS handshake) is measured per host;
+see `handshake_stats()`.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+import typing
+import urllib.parse
+
+from django.conf import settings
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+
+log = logging.getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats_pid = os.getpid()
+_handshakes: typing.Dict[str, typing.Dict[str, float]] = {}
+
+
+def origin(url: str) -> str:
+    """Returns scheme://host:port of the URL, which is what connections are shared by."""
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or {'http': 80, 'https': 443}.get(parts.scheme)
+    return f'{parts.scheme}://{parts.hostname}:{port}'
+
+
+def _reset_stats_after_fork():
+    """Makes sure that a forked process only counts its own connections."""
+    global _stats_lock, _stats_pid
+
+    if _stats_pid != os.getpid():
+        _stats_lock = threading.Lock()
+        _stats_pid = os.getpid()
+        _handshakes.clear()
+
+
+def _record_handshake(scheme: str, host: str, port: int, duration: float):
+    key = f'{scheme}://{host}:{port}'
+    log.debug('connecting to %s took %.1f ms', key, duration * 1000)
+    _reset_stats_after_fork()
+    with _stats_lock:
+        stats = _handshakes.setdefault(key, {'count': 0, 'seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += duration
+
+
+def handshake_stats() -> typing.Dict[str, typing.Dict[str, float]]:
+    """Returns the number of connections made per origin, and the seconds spent making them."""
+    _reset_stats_after_fork()
+    with _stats_lock:
+        return {key: dict(stats) for key, stats in _handshakes.items()}
+
+
+def reset_handshake_stats():
+    with _stats_lock:
+        _handshakes.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_stats_after_fork)
+
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        _record_handshake('http', self.host, self.port, time.monotonic() - start)
+
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        _record_handshake('https', self.host, self.port, time.monotonic() - start)
+
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that measures how long it takes to set up connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+def new_session(*, max_retries: int, pool_size: int = 10, pool_block=False) -> requests.Session:
+    """Creates a Requests session that measures the time spent connecting."""
+    sess = requests.Session()
+    for prefix in ('https://', 'http://'):
+        adapter = TimedHTTPAdapter(max_retries=max_retries,
+                                   pool_connections=1,
+                                   pool_maxsize=pool_size,
+                                   pool_block=pool_block)
+        sess.mount(prefix, adapter)
+    return sess
+
+
+class _HostSession:
+    def __init__(self, session: requests.Session):
+        self.session = session
+        self.last_used = time.monotonic()
+        self.users = 0
+
+
+class SessionRegistry:
+    """Keeps a long-lived Requests session per host."""
+
+    log = log.getChild('SessionRegistry')
+
+    def __init__(self, *, max_retries: int):
+        self.max_retries = max_retries
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Forgets all sessions without closing them; their sockets belong to the parent."""
+        self._lock = threading.Lock()
+        self._sessions: typing.Dict[str, _HostSession] = {}
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # Python 3.6 has no os.register_at_fork().
+        if self._pid != os.getpid():
+            self._reset()
+
+    @contextlib.contextmanager
+    def session(self, url: str) -> typing.Iterator[requests.Session]:
+        """Returns the session to use for sending to this URL.
+
+        The session is never closed while being used; use it only within
+        the context.
+        """
+        self._check_fork()
+        key = origin(url)
+        with self._lock:
+            host_session = self._sessions.get(key)
+            if host_session is None:
+                self.log.debug('creating session for %s', key)
+                sess = new_session(max_retries=self.max_retries,
+                                   pool_size=settings.WEBHOOK_HTTP_POOL_SIZE,
+                                   pool_block=True)
+                host_session = self._sessions[key] = _HostSession(sess)
+            host_session.users += 1
+
+        try:
+            yield host_session.session
+        finally:
+            with self._lock:
+                host_session.users -= 1
+                host_session.last_used = time.monotonic()
+            self.prune()
+
+    def prune(self):
+        """Closes sessions that have not been used for WEBHOOK_HTTP_IDLE_TIMEOUT seconds."""
+        self._check_fork()
+        idle_since = time.monotonic() - settings.WEBHOOK_HTTP_IDLE_TIMEOUT
+        with self._lock:
+            idle = [key for key, host_session in self._sessions.items()
+                    if not host_session.users and host_session.last_used < idle_since]
+            to_close = [self._sessions.pop(key) for key in idle]
+        for key, host_session in zip(idle, to_close):
+            self.log.debug('closing idle session for %s', key)
+            host_session.session.close()
+
+    def close(self):
+        """Closes all sessions that are not in use."""
+        self._check_fork()
+        with self._lock:
+            keys = [key for key, host_session in self._sessions.items() if not host_session.users]
+            to_close = [self._sessions.pop(key) for key in keys]
+        for host_session in to_close:
+            host_session.session.close()
+
+    def hosts(self) -> typing.List[str]:
+        """Returns the origins for which there is a session."""
+        self._check_fork()
+        with self._lock:
+            return sorted(self._sessions)
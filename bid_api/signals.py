@@ -1,20 +1,22 @@
-import copy
+import collections
 import functools
 import json
 import logging
+import typing
 
 from django.contrib.auth import get_user_model
 from django.core.files.storage import default_storage
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver, Signal
 
-from . import models
+from bid_main.signals import user_deletion_requested
+from . import models, outbox, payloads
 
 log = logging.getLogger(__name__)
 UserModel = get_user_model()
 user_email_changed = Signal(providing_args=['user', 'old_email'])
 
-USER_SAVE_INTERESTING_FIELDS = {'email', 'full_name', 'public_roles_as_string', 'avatar'}
+USER_SAVE_INTERESTING_FIELDS = set(UserModel.TRACKED_FIELDS)
 WEBHOOK_TIMEOUT_SECS = 5
 
 
@@ -39,24 +41,6 @@ def filter_user_save_hook(wrapped):
     return wrapper
 
 
-def _check_user_modification(new_user: UserModel, old_user: UserModel) -> bool:
-    """Returns True iff the user was modified.
-
-    Only checks fields listed in USER_SAVE_INTERESTING_FIELDS.
-    """
-
-    for field in USER_SAVE_INTERESTING_FIELDS:
-        old_val = getattr(old_user, field)
-        new_val = getattr(new_user, field)
-        if old_val != new_val:
-            # log.debug('user %s changed field %r from %r to %r',
-            #           new_user.email, field, old_val, new_val)
-            return True
-        # log.debug('user %s has unmutated field %r = %r = %r',
-        #           new_user.email, field, old_val, new_val)
-    return False
-
-
 @receiver(pre_save)
 @filter_user_save_hook
 def inspect_modified_user(sender, user: UserModel, **kwargs):
@@ -70,16 +54,40 @@ def inspect_modified_user(sender, user: UserModel, **kwargs):
         # New user; don't notify the webhooks.
         # log.debug('%s is a new user (no ID yet), skipping', user.email)
         return
-    try:
-        db_user = UserModel.objects.get(id=user.id)
-    except UserModel.DoesNotExist:
-        # New user; don't notify the webhooks.
-        # log.debug('%s is a new user (not in DB), skipping', user.email)
-        return
+
+    old_values = user.loaded_values() or {}
+    missing = USER_SAVE_INTERESTING_FIELDS - old_values.keys()
+    if missing:
+        # This instance wasn't (entirely) loaded from the database, so we have
+        # to ask the database what the user looks like.
+        db_user = UserModel.objects.only(*missing).filter(id=user.id).first()
+        if db_user is None:
+            # New user; don't notify the webhooks.
+            # log.debug('%s is a new user (not in DB), skipping', user.email)
+            return
+        old_values = {**db_user.loaded_values(), **old_values}
 
     # Make sure that the post-save hook knows what the pre-save user looks like.
-    user.webhook_pre_save = copy.deepcopy(db_user.__dict__)
-    user.webhook_user_modified = _check_user_modification(user, db_user)
+    user.webhook_pre_save = dict(old_values)
+    current_values = user.tracked_values(old_values.keys())
+    user.webhook_changed_fields = {name for name, value in current_values.items()
+                                   if old_values[name] != value}
+    user.webhook_user_modified = bool(user.webhook_changed_fields)
+
+
+def user_events(changed_fields: typing.Set[str],
+                old_roles: typing.Set[str], new_roles: typing.Set[str]) -> typing.Set[str]:
+    """Returns the webhook events of a change to a user."""
+    events = set()
+    if 'email' in changed_fields:
+        events.add(models.EVENT_EMAIL_CHANGED)
+    if new_roles - old_roles:
+        events.add(models.EVENT_ROLE_GRANTED)
+    if old_roles - new_roles:
+        events.add(models.EVENT_ROLE_REVOKED)
+    if changed_fields - {'email', 'public_roles_as_string'}:
+        events.add(models.EVENT_USER_MODIFIED)
+    return events
 
 
 @receiver(post_save)
@@ -87,8 +95,9 @@ def inspect_modified_user(sender, user: UserModel, **kwargs):
 def modified_user_to_webhooks(sender, user: UserModel, **kwargs):
     """Forwards modified user information to webhooks.
 
-    The payload is POSTed, and a HMAC-SHA256 checksum is sent using the
-    X-Webhook-HMAC HTTP header.
+    The payload is queued in the webhook outbox, in the same transaction as
+    the user modification, and POSTed after commit. A HMAC-SHA256 checksum
+    is sent using the X-Webhook-HMAC HTTP header.
 
     Also see https://docs.djangoproject.com/en/1.11/ref/signals/#post-save
     """
@@ -100,9 +109,6 @@ def modified_user_to_webhooks(sender, user: UserModel, **kwargs):
         # log.debug('Skipping save of %s', user.email)
         return
 
-    hooks = models.Webhook.objects.filter(enabled=True)
-    log.debug('Sending modification of %s to %d webhooks', user.email, len(hooks))
-
     # Get the old email address so that the webhook receiver can match by
     # either database ID or email address.
     webhook_pre_save = getattr(user, 'webhook_pre_save', {})
@@ -111,7 +117,7 @@ def modified_user_to_webhooks(sender, user: UserModel, **kwargs):
     # Map all falsey values to empty string for more consistent comparison later.
     # An empty avatar can be either '' or None.
     old_avatar = webhook_pre_save.get('avatar') or ''
-    cur_avatar = user.avatar or ''
+    cur_avatar = user.avatar.name or ''
 
     if old_avatar and old_avatar != cur_avatar:
         log.debug('User changed avatar, going to delete old avatar file %r', old_avatar)
@@ -121,18 +127,87 @@ def modified_user_to_webhooks(sender, user: UserModel, **kwargs):
         log.debug('User changed email from %s to %s', old_email, user.email)
         user_email_changed.send(sender, user=user, old_email=old_email)
 
-    # Do our own JSON encoding so that we can compute the HMAC using the hook's secret.
-    payload = {
-        'id': user.id,
-        'old_email': old_email,
-        'full_name': user.get_full_name(),
-        'email': user.email,
-        'roles': sorted(user.public_roles()),
-        'avatar_changed': old_avatar != cur_avatar,
-    }
-    json_payload = json.dumps(payload).encode()
-
-    sess = models.webhook_session()
+    # Only call the webhooks that are interested in this change.
+    changed_fields = getattr(user, 'webhook_changed_fields', set())
+    old_roles = set((webhook_pre_save.get('public_roles_as_string') or '').split())
+    # Kept up to date by bid_main.signals.modified_user_role, so no need to query.
+    new_roles = set(user.public_roles_as_string.split())
+    events = user_events(changed_fields, old_roles, new_roles)
+    hooks = [hook for hook in models.Webhook.objects.filter(enabled=True)
+             if hook.wants(events, old_roles | new_roles, old_roles ^ new_roles)]
+    log.debug('Queueing modification of %s for %d webhooks', user.email, len(hooks))
+
+    _queue_user_modified(hooks, user, old_email, changed_fields)
+
+
+@receiver(user_deletion_requested)
+def deletion_requested_to_webhooks(sender, users: typing.List[UserModel], **kwargs):
+    """Tells webhooks that deletion of users was requested."""
+
+    hooks = list(models.Webhook.objects.filter(enabled=True))
+    for user in users:
+        roles = set(user.public_roles_as_string.split())
+        user_hooks = [hook for hook in hooks
+                      if hook.wants({models.EVENT_DELETION_REQUESTED}, roles, set())]
+        log.debug('Queueing deletion request of %s for %d webhooks', user.email, len(user_hooks))
+        _queue_user_modified(user_hooks, user, user.email, {'deletion_requested'})
+
+
+def roles_changed_to_webhooks(changes: typing.Iterable[typing.Tuple[UserModel, typing.Set[str]]]):
+    """Tells webhooks about users whose roles were changed without saving them.
+
+    For bulk changes, which update the database directly and so send no save
+    signals. Every user gets a single call, with all its role changes.
+
+    :param changes: (user, old public role names) tuples. The users must have
+        their new public_roles_as_string.
+    """
+
+    hooks = list(models.Webhook.objects.filter(enabled=True))
+    changed_fields = {'public_roles_as_string'}
+    # Queued with a single insert per webhook.
+    per_hook = collections.defaultdict(list)
+    for user, old_roles in changes:
+        new_roles = set(user.public_roles_as_string.split())
+        events = user_events(changed_fields, old_roles, new_roles)
+        encoded = {}
+        for hook in hooks:
+            if not hook.wants(events, old_roles | new_roles, old_roles ^ new_roles):
+                continue
+            version = hook.payload_version
+            if version not in encoded:
+                encoded[version] = _user_modified_payload(version, user, user.email,
+                                                          changed_fields)
+            per_hook[hook].append((user.id, encoded[version]))
+
+    for hook, hook_payloads in per_hook.items():
+        log.debug('Queueing role changes of %d users for %s', len(hook_payloads), hook)
+        outbox.enqueue_many(hook, hook_payloads, coalesce=True)
+
+
+def _queue_user_modified(hooks: typing.List[models.Webhook], user: UserModel,
+                         old_email: str, changed_fields: typing.Set[str]):
+    """Queues USER_MODIFIED calls, encoding the payload once per payload version."""
+
+    hooks_per_version = collections.defaultdict(list)
     for hook in hooks:
-        log.debug('Sending to %s, %s', hook, hook.url)
-        hook.send(json_payload, sess)
+        hooks_per_version[hook.payload_version].append(hook)
+
+    for version, version_hooks in sorted(hooks_per_version.items()):
+        json_payload = _user_modified_payload(version, user, old_email, changed_fields)
+        outbox.enqueue(version_hooks, json_payload, subject_id=user.id)
+
+
+def _user_modified_payload(version: int, user: UserModel, old_email: str,
+                           changed_fields: typing.Set[str]) -> bytes:
+    payload = payloads.user_modified(
+        version,
+        user_id=user.id,
+        old_email=old_email,
+        email=user.email,
+        full_name=user.get_full_name(),
+        roles=sorted(user.public_roles_as_string.split()),
+        changed_fields=changed_fields,
+    )
+    # Do our own JSON encoding so that we can compute the HMAC using the hook's secret.
+    return json.dumps(payload).encode()
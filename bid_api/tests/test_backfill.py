@@ -0,0 +1,119 @@
+import datetime
+import io
+import json
+import pathlib
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from bid_api import models
+from bid_main.models import Role
+from .abstract import UserModel
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class WebhookBackfillTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.hook = models.Webhook.objects.create(name='new-consumer', url='http://unit.test/')
+        self.subscriber = Role.objects.create(name='cloud_subscriber')
+        self.hidden = Role.objects.create(name='hidden', is_public=False)
+
+        self.users = []
+        for idx in range(5):
+            user = UserModel.objects.create_user(f'user{idx}@example.com', '123456',
+                                                 nickname=f'user{idx}',
+                                                 full_name=f' User {idx} ')
+            self.users.append(user)
+        self.users[1].roles.add(self.subscriber, self.hidden)
+        self.users[3].roles.add(self.subscriber)
+        # Forget about the calls queued for the changes above.
+        models.WebhookQueuedCall.objects.all().delete()
+
+    def backfill(self, *args) -> str:
+        out = io.StringIO()
+        call_command('webhook_backfill', *args, rate=0, stdout=out)
+        return out.getvalue()
+
+    def queued_payloads(self) -> list:
+        return [json.loads(call.payload) for call in self.hook.queue.order_by('created', 'id')]
+
+    def test_all_users(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.backfill(self.hook.name, '--page-size', '2')
+        # Roles are fetched and calls inserted per page, not per user.
+        sqls = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(3, len([sql for sql in sqls if 'bid_main_user_roles' in sql]))
+        self.assertEqual(3, len([sql for sql in sqls if sql.startswith('INSERT')]))
+
+        payloads = self.queued_payloads()
+        self.assertEqual([user.id for user in self.users], [p['id'] for p in payloads])
+        self.assertEqual({
+            'id': self.users[1].id,
+            'old_email': 'user1@example.com',
+            'full_name': 'User 1',
+            'email': 'user1@example.com',
+            'roles': ['cloud_subscriber'],
+            'avatar_changed': False,
+        }, payloads[1])
+        self.assertEqual([user.id for user in self.users],
+                         list(self.hook.queue.order_by('created', 'id')
+                              .values_list('subject_id', flat=True)))
+
+    def test_role_filter(self):
+        self.backfill(str(self.hook.id), '--role', 'cloud_subscriber', '--role', 'hidden')
+        self.assertEqual([self.users[1].id, self.users[3].id],
+                         [p['id'] for p in self.queued_payloads()])
+
+    def test_webhook_role_filter(self):
+        self.hook.role_filter = 'cloud_subscriber'
+        self.hook.save()
+
+        self.backfill(self.hook.name, '--page-size', '2')
+        self.assertEqual([self.users[1].id, self.users[3].id],
+                         [p['id'] for p in self.queued_payloads()])
+
+    def test_webhook_event_types(self):
+        self.hook.event_types = models.EVENT_DELETION_REQUESTED
+        self.hook.save()
+
+        self.backfill(self.hook.name)
+        self.assertEqual([], self.queued_payloads())
+
+    def test_since_filter(self):
+        UserModel.objects.filter(id__in=[self.users[0].id, self.users[4].id]) \
+            .update(last_update=timezone.now() - datetime.timedelta(days=30))
+        since = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+
+        self.backfill(self.hook.name, '--since', since)
+        self.assertEqual([user.id for user in self.users[1:4]],
+                         [p['id'] for p in self.queued_payloads()])
+
+    def test_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = pathlib.Path(tmpdir) / 'backfill.json'
+            checkpoint.write_text(json.dumps({
+                'hook': self.hook.id,
+                'since': None,
+                'roles': [],
+                'last_user_id': self.users[2].id,
+            }))
+
+            self.backfill(self.hook.name, '--checkpoint', str(checkpoint))
+            self.assertEqual([self.users[3].id, self.users[4].id],
+                             [p['id'] for p in self.queued_payloads()])
+            self.assertEqual(self.users[4].id, json.loads(checkpoint.read_text())['last_user_id'])
+
+            # A checkpoint of another backfill should not be used.
+            with self.assertRaises(CommandError):
+                self.backfill(self.hook.name, '--checkpoint', str(checkpoint),
+                              '--role', 'cloud_subscriber')
+
+    def test_unknown_hook(self):
+        with self.assertRaises(CommandError):
+            self.backfill('nonexistent')
@@ -1,13 +1,33 @@
 from datetime import timedelta
+import json
 
+from django.core.cache import cache
+from django.db import connection
 from django.http import HttpResponse
 from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
+from bid_api import models
+from bid_main import badger
 from bid_main.models import Role
 from .abstract import AbstractAPITest, AccessToken, UserModel
 
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'bid_main.cache.TwoTierCache',
+        'LOCATION': 'l2',
+        'KEY_PREFIX': 'badger-test',
+    },
+    'l2': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'badger-test-l2',
+    },
+}
+
 
 class BadgerBaseTest(AbstractAPITest):
     access_token_scope = 'badger'
@@ -31,6 +51,18 @@ class BadgerBaseTest(AbstractAPITest):
                                               cls.role_inactivebadge])
         cls.role_badger.save()
 
+    def setUp(self):
+        super().setUp()
+        # Cached permissions are only invalidated on commit, which never
+        # happens in these tests.
+        cache.clear()
+
+    def commit(self):
+        """Runs the on-commit callbacks, such as invalidating cached permissions."""
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
     def post(self, view_name: str, badge: str, email_or_uid: str, *, access_token='') -> HttpResponse:
         url_path = reverse(view_name, kwargs={'badge': badge, 'email_or_uid': email_or_uid})
         response = self.authed_post(url_path, access_token=access_token)
@@ -213,3 +245,212 @@ class BadgerApiRevokeTest(BadgerBaseTest):
     def test_unknown_target_user(self):
         response = self.post('bid_api:badger_revoke', 'badge1', 'unknown@address')
         self.assertEqual(response.status_code, 422)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BadgerApiBulkTest(BadgerBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.user.roles.set([self.role_badger])
+        self.user.save()
+
+        self.target1 = UserModel.objects.create_user('target1@user.com', '123456', nickname='t1')
+        self.target2 = UserModel.objects.create_user('target2@user.com', '123456', nickname='t2')
+        self.target2.roles.set([self.role_badge2])
+
+    def bulk(self, operations, **kwargs) -> HttpResponse:
+        return self.authed_post(reverse('bid_api:badger_bulk'),
+                                data=json.dumps({'operations': operations}),
+                                content_type='application/json',
+                                **kwargs)
+
+    def results(self, operations) -> list:
+        response = self.bulk(operations)
+        self.assertEqual(200, response.status_code, f'response: {response}')
+        return [result['result'] for result in response.json()['results']]
+
+    def test_happy_flow(self):
+        results = self.results([
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge1', 'user': self.target2.id},
+            {'action': 'revoke', 'badge': 'badge2', 'user': str(self.target2.id)},
+            {'action': 'grant', 'badge': 'badge2', 'user': 'target1@user.com'},
+        ])
+        self.assertEqual(['ok', 'ok', 'ok', 'ok'], results)
+
+        self.target1.refresh_from_db()
+        self.target2.refresh_from_db()
+        self.assertEqual({self.role_badge1, self.role_badge2}, set(self.target1.roles.all()))
+        self.assertEqual([self.role_badge1], list(self.target2.roles.all()))
+        self.assertEqual('badge1 badge2', self.target1.public_roles_as_string)
+        self.assertEqual('badge1', self.target2.public_roles_as_string)
+
+        entries = LogEntry.objects.filter(object_id=self.target1.id).order_by('id')
+        self.assertEqual(['Granted role badge1.', 'Granted role badge2.'],
+                         [entry.change_message for entry in entries])
+        self.assertEqual(2, LogEntry.objects.filter(object_id=self.target2.id).count())
+
+    def test_errors_per_operation(self):
+        response = self.bulk([
+            {'action': 'grant', 'badge': 'not-allowed-badge', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'inactive-badge', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge1', 'user': 'unknown@user.com'},
+            {'action': 'promote', 'badge': 'badge1', 'user': 'target1@user.com'},
+            'grant badge1',
+            {'action': 'revoke', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge2', 'user': 'target2@user.com'},
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+        ])
+        self.assertEqual(200, response.status_code)
+        results = response.json()['results']
+        self.assertEqual(['forbidden', 'forbidden', 'unknown-user', 'invalid', 'invalid',
+                          'no-op', 'no-op', 'ok'],
+                         [result['result'] for result in results])
+        self.assertEqual({'action': 'grant', 'badge': 'badge1', 'user': 'unknown@user.com',
+                          'result': 'unknown-user'}, results[2])
+
+        self.target1.refresh_from_db()
+        self.assertEqual([self.role_badge1], list(self.target1.roles.all()))
+        self.assertEqual(1, LogEntry.objects.filter(object_id=self.target1.id).count())
+
+    def test_mixed_case_email_and_leading_zeros(self):
+        results = self.results([
+            {'action': 'grant', 'badge': 'badge1', 'user': 'Target1@User.com'},
+            {'action': 'revoke', 'badge': 'badge2', 'user': f'0{self.target2.id}'},
+        ])
+        self.assertEqual(['ok', 'ok'], results)
+        self.assertEqual([self.role_badge1], list(self.target1.roles.all()))
+        self.assertEqual([], list(self.target2.roles.all()))
+
+    def test_operations_in_order(self):
+        results = self.results([
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'revoke', 'badge': 'badge1', 'user': 'target1@user.com'},
+        ])
+        self.assertEqual(['ok', 'no-op', 'ok'], results)
+        self.assertEqual([], list(self.target1.roles.all()))
+
+    def test_queries_independent_of_operations(self):
+        def count_queries(operations) -> int:
+            with CaptureQueriesContext(connection) as queries:
+                self.results(operations)
+            return len(queries)
+
+        # Warm up the permission and content type caches.
+        self.results([])
+        ContentType.objects.get_for_model(UserModel)
+
+        few = count_queries([
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'revoke', 'badge': 'badge2', 'user': 'target2@user.com'},
+        ])
+
+        others = [UserModel.objects.create_user(f'other{idx}@user.com', '123456',
+                                                nickname=f'other{idx}')
+                  for idx in range(10)]
+        many = count_queries(
+            [{'action': 'grant', 'badge': 'badge1', 'user': other.email} for other in others] +
+            [{'action': 'revoke', 'badge': 'badge1', 'user': 'target1@user.com'},
+             {'action': 'grant', 'badge': 'badge2', 'user': 'target2@user.com'}])
+        self.assertEqual(few, many)
+
+    def test_single_webhook_call_per_user(self):
+        hook = models.Webhook.objects.create(name='hook', url='http://www.unit.test/api/webhook')
+        self.results([
+            {'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge2', 'user': 'target1@user.com'},
+            {'action': 'grant', 'badge': 'badge2', 'user': 'target2@user.com'},
+            {'action': 'grant', 'badge': 'not-badge', 'user': 'target2@user.com'},
+        ])
+
+        payloads = [json.loads(call.payload) for call in hook.queue.order_by('id')]
+        self.assertEqual([(self.target1.id, ['badge1', 'badge2']),
+                          (self.target2.id, ['badge2', 'not-badge'])],
+                         [(payload['id'], payload['roles']) for payload in payloads])
+
+    def test_invalid_document(self):
+        response = self.authed_post(reverse('bid_api:badger_bulk'), data='[1, 2',
+                                    content_type='application/json')
+        self.assertEqual(400, response.status_code)
+
+        with self.settings(BADGER_BULK_MAX_OPERATIONS=1):
+            response = self.bulk([{}, {}])
+        self.assertEqual(400, response.status_code)
+
+    def test_wrong_token_scope(self):
+        wrong_token = AccessToken.objects.create(
+            user=self.user,
+            scope='email',
+            expires=timezone.now() + timedelta(seconds=300),
+            token='token-with-wrong-scope',
+            application=self.application
+        )
+        response = self.bulk([{'action': 'grant', 'badge': 'badge1', 'user': 'target1@user.com'}],
+                             access_token=wrong_token.token)
+        self.assertEqual(403, response.status_code)
+        self.assertEqual([], list(self.target1.roles.all()))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BadgerPermissionCacheTest(BadgerBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.user.roles.set([self.role_badger])
+        self.target_user = UserModel.objects.create_user('target@user.com', '123456',
+                                                         nickname='hey')
+
+    def may_manage(self) -> set:
+        return set(badger.may_manage(self.user))
+
+    def test_cached(self):
+        self.assertEqual({'not-badge', 'badge1', 'badge2', 'inactive-badge'}, self.may_manage())
+        with self.assertNumQueries(0):
+            self.assertEqual({'not-badge', 'badge1', 'badge2', 'inactive-badge'},
+                             self.may_manage())
+
+        # Granting roles to others keeps the cache.
+        response = self.post('bid_api:badger_grant', 'badge1', self.target_user.email)
+        self.assertEqual(200, response.status_code)
+        with self.assertNumQueries(0):
+            self.may_manage()
+
+    def test_invalidated_by_may_manage_roles(self):
+        self.may_manage()
+        self.role_badger.may_manage_roles.remove(self.role_badge1)
+        self.commit()
+        try:
+            self.assertEqual({'not-badge', 'badge2', 'inactive-badge'}, self.may_manage())
+            response = self.post('bid_api:badger_grant', 'badge1', self.target_user.email)
+            self.assertEqual(403, response.status_code)
+        finally:
+            self.role_badger.may_manage_roles.add(self.role_badge1)
+            self.commit()
+        self.assertIn('badge1', self.may_manage())
+
+    def test_invalidated_by_role_change(self):
+        self.may_manage()
+        role = Role.objects.get(id=self.role_badge1.id)
+        role.is_active = False
+        role.save()
+        self.commit()
+        response = self.post('bid_api:badger_grant', 'badge1', self.target_user.email)
+        self.assertEqual(403, response.status_code)
+
+    def test_invalidated_by_caller_roles(self):
+        self.may_manage()
+        self.user.roles.remove(self.role_badger)
+        self.commit()
+        self.assertEqual(set(), self.may_manage())
+
+        # Granting a badger role makes a user a caller.
+        self.role_badger.users.add(self.user)
+        self.commit()
+        self.assertIn('badge1', self.may_manage())
+
+    def test_other_users_cost_nothing(self):
+        self.commit()
+        self.may_manage()
+        with self.assertNumQueries(0):
+            badger.roles_changed([self.target_user.id], [self.role_badge1.id])
+        self.assertEqual([], connection.run_on_commit, 'nothing should be invalidated')
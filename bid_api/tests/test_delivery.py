@@ -0,0 +1,250 @@
+import datetime
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+import typing
+
+import responses
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from bid_api import delivery, models, outbox
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class DeliveryDaemonTest(TransactionTestCase):
+    FAST_URL = 'http://fast.unit.test/api/webhook'
+    SLOW_URL = 'http://slow.unit.test/api/webhook'
+
+    def setUp(self):
+        super().setUp()
+        self.fast = models.Webhook.objects.create(name='fast', url=self.FAST_URL)
+        self.slow = models.Webhook.objects.create(name='slow', url=self.SLOW_URL)
+        self.daemon = delivery.DeliveryDaemon(concurrency=2, poll_interval=0.01,
+                                              shutdown_timeout=10)
+        self.slow_release = threading.Event()
+
+    def tearDown(self):
+        self.slow_release.set()
+        self.daemon.shutdown()
+        super().tearDown()
+
+    def slow_callback(self, request):
+        self.slow_release.wait(10)
+        return 200, {}, '{}'
+
+    def queue(self, hook: models.Webhook, *payloads):
+        for payload in payloads:
+            outbox.enqueue([hook], json.dumps(payload).encode())
+
+    def delivered_to(self, url: str) -> list:
+        return [json.loads(call.request.body)
+                for call in responses.calls
+                if call.request.url == url]
+
+    @responses.activate
+    def test_slow_hook_does_not_block_others(self):
+        responses.add(responses.POST, self.FAST_URL, json={}, status=200)
+        responses.add_callback(responses.POST, self.SLOW_URL, callback=self.slow_callback)
+        self.queue(self.slow, 'slow')
+        self.queue(self.fast, 1, 2, 3)
+
+        started = self.daemon.tick()
+        self.assertEqual({self.fast.id, self.slow.id}, set(started))
+
+        deadline = time.monotonic() + 10
+        while self.fast.queue_size() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # The fast hook got everything in order, while the slow one is still sending.
+        self.assertEqual([1, 2, 3], self.delivered_to(self.FAST_URL))
+        self.assertEqual(1, self.slow.queue_size())
+
+        # No second lane for a webhook that already has one.
+        self.assertEqual([], self.daemon.tick())
+
+        self.slow_release.set()
+        self.assertTrue(self.daemon.wait(10))
+        self.assertEqual(['slow'], self.delivered_to(self.SLOW_URL))
+        self.assertEqual(0, models.WebhookQueuedCall.objects.count())
+
+    @responses.activate
+    def test_disabled_hooks_are_skipped(self):
+        responses.add(responses.POST, self.FAST_URL, json={}, status=200)
+        self.queue(self.fast, 'payload')
+        self.fast.enabled = False
+        self.fast.save()
+
+        self.assertEqual([], self.daemon.tick())
+        self.assertEqual(1, self.fast.queue_size())
+
+        # Enabling the hook should be picked up without restarting.
+        self.fast.enabled = True
+        self.fast.save()
+        self.assertEqual([self.fast.id], self.daemon.tick())
+        self.assertTrue(self.daemon.wait(10))
+        self.assertEqual(['payload'], self.delivered_to(self.FAST_URL))
+
+    @responses.activate
+    def test_run_until_stopped(self):
+        responses.add(responses.POST, self.FAST_URL, json={}, status=200)
+        self.queue(self.fast, 'payload')
+
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while self.fast.queue_size() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.daemon.stop()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(['payload'], self.delivered_to(self.FAST_URL))
+
+
+class WebhookLeaseTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.hook = models.Webhook.objects.create(name='hook', url='http://unit.test/hook')
+
+    def test_claim_and_release(self):
+        self.assertTrue(self.hook.claim('worker-1'))
+        self.assertFalse(models.Webhook.objects.get(id=self.hook.id).claim('worker-2'))
+
+        # Renewing your own lease is fine.
+        self.assertTrue(self.hook.claim('worker-1'))
+
+        # Releasing somebody else's lease does nothing.
+        self.hook.release('worker-2')
+        self.assertFalse(models.Webhook.objects.get(id=self.hook.id).claim('worker-2'))
+
+        self.hook.release('worker-1')
+        self.assertTrue(models.Webhook.objects.get(id=self.hook.id).claim('worker-2'))
+
+    def test_expired_lease(self):
+        self.assertTrue(self.hook.claim('worker-1'))
+        models.Webhook.objects.filter(id=self.hook.id) \
+            .update(claimed_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertTrue(models.Webhook.objects.get(id=self.hook.id).claim('worker-2'))
+
+        # The old worker should notice that it lost its lease.
+        self.assertFalse(self.hook.claim('worker-1'))
+
+    @responses.activate
+    def test_flush_skips_claimed_hook(self):
+        responses.add(responses.POST, self.hook.url, json={}, status=200)
+        outbox.enqueue([self.hook], b'"payload"')
+        self.assertTrue(models.Webhook.objects.get(id=self.hook.id).claim('other-worker'))
+
+        self.hook.flush(worker_id='this-worker')
+        self.assertEqual(0, len(responses.calls))
+        self.assertEqual(1, self.hook.queue_size())
+
+
+def _flush_worker(worker_id: str, urls: typing.List[str], results: multiprocessing.Queue):
+    """Flushes all webhooks until the queue is empty, reporting what was delivered."""
+    from django.db import connection
+
+    delivered = []
+
+    def record(request):
+        time.sleep(0.002)  # Give other workers a chance to interfere.
+        delivered.append((time.monotonic(), request.url, json.loads(request.body)))
+        return 200, {}, '{}'
+
+    try:
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as mock:
+            for url in urls:
+                mock.add_callback(responses.POST, url, callback=record)
+
+            deadline = time.monotonic() + 30
+            while models.WebhookQueuedCall.objects.exists() and time.monotonic() < deadline:
+                for hook in models.Webhook.objects.all():
+                    hook.flush(worker_id=worker_id)
+    finally:
+        connection.close()
+        results.put(delivered)
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class ConcurrentWorkersTest(TransactionTestCase):
+    """Multiple worker processes should not duplicate or reorder calls."""
+
+    URLS = ['http://hook-a.unit.test/', 'http://hook-b.unit.test/']
+    WORKERS = 4
+    CALLS_PER_HOOK = 20
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('worker processes cannot share an in-memory database')
+
+    def test_no_duplicates_no_reordering(self):
+        for url in self.URLS:
+            hook = models.Webhook.objects.create(name=url, url=url)
+            for idx in range(self.CALLS_PER_HOOK):
+                outbox.enqueue([hook], json.dumps(idx).encode())
+
+        # Forked processes must not share the database connection of this one.
+        connections.close_all()
+        mp = multiprocessing.get_context('fork')
+        results = mp.Queue()
+        procs = [mp.Process(target=_flush_worker, args=(f'worker-{idx}', self.URLS, results))
+                 for idx in range(self.WORKERS)]
+        for proc in procs:
+            proc.start()
+        delivered = sorted(itertools.chain.from_iterable(
+            results.get(timeout=60) for _ in procs))
+        for proc in procs:
+            proc.join(10)
+
+        self.assertEqual(0, models.WebhookQueuedCall.objects.count())
+        expect = list(range(self.CALLS_PER_HOOK))
+        for url in self.URLS:
+            payloads = [payload for _, call_url, payload in delivered if call_url == url]
+            self.assertEqual(expect, payloads, f'unexpected deliveries to {url}')
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class DeliverySchedulingTest(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hook = models.Webhook.objects.create(name='hook', url='http://unit.test/hook')
+        self.daemon = delivery.DeliveryDaemon(concurrency=1, poll_interval=5)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        super().tearDown()
+
+    def test_sleep_until_next_attempt(self):
+        self.assertEqual(5, self.daemon.next_wait())
+
+        outbox.enqueue([self.hook], b'"payload"')
+        models.WebhookQueuedCall.objects.update(
+            next_attempt_at=timezone.now() + datetime.timedelta(seconds=2))
+
+        self.assertEqual([], self.daemon.tick())
+        self.assertAlmostEqual(2, self.daemon.next_wait(), delta=0.5)
+
+        models.WebhookQueuedCall.objects.update(
+            next_attempt_at=timezone.now() + datetime.timedelta(minutes=2))
+        self.daemon.tick()
+        self.assertEqual(5, self.daemon.next_wait())
+
+    def test_postponed_webhook_not_due(self):
+        outbox.enqueue([self.hook], b'"payload"')
+        self.hook.postpone_queue(timezone.now() + datetime.timedelta(seconds=2))
+
+        self.assertEqual([], self.daemon.tick())
+        self.assertAlmostEqual(2, self.daemon.next_wait(), delta=0.5)
+
+    def test_single_query_per_tick(self):
+        outbox.enqueue([self.hook], b'"payload"')
+        models.WebhookQueuedCall.objects.update(
+            next_attempt_at=timezone.now() + datetime.timedelta(seconds=2))
+
+        with self.assertNumQueries(1):
+            self.daemon.tick()
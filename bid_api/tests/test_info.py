@@ -3,7 +3,9 @@ from datetime import timedelta
 import json
 
 from django.conf import settings
+from django.db import connection
 from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
@@ -475,3 +477,63 @@ class UserAvatarTest(AbstractAPITest):
         with avatar_path.open('rb') as infile:
             original_image_bytes = infile.read()
         self.assertNotEqual(resp.content, original_image_bytes)
+
+
+class BulkAvatarTest(AbstractAPITest):
+    def setUp(self):
+        super().setUp()
+
+        my_dir = pathlib.Path(__file__).absolute().parent
+        self.settings_modifier = self.settings(MEDIA_ROOT=my_dir / 'media')
+        self.settings_modifier.__enter__()
+
+        self.with_avatar = UserModel.objects.create_user(
+            'avatar@user.com', '123456', nickname='with-avatar', avatar='badges/t-rex.png')
+        self.without_avatar = UserModel.objects.create_user(
+            'no-avatar@user.com', '123456', nickname='without-avatar')
+
+    def tearDown(self):
+        self.settings_modifier.__exit__(None, None, None)
+        super().tearDown()
+
+    def post(self, doc) -> HttpResponse:
+        return self.client.post(reverse('bid_api:avatars'), data=json.dumps(doc),
+                                content_type='application/json')
+
+    def test_happy(self):
+        user_ids = [self.with_avatar.id, self.without_avatar.id, 4747]
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.post({'user_ids': user_ids})
+        self.assertEqual(200, resp.status_code)
+
+        # Thumbnail lookups may query the thumbnail store, but users are fetched only once.
+        user_queries = [query for query in ctx.captured_queries
+                        if 'FROM "bid_main_user"' in query['sql']]
+        self.assertEqual(1, len(user_queries))
+
+        avatars = resp.json()['avatars']
+        self.assertEqual({str(self.with_avatar.id), str(self.without_avatar.id)}, set(avatars))
+        self.assertTrue(avatars[str(self.with_avatar.id)].startswith(
+            f'https://example.com{settings.MEDIA_URL}'))
+        self.assertTrue(avatars[str(self.with_avatar.id)].endswith('.jpg'))
+        self.assertEqual(f'https://example.com{settings.STATIC_URL}'
+                         f'{settings.AVATAR_DEFAULT_FILENAME}',
+                         avatars[str(self.without_avatar.id)])
+
+    def test_size(self):
+        default = self.post({'user_ids': [self.with_avatar.id]}).json()['avatars']
+        small = self.post({'user_ids': [self.with_avatar.id], 'size': 64}).json()['avatars']
+        self.assertNotEqual(default, small)
+
+    def test_invalid_requests(self):
+        self.assertEqual(400, self.post({'size': 64}).status_code)
+        self.assertEqual(400, self.post({'user_ids': ['abc']}).status_code)
+        self.assertEqual(400, self.post({'user_ids': '123'}).status_code)
+        self.assertEqual(400, self.post({'user_ids': ['123']}).status_code)
+        self.assertEqual(400, self.post({'user_ids': [1.5]}).status_code)
+        self.assertEqual(400, self.post({'user_ids': {'1': 2}}).status_code)
+        self.assertEqual(400, self.post([1, 2, 3]).status_code)
+        self.assertEqual(400, self.post({'user_ids': [1], 'size': 47}).status_code)
+
+        too_many = list(range(settings.AVATAR_BULK_MAX_USERS + 1))
+        self.assertEqual(400, self.post({'user_ids': too_many}).status_code)
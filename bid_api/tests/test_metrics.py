@@ -0,0 +1,137 @@
+import datetime
+
+import responses
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from bid_api import metrics, models
+from .abstract import AbstractAPITest
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'metrics-test-default',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'metrics-test-shared',
+    },
+}
+
+
+@override_settings(CACHES=TEST_CACHES, WEBHOOK_FLUSH_ON_COMMIT=False)
+class WebhookMetricsTest(TestCase):
+    HOOK_URL = 'http://www.unit.test/api/webhook'
+
+    def setUp(self):
+        super().setUp()
+        caches['shared'].clear()
+        metrics.reset()
+        self.hook = models.Webhook.objects.create(name='hook', url=self.HOOK_URL)
+
+    def tearDown(self):
+        metrics.reset()
+        super().tearDown()
+
+    def test_status_class(self):
+        self.assertEqual('error', metrics.status_class(0))
+        self.assertEqual('2xx', metrics.status_class(204))
+        self.assertEqual('3xx', metrics.status_class(302))
+        self.assertEqual('4xx', metrics.status_class(404))
+        self.assertEqual('5xx', metrics.status_class(503))
+
+    @responses.activate
+    def test_flush_records_deliveries(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=502)
+        for idx in range(2):
+            models.WebhookQueuedCall.objects.create(webhook=self.hook, payload=str(idx))
+
+        self.hook.flush()
+
+        counters = metrics.snapshot()[self.hook.id]
+        self.assertEqual(2, counters['attempts'])
+        self.assertEqual(1, counters['successes'])
+        self.assertEqual(1, counters['failures'])
+        self.assertEqual(1, counters['events'])
+        self.assertEqual(1, counters['status_classes']['2xx'])
+        self.assertEqual(1, counters['status_classes']['5xx'])
+        self.assertEqual(2, counters['latency']['count'])
+        self.assertEqual(2, sum(counters['latency']['buckets']))
+
+    def test_aggregate_over_workers(self):
+        metrics.record_delivery(self.hook.id, 200, 0.01)
+        metrics.publish(force=True, worker='host-a:1')
+        metrics.reset()
+        metrics.record_delivery(self.hook.id, 500, 20, events=3)
+        metrics.record_delivery(self.hook.id, 200, 0.2, events=3)
+        metrics.publish(force=True, worker='host-b:2')
+
+        totals = metrics.aggregate()[self.hook.id]
+        self.assertEqual(3, totals['attempts'])
+        self.assertEqual(2, totals['successes'])
+        self.assertEqual(4, totals['events'])
+        self.assertEqual({'2xx': 2, '3xx': 0, '4xx': 0, '5xx': 1, 'error': 0},
+                         totals['status_classes'])
+        self.assertEqual([1, 0, 1, 0, 0, 0, 0, 0, 1], totals['latency']['buckets'])
+
+        # Publishing again replaces the worker's earlier counters.
+        metrics.publish(force=True, worker='host-b:2')
+        self.assertEqual(3, metrics.aggregate()[self.hook.id]['attempts'])
+
+    def test_collect_queue_state(self):
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='1')
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='2')
+        models.WebhookQueuedCall.objects.update(
+            created=timezone.now() - datetime.timedelta(minutes=5))
+        idle = models.Webhook.objects.create(name='idle', url=self.HOOK_URL)
+
+        collected = {info['id']: info for info in metrics.collect()}
+        self.assertEqual(2, collected[self.hook.id]['queue_depth'])
+        self.assertAlmostEqual(300, collected[self.hook.id]['oldest_queued_seconds'], delta=10)
+        self.assertEqual('closed', collected[self.hook.id]['breaker_state'])
+        self.assertEqual(0, collected[idle.id]['queue_depth'])
+        self.assertEqual(0, collected[idle.id]['oldest_queued_seconds'])
+
+    def test_prometheus_text(self):
+        metrics.record_delivery(self.hook.id, 200, 0.3)
+        text = metrics.prometheus_text(metrics.collect())
+
+        labels = f'webhook="hook",id="{self.hook.id}"'
+        self.assertIn('# TYPE blender_id_webhook_attempts_total counter', text)
+        self.assertIn(f'blender_id_webhook_attempts_total{{{labels}}} 1', text)
+        self.assertIn(f'blender_id_webhook_responses_total{{{labels},class="2xx"}} 1', text)
+        self.assertIn(f'blender_id_webhook_delivery_seconds_bucket{{{labels},le="0.25"}} 0', text)
+        self.assertIn(f'blender_id_webhook_delivery_seconds_bucket{{{labels},le="0.5"}} 1', text)
+        self.assertIn(f'blender_id_webhook_delivery_seconds_bucket{{{labels},le="+Inf"}} 1', text)
+        self.assertIn(f'blender_id_webhook_breaker_state{{{labels},state="closed"}} 1', text)
+        self.assertIn(f'blender_id_webhook_breaker_state{{{labels},state="open"}} 0', text)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class WebhookMetricsViewTest(AbstractAPITest):
+    access_token_scope = 'metrics'
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.hook = models.Webhook.objects.create(name='hook', url='http://unit.test/')
+
+    def test_json(self):
+        resp = self.authed_get(reverse('bid_api:webhook-metrics'))
+        self.assertEqual(200, resp.status_code)
+        payload = resp.json()
+        self.assertEqual(list(metrics.LATENCY_BUCKETS), payload['latency_buckets'])
+        self.assertEqual(['hook'], [info['name'] for info in payload['webhooks']])
+
+    def test_prometheus(self):
+        resp = self.authed_get(reverse('bid_api:webhook-metrics'), data={'format': 'prometheus'})
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'blender_id_webhook_queue_depth{webhook="hook"', resp.content)
+
+    def test_requires_token(self):
+        resp = self.client.get(reverse('bid_api:webhook-metrics'))
+        self.assertEqual(403, resp.status_code)
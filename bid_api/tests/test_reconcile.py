@@ -0,0 +1,199 @@
+import io
+import json
+import pathlib
+import tempfile
+
+from django.contrib.admin.models import LogEntry
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from bid_api import models, reconcile
+from bid_main.models import Role
+from .abstract import UserModel
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'bid_main.cache.TwoTierCache',
+        'LOCATION': 'l2',
+        'KEY_PREFIX': 'reconcile-test',
+    },
+    'l2': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'reconcile-test-l2',
+    },
+}
+
+
+@override_settings(CACHES=TEST_CACHES, WEBHOOK_FLUSH_ON_COMMIT=False)
+class ReconcileUsersTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = pathlib.Path(self.tmpdir.name)
+
+        self.subscriber = Role.objects.create(name='cloud_subscriber')
+        self.has_subscription = Role.objects.create(name='cloud_has_subscription')
+        self.other = Role.objects.create(name='other')
+        badger_role = Role.objects.create(name='cloud_badger', is_public=False)
+        badger_role.may_manage_roles.set([self.subscriber, self.has_subscription])
+        self.badger = UserModel.objects.create_user('badger@example.com', '123456',
+                                                    nickname='badger')
+        self.badger.roles.add(badger_role)
+
+        self.users = [UserModel.objects.create_user(f'user{idx}@example.com', '123456',
+                                                    nickname=f'user{idx}')
+                      for idx in range(4)]
+        self.users[1].roles.add(self.subscriber, self.has_subscription, self.other)
+        self.users[2].roles.add(self.subscriber)
+
+        self.hook = models.Webhook.objects.create(name='hook', url='http://unit.test/')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def write(self, name: str, content) -> pathlib.Path:
+        path = self.tmp / name
+        with path.open('w') as outfile:
+            if name.endswith('.ndjson'):
+                for user, roles in content:
+                    print(json.dumps({'user': user, 'roles': roles}), file=outfile)
+            else:
+                json.dump(content, outfile)
+        return path
+
+    def reconcile(self, *args) -> str:
+        out = io.StringIO()
+        call_command('reconcile_users', 'badger@example.com', *args, stdout=out)
+        return out.getvalue()
+
+    def roles(self, user) -> set:
+        return {role.name for role in user.roles.all()}
+
+    def test_json(self):
+        path = self.write('state.json', {
+            'user0@example.com': ['cloud_subscriber', 'cloud_has_subscription'],
+            str(self.users[1].id): ['cloud_has_subscription', 'other'],
+            'user2@example.com': ['cloud_subscriber'],
+            'unknown@example.com': ['cloud_subscriber'],
+        })
+        output = self.reconcile(str(path))
+
+        self.assertEqual({'cloud_subscriber', 'cloud_has_subscription'}, self.roles(self.users[0]))
+        self.assertEqual({'cloud_has_subscription', 'other'}, self.roles(self.users[1]))
+        self.assertEqual({'cloud_subscriber'}, self.roles(self.users[2]))
+        self.users[0].refresh_from_db()
+        self.assertEqual('cloud_has_subscription cloud_subscriber',
+                         self.users[0].public_roles_as_string)
+        self.users[1].refresh_from_db()
+        self.assertEqual('cloud_has_subscription other', self.users[1].public_roles_as_string)
+
+        # One webhook call per changed user.
+        payloads = [json.loads(call.payload) for call in self.hook.queue.order_by('id')]
+        self.assertEqual([(self.users[0].id, ['cloud_has_subscription', 'cloud_subscriber']),
+                          (self.users[1].id, ['cloud_has_subscription', 'other'])],
+                         [(payload['id'], payload['roles']) for payload in payloads])
+
+        entries = LogEntry.objects.filter(user=self.badger).order_by('object_id', 'id')
+        self.assertEqual([(str(self.users[0].id), 'Granted role cloud_has_subscription.'),
+                          (str(self.users[0].id), 'Granted role cloud_subscriber.'),
+                          (str(self.users[1].id), 'Revoked role cloud_subscriber.')],
+                         [(entry.object_id, entry.change_message) for entry in entries])
+        self.assertIn('4 users listed, 1 unknown', output)
+        self.assertIn('2 users were changed', output)
+
+    def test_ndjson_dry_run_report(self):
+        path = self.write('state.ndjson', [
+            ('user0@example.com', ['cloud_subscriber', 'bogus']),
+            ('user1@example.com', []),
+            ('unknown@example.com', []),
+        ])
+        report = self.tmp / 'report.ndjson'
+        output = self.reconcile(str(path), '--dry-run', '--report', str(report))
+
+        self.assertEqual(set(), self.roles(self.users[0]))
+        self.assertEqual(0, self.hook.queue.count())
+        self.assertEqual(0, LogEntry.objects.filter(user=self.badger).count())
+        with report.open() as infile:
+            lines = [json.loads(line) for line in infile]
+        self.assertEqual([
+            {'user': 'user0@example.com', 'id': self.users[0].id,
+             'grant': ['cloud_subscriber'], 'revoke': []},
+            {'user': 'user1@example.com', 'id': self.users[1].id,
+             'grant': [], 'revoke': ['cloud_has_subscription', 'cloud_subscriber']},
+            {'user': 'unknown@example.com', 'error': 'unknown-user'},
+        ], lines)
+        self.assertIn('cloud_subscriber: 1 granted, 1 revoked', output)
+        self.assertIn('bogus is not managed, ignored for 1 users', output)
+        self.assertIn('2 users would be changed', output)
+
+    def test_revoke_unlisted(self):
+        path = self.write('state.json', {'user1@example.com': ['cloud_subscriber']})
+        self.reconcile(str(path), '--revoke-unlisted', '--role', 'cloud_subscriber')
+
+        self.assertEqual({'cloud_subscriber', 'cloud_has_subscription', 'other'},
+                         self.roles(self.users[1]))
+        self.assertEqual(set(), self.roles(self.users[2]))
+
+    def test_case_and_leading_zeros(self):
+        path = self.write('state.json', {
+            'User0@Example.com': ['cloud_subscriber'],
+            f'00{self.users[1].id}': ['cloud_subscriber'],
+        })
+        output = self.reconcile(str(path), '--revoke-unlisted', '--role', 'cloud_subscriber')
+
+        self.assertEqual({'cloud_subscriber'}, self.roles(self.users[0]))
+        self.assertEqual({'cloud_subscriber', 'cloud_has_subscription', 'other'},
+                         self.roles(self.users[1]))
+        self.assertEqual(set(), self.roles(self.users[2]))
+        self.assertIn('0 unknown', output)
+
+    def test_checkpoint(self):
+        path = self.write('state.ndjson', [
+            (f'user{idx}@example.com', ['cloud_subscriber']) for idx in range(4)
+        ])
+        checkpoint = self.tmp / 'checkpoint.json'
+        with checkpoint.open('w') as outfile:
+            json.dump({'input': str(path.absolute()),
+                       'roles': ['cloud_subscriber'],
+                       'chunk_size': 2,
+                       'revoke_unlisted': False,
+                       'chunks_done': 1,
+                       'last_unlisted_user_id': 0}, outfile)
+
+        self.reconcile(str(path), '--role', 'cloud_subscriber', '--chunk-size', '2',
+                       '--checkpoint', str(checkpoint))
+        self.assertEqual(set(), self.roles(self.users[0]))
+        self.assertEqual({'cloud_subscriber'}, self.roles(self.users[3]))
+        with checkpoint.open() as infile:
+            self.assertEqual(2, json.load(infile)['chunks_done'])
+
+        with self.assertRaises(CommandError):
+            self.reconcile(str(path), '--chunk-size', '3', '--checkpoint', str(checkpoint))
+
+    def test_not_allowed_role(self):
+        path = self.write('state.json', {})
+        with self.assertRaises(CommandError):
+            self.reconcile(str(path), '--role', 'other')
+
+    def test_queries_per_chunk(self):
+        reconciler = reconcile.Reconciler(self.badger, ['cloud_subscriber'])
+
+        def count_queries(entries) -> int:
+            with CaptureQueriesContext(connection) as queries:
+                reconciler.reconcile(entries)
+            return len(queries)
+
+        few = count_queries([('user0@example.com', {'cloud_subscriber'}),
+                             ('user1@example.com', set())])
+        more_users = [UserModel.objects.create_user(f'more{idx}@example.com', '123456',
+                                                    nickname=f'more{idx}')
+                      for idx in range(10)]
+        many = count_queries([(user.email, {'cloud_subscriber'}) for user in more_users] +
+                             [('user0@example.com', set()), ('user2@example.com', set())])
+        self.assertEqual(few, many)
@@ -0,0 +1,116 @@
+import http.server
+import multiprocessing
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from bid_api import sessions
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def _connect_in_child(registry: sessions.SessionRegistry, url: str, results: multiprocessing.Queue):
+    try:
+        with registry.session(url) as sess:
+            sess.post(url, data=b'{}', timeout=5)
+        results.put((registry.hosts(), sessions.handshake_stats()))
+    except Exception as ex:
+        results.put(ex)
+
+
+@override_settings(WEBHOOK_HTTP_POOL_SIZE=2, WEBHOOK_HTTP_IDLE_TIMEOUT=60)
+class SessionRegistryTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/webhook' % self.server.server_port
+        self.origin = 'http://127.0.0.1:%d' % self.server.server_port
+
+        sessions.reset_handshake_stats()
+        self.registry = sessions.SessionRegistry(max_retries=0)
+
+    def tearDown(self):
+        self.registry.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def post(self, url=None):
+        url = url or self.url
+        with self.registry.session(url) as sess:
+            resp = sess.post(url, data=b'{}', timeout=5)
+            resp.raise_for_status()
+
+    def test_origin(self):
+        self.assertEqual('https://hook.example.com:443',
+                         sessions.origin('https://hook.example.com/api/webhook'))
+        self.assertEqual('http://hook.example.com:8080',
+                         sessions.origin('http://hook.example.com:8080/'))
+
+    def test_connection_reused(self):
+        for _ in range(5):
+            self.post()
+        # Another webhook on the same host shares the connection.
+        self.post(self.url + '/other')
+
+        self.assertEqual([self.origin], self.registry.hosts())
+        stats = sessions.handshake_stats()
+        self.assertEqual(1, stats[self.origin]['count'])
+        self.assertGreater(stats[self.origin]['seconds'], 0)
+
+    def test_idle_sessions_pruned(self):
+        self.post()
+        self.registry.prune()
+        self.assertEqual([self.origin], self.registry.hosts())
+
+        with self.settings(WEBHOOK_HTTP_IDLE_TIMEOUT=0):
+            # Sessions in use are never pruned.
+            with self.registry.session(self.url):
+                self.registry.prune()
+                self.assertEqual([self.origin], self.registry.hosts())
+            self.registry.prune()
+        self.assertEqual([], self.registry.hosts())
+
+        self.post()
+        self.assertEqual(2, sessions.handshake_stats()[self.origin]['count'])
+
+    def test_bounded_pool(self):
+        with self.registry.session(self.url) as sess:
+            adapter = sess.get_adapter(self.url)
+            self.assertEqual(2, adapter._pool_maxsize)
+            self.assertTrue(adapter._pool_block)
+
+    def test_fresh_sessions_after_fork(self):
+        self.post()
+
+        mp = multiprocessing.get_context('fork')
+        results = mp.Queue()
+        proc = mp.Process(target=_connect_in_child, args=(self.registry, self.url, results))
+        proc.start()
+        result = results.get(timeout=10)
+        proc.join(10)
+
+        if isinstance(result, Exception):
+            raise result
+        hosts, stats = result
+        self.assertEqual([self.origin], hosts)
+        # The child made its own connection, and counted only that one.
+        self.assertEqual(1, stats[self.origin]['count'])
+
+        # The parent's connection is still usable.
+        self.post()
+        self.assertEqual(1, sessions.handshake_stats()[self.origin]['count'])
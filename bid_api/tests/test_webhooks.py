@@ -1,17 +1,24 @@
 import datetime
+import gzip
 import hashlib
 import hmac
 import json
 import pathlib
+import zlib
+from unittest import mock
 
 import responses
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from .abstract import UserModel
 from bid_main.models import Role
+from bid_main.signals import user_deletion_requested
 import bid_main.fields
-from bid_api import models
+from bid_api import models, outbox, payloads
 
 # Import for side-effects of registering the signals
 # noinspection PyUnresolvedReferences
@@ -34,6 +41,10 @@ class WebhookBaseTest(TestCase):
 
         self.default_user_avatar_url = bid_main.fields.AvatarFieldFile.default_thumbnail_url()
 
+    def flush(self):
+        """Delivers queued calls, like the on-commit flush would outside of tests."""
+        models.WebhookQueuedCall.flush_all()
+
 
 class WebhookTest(WebhookBaseTest):
     @responses.activate
@@ -49,7 +60,10 @@ class WebhookTest(WebhookBaseTest):
         self.assertEqual(user.public_roles_as_string, '')
 
         self.assertTrue(user.webhook_user_modified)
+        self.assertEqual(0, len(responses.calls), 'Calls should only be queued when saving')
+        self.assertEqual(1, models.WebhookQueuedCall.objects.count())
 
+        self.flush()
         self.assertEqual(1, len(responses.calls))
         call = responses.calls[0]
         self.assertEqual(self.HOOK_URL, call.request.url)
@@ -87,6 +101,7 @@ class WebhookTest(WebhookBaseTest):
 
         self.assertTrue(user.webhook_user_modified)
 
+        self.flush()
         self.assertEqual(1, len(responses.calls))
         payload = json.loads(responses.calls[0].request.body)
         self.assertEqual({'id': user.id,
@@ -113,6 +128,7 @@ class WebhookTest(WebhookBaseTest):
 
             self.assertTrue(user.webhook_user_modified)
 
+            self.flush()
             self.assertEqual(1, len(responses.calls))
             payload = json.loads(responses.calls[0].request.body)
             self.assertEqual({'id': user.id,
@@ -157,6 +173,7 @@ class WebhookTest(WebhookBaseTest):
         user.roles.remove(role2)
         user.save()
 
+        self.flush()
         self.assertEqual(2, len(responses.calls))
         payload = json.loads(responses.calls[0].request.body)
         self.assertEqual({'id': user.id,
@@ -185,8 +202,9 @@ class WebhookTest(WebhookBaseTest):
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
 
-        # The POST to the webhook should be queued now.
+        # The POST to the webhook should still be queued now.
         queue = list(models.WebhookQueuedCall.objects.all())
         self.assertEqual(1, len(queue))
 
@@ -211,8 +229,9 @@ class WebhookTest(WebhookBaseTest):
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
 
-        # The POST to the webhook should be queued now.
+        # The POST to the webhook should still be queued now.
         queue = list(models.WebhookQueuedCall.objects.all())
         self.assertEqual(1, len(queue))
 
@@ -244,8 +263,9 @@ class WebhookTest(WebhookBaseTest):
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
 
-        # The POST to the webhook should be queued now.
+        # The POST to the webhook should still be queued now.
         queue = list(models.WebhookQueuedCall.objects.all())
         self.assertEqual(1, len(queue))
         self.assertEqual(1, len(responses.calls))  # the failed call
@@ -293,8 +313,9 @@ class WebhookTest(WebhookBaseTest):
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
 
-        # The POST to the webhook should be queued now.
+        # The POST to the webhook should still be queued now.
         queue = list(models.WebhookQueuedCall.objects.all())
         self.assertEqual(1, len(queue))
         self.assertEqual(1, len(responses.calls))  # the failed call
@@ -344,8 +365,9 @@ class WebhookTest(WebhookBaseTest):
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
 
-        # The POST to the webhook should be queued now.
+        # The POST to the webhook should still be queued now.
         queue = list(models.WebhookQueuedCall.objects.all())
         self.assertEqual(1, len(queue))
         self.assertEqual(1, len(responses.calls))  # the failed call
@@ -386,10 +408,11 @@ class WebhookTest(WebhookBaseTest):
     def test_queueing_after_failure(self):
         """When one item is queued, new items should also be queued to ensure order."""
 
-        # No POST response set up, so hook wil fail and be queued.
+        # No POST response set up, so hook wil fail and remain queued.
         user = UserModel.objects.create_user('test@user.com', '123456')
         user.full_name = 'ဖန်စီဘောင်းဘီ'
         user.save()
+        self.flush()
         self.assertEqual(1, models.WebhookQueuedCall.objects.count())
 
         # Set up POST to fix the hook
@@ -404,13 +427,14 @@ class WebhookTest(WebhookBaseTest):
         self.assertEqual(2, models.WebhookQueuedCall.objects.count())
 
         # Flushing should work now.
-        models.WebhookQueuedCall.flush_all()
+        self.flush()
         self.assertEqual(3, len(responses.calls))  # one failed + two successful calls
         self.assertEqual(0, models.WebhookQueuedCall.objects.count())
 
         # Another change should go through just fine.
         user.full_name = 'yet another name'
         user.save()
+        self.flush()
         self.assertEqual(4, len(responses.calls))  # one failed + three successful calls
         self.assertEqual(0, models.WebhookQueuedCall.objects.count())
 
@@ -451,142 +475,807 @@ class WebhookTest(WebhookBaseTest):
                          'Saving user without email change should not trigger email changed signal')
 
 
-class WebhookFlushDelayTest(WebhookBaseTest):
-    """To simplify the test, we use a fake 'now' for evaluation.
+class WebhookOutboxTest(TransactionTestCase):
+    """Tests delivery after commit, which requires real transactions."""
+    HOOK_URL = WebhookBaseTest.HOOK_URL
 
-    This prevents setting queued_call.created after saving it and saving
-    it again.
-    """
+    def setUp(self):
+        super().setUp()
+        models.Webhook.objects.create(name='Unit test webhook', url=self.HOOK_URL)
 
-    def queue_call(self):
-        queued_call = models.WebhookQueuedCall(
-            webhook=self.hook,
-            payload='"payload"',
-            error_code=0,
-            error_msg='unit test',
-        )
-        queued_call.save()
+    def wait_for_background_flush(self):
+        # The executor has a single thread, so this waits for all queued work.
+        outbox._get_executor().submit(lambda: None).result(timeout=10)
 
-    def test_empty_queue(self):
-        flush_delay = self.hook.flush_delay()
-        self.assertIsNone(flush_delay)
+    @responses.activate
+    def test_delivered_after_commit(self):
+        responses.add(responses.POST,
+                      self.HOOK_URL,
+                      json={'status': 'success'},
+                      status=200)
 
-    def test_just_queued(self):
-        self.queue_call()
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        with transaction.atomic():
+            user.full_name = 'ဖန်စီဘောင်းဘီ'
+            user.save()
+            self.assertEqual(1, models.WebhookQueuedCall.objects.count())
+        self.wait_for_background_flush()
 
-        now = timezone.now()
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(flush_delay, datetime.timedelta(seconds=1))
+        self.assertEqual(1, len(responses.calls))
+        payload = json.loads(responses.calls[0].request.body)
+        self.assertEqual('ဖန်စီဘောင်းဘီ', payload['full_name'])
+        self.assertEqual(0, models.WebhookQueuedCall.objects.count())
 
-    def test_queued_1_min_ago(self):
-        self.queue_call()
+    @responses.activate
+    def test_rolled_back_not_announced(self):
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                user.full_name = 'ဖန်စီဘောင်းဘီ'
+                user.save()
+                raise ValueError('roll back')
+        self.wait_for_background_flush()
+
+        self.assertEqual(0, len(responses.calls))
+        self.assertEqual(0, models.WebhookQueuedCall.objects.count())
 
-        now = timezone.now() + datetime.timedelta(minutes=1)
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(flush_delay, datetime.timedelta(seconds=5))
+    @responses.activate
+    def test_no_flush_on_commit(self):
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        with self.settings(WEBHOOK_FLUSH_ON_COMMIT=False):
+            user.full_name = 'ဖန်စီဘောင်းဘီ'
+            user.save()
+        self.wait_for_background_flush()
 
-    def test_queued_3_min_ago(self):
-        self.queue_call()
+        self.assertEqual(0, len(responses.calls))
+        self.assertEqual(1, models.WebhookQueuedCall.objects.count())
 
-        now = timezone.now() + datetime.timedelta(minutes=3)
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(flush_delay, datetime.timedelta(seconds=10))
 
-    def test_queued_10_min_ago(self):
-        self.queue_call()
+class WebhookRetryTest(WebhookBaseTest):
+    def queue_call(self, payload='"payload"') -> models.WebhookQueuedCall:
+        return models.WebhookQueuedCall.objects.create(webhook=self.hook, payload=payload)
+
+    @override_settings(WEBHOOK_RETRY_BASE_DELAY=2, WEBHOOK_RETRY_MAX_DELAY=60)
+    def test_retry_delay(self):
+        for attempts, full_delay in ((1, 2), (2, 4), (3, 8), (5, 32), (6, 60), (100, 60)):
+            for _ in range(10):
+                delay = models.retry_delay(attempts).total_seconds()
+                self.assertGreaterEqual(delay, full_delay / 2)
+                self.assertLessEqual(delay, full_delay)
 
-        now = timezone.now() + datetime.timedelta(minutes=10)
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(flush_delay, datetime.timedelta(seconds=10))
+    @responses.activate
+    def test_failure_schedules_next_attempt(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=500)
+        first = self.queue_call('1')
+        second = self.queue_call('2')
+
+        before = timezone.now()
+        self.hook.flush()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.hook.refresh_from_db()
+        self.assertEqual(1, len(responses.calls), 'Flush should stop at the first failure')
+        self.assertEqual(1, first.attempts)
+        self.assertGreater(first.next_attempt_at, before)
+        self.assertEqual(0, second.attempts)
+        self.assertEqual(first.next_attempt_at, self.hook.postponed_until,
+                         'Later calls should not be due before the first one')
 
-    def test_queued_1_hour_ago(self):
+    @responses.activate
+    def test_postponed_until_success(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
         self.queue_call()
+        self.hook.postpone_queue(timezone.now() + datetime.timedelta(minutes=1))
 
-        now = timezone.now() + datetime.timedelta(hours=1)
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(flush_delay, datetime.timedelta(seconds=15))
+        # Not even the queue is read while postponed.
+        with self.assertNumQueries(0):
+            self.hook._flush_queue(mock.Mock(), 'unit-test-worker', force=False)
 
+        self.hook.flush(force=True)
+        self.assertEqual(1, len(responses.calls))
+        self.hook.refresh_from_db()
+        self.assertIsNone(self.hook.postponed_until)
 
-class WebhookFlushTimeTest(WebhookBaseTest):
+    @responses.activate
+    def test_flush_skips_calls_not_due(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        call = self.queue_call()
+        call.next_attempt_at = timezone.now() + datetime.timedelta(minutes=1)
+        call.save()
+
+        self.hook.flush()
+        self.assertEqual(0, len(responses.calls))
+        self.assertEqual(1, self.hook.queue_size())
+
+        # Forcing a flush should ignore the next attempt time.
+        self.hook.flush(force=True)
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual(0, self.hook.queue_size())
 
-    def assertCloseTo(self, time1, time2, **kwargs):
-        """Asserts that 'time1' is close to 'time2 + timedelta(**kwargs)'."""
-        delta = datetime.timedelta(**kwargs)
-        precision = datetime.timedelta(milliseconds=10)
+    @responses.activate
+    def test_flush_reads_queue_in_pages(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        for idx in range(7):
+            self.queue_call(str(idx))
+
+        with mock.patch.object(models, 'FLUSH_PAGE_SIZE', 3), \
+                CaptureQueriesContext(connection) as queries:
+            self.hook.flush()
+        self.assertEqual(list(range(7)), [json.loads(call.request.body)
+                                          for call in responses.calls])
+        self.assertEqual(0, self.hook.queue_size())
+
+        sqls = [query['sql'] for query in queries.captured_queries]
+        # Three full pages and an empty one, not one query per call.
+        self.assertEqual(4, len([sql for sql in sqls
+                                 if sql.startswith('SELECT') and 'ORDER BY' in sql
+                                 and 'bid_api_webhookqueuedcall' in sql]))
+        # The queue is counted once, to log its size, not for every call.
+        self.assertEqual(1, len([sql for sql in sqls if sql.startswith('SELECT COUNT(*)')
+                                 and 'bid_api_webhookqueuedcall' in sql]))
+        # The lease is taken and released, not renewed for every call.
+        self.assertEqual(2, len([sql for sql in sqls
+                                 if sql.startswith('UPDATE "bid_api_webhook" SET "claimed_by"')]))
+
+    def test_renew_claim(self):
+        worker_id = 'unit-test-worker'
+        self.assertTrue(self.hook.claim(worker_id))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.hook.renew_claim(worker_id))
+
+        self.hook.claimed_until = timezone.now() + self.hook.worst_send_duration()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.hook.renew_claim(worker_id))
+        self.assertGreater(self.hook.claimed_until - timezone.now(),
+                           2 * self.hook.worst_send_duration())
 
-        if time2 + delta - precision <= time1 <= time2 + delta + precision:
-            return
-        self.fail(f'{time1} is not close to {time2} + {delta}:\n'
-                  f'Actual  : {time1}\n'
-                  f'Expected: {time2 + delta}')
+    @responses.activate
+    def test_attempts_grow(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=500)
+        call = self.queue_call()
+
+        for attempt in range(1, 4):
+            self.hook.flush(force=True)
+            call.refresh_from_db()
+            self.assertEqual(attempt, call.attempts)
+
+
+@override_settings(WEBHOOK_BREAKER_MIN_ATTEMPTS=3,
+                   WEBHOOK_BREAKER_FAILURE_RATE=0.5,
+                   WEBHOOK_BREAKER_COOLDOWN=60)
+class WebhookBreakerTest(WebhookBaseTest):
+    def queue_calls(self, count: int):
+        for idx in range(count):
+            models.WebhookQueuedCall.objects.create(webhook=self.hook, payload=str(idx))
+
+    def flush_due(self):
+        """Makes all calls due, then flushes."""
+        self.hook.queue.update(next_attempt_at=timezone.now())
+        self.hook.postponed_until = None
+        self.hook.save(update_fields={'postponed_until'})
+        self.hook.flush()
+        self.hook.refresh_from_db()
 
-    def queue_call(self, created: datetime.datetime):
-        queued_call = models.WebhookQueuedCall(
-            webhook=self.hook,
-            payload='"payload"',
-            error_code=0,
-            error_msg='unit test',
-        )
-        queued_call.save()
-        queued_call.created = created
-        queued_call.save(update_fields={'created'})
+    @responses.activate
+    def test_breaker_opens_and_skips_network(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=500)
+        self.queue_calls(2)
 
-    def test_empty_queue(self):
-        flush_time = self.hook.flush_time()
-        self.assertIsNone(flush_time)
+        for _ in range(3):
+            self.flush_due()
+        self.assertEqual(3, len(responses.calls))
+        self.assertEqual(models.BREAKER_OPEN, self.hook.breaker_state)
 
-    def test_just_queued_never_flushed(self):
-        now = timezone.now()
-        self.queue_call(now)
+        # While open, nothing should be sent.
+        self.flush_due()
+        self.assertEqual(3, len(responses.calls))
 
-        flush_time = self.hook.flush_time(now=now)
-        self.assertCloseTo(flush_time, now, seconds=0)
+        # And the queue should be postponed until the breaker becomes half-open.
+        self.assertEqual(self.hook.breaker_closes_at(), self.hook.postponed_until)
 
-    def test_queued_47_min_ago_flushed_never(self):
+    @responses.activate
+    def test_half_open_success_closes(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.queue_calls(2)
+        self.hook.breaker_state = models.BREAKER_OPEN
+        self.hook.breaker_opened_at = timezone.now() - datetime.timedelta(minutes=2)
+        self.hook.save()
+
+        self.flush_due()
+        self.assertEqual(models.BREAKER_CLOSED, self.hook.breaker_state)
+        self.assertEqual(2, len(responses.calls))
+        self.assertEqual(0, self.hook.queue_size())
+
+    @responses.activate
+    def test_half_open_failure_reopens(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=500)
+        self.queue_calls(2)
+        self.hook.breaker_state = models.BREAKER_OPEN
+        self.hook.breaker_opened_at = timezone.now() - datetime.timedelta(minutes=2)
+        self.hook.save()
+
+        self.flush_due()
+        self.assertEqual(models.BREAKER_OPEN, self.hook.breaker_state)
+        self.assertEqual(1, len(responses.calls), 'Only one call should be tried when half-open')
+        self.assertGreater(self.hook.breaker_opened_at,
+                           timezone.now() - datetime.timedelta(minutes=1))
+
+    @responses.activate
+    def test_successes_keep_breaker_closed(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.queue_calls(5)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.flush_due()
+        self.assertEqual(models.BREAKER_CLOSED, self.hook.breaker_state)
+        self.assertEqual(5, len(responses.calls))
+        self.assertEqual(5, self.hook.breaker_window_attempts)
+
+        # The breaker is saved once, not for every call.
+        breaker_saves = [query for query in queries.captured_queries
+                         if '"breaker_window_attempts" =' in query['sql']]
+        self.assertEqual(1, len(breaker_saves))
+
+
+class WebhookDeadLetterTest(WebhookBaseTest):
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=2, WEBHOOK_ERROR_MSG_MAX_LENGTH=10)
+    @responses.activate
+    def test_max_attempts(self):
+        responses.add(responses.POST, self.HOOK_URL, body='x' * 100, status=500)
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='"first"')
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='"second"')
+
+        self.hook.flush(force=True)
+        self.assertEqual(0, self.hook.dead_letters.count())
+        self.assertEqual(10, len(self.hook.queue.order_by('created').first().error_msg))
+
+        self.hook.flush(force=True)
+        self.assertEqual(1, self.hook.queue_size())
+        dead_letter = self.hook.dead_letters.get()
+        self.assertEqual('"first"', dead_letter.payload)
+        self.assertEqual(2, dead_letter.attempts)
+        self.assertEqual(500, dead_letter.error_code)
+        self.assertEqual('x' * 9 + '…', dead_letter.error_msg)
+
+    @override_settings(WEBHOOK_MAX_AGE=60)
+    @responses.activate
+    def test_max_age(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        old = models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='"old"')
+        models.WebhookQueuedCall.objects.filter(id=old.id) \
+            .update(created=timezone.now() - datetime.timedelta(minutes=2))
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload='"new"')
+
+        self.hook.flush()
+
+        # The old call should not even be tried.
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual(b'"new"', responses.calls[0].request.body)
+        self.assertEqual('"old"', self.hook.dead_letters.get().payload)
+
+    def test_replay(self):
         now = timezone.now()
-        # Oldest queued call was queued 47 minutes ago.
-        self.queue_call(now - datetime.timedelta(minutes=47))
+        for idx in (2, 1):
+            models.WebhookDeadLetter.objects.create(
+                webhook=self.hook, payload=str(idx), attempts=5,
+                queued=now - datetime.timedelta(minutes=idx))
 
-        # Verify that the creation timestamp was set correctly.
-        oldest = self.hook.queue.order_by('created').first()
-        age = now - oldest.created
-        self.assertEqual(47 * 60, age.total_seconds())
+        count = models.WebhookDeadLetter.replay(models.WebhookDeadLetter.objects.all())
+        self.assertEqual(2, count)
+        self.assertEqual(0, models.WebhookDeadLetter.objects.count())
 
-        # Should be flushed soon.
-        flush_time = self.hook.flush_time(now=now)
-        self.assertCloseTo(flush_time, now, seconds=0)
+        queue = list(self.hook.queue.order_by('created', 'id'))
+        self.assertEqual(['2', '1'], [call.payload for call in queue])
+        self.assertEqual([0, 0], [call.attempts for call in queue])
 
-    def test_queued_47_min_ago_flushed_3_sec_ago(self):
+    def test_replay_before_newer_calls(self):
         now = timezone.now()
-        # Oldest queued call was queued 47 minutes ago.
-        self.queue_call(now - datetime.timedelta(minutes=47))
+        old = {'id': 5, 'old_email': 'old@example.com', 'email': 'mid@example.com',
+               'roles': ['cloud_subscriber'], 'avatar_changed': True}
+        newer = {'id': 5, 'old_email': 'mid@example.com', 'email': 'new@example.com',
+                 'roles': [], 'avatar_changed': False}
+        models.WebhookDeadLetter.objects.create(
+            webhook=self.hook, payload=json.dumps(old), subject_id=5, attempts=5, queued=now)
+        models.WebhookDeadLetter.objects.create(
+            webhook=self.hook, payload='"other"', subject_id=6, attempts=5, queued=now)
+        models.WebhookQueuedCall.objects.create(
+            webhook=self.hook, payload=json.dumps(newer), subject_id=5)
+
+        count = models.WebhookDeadLetter.replay(models.WebhookDeadLetter.objects.all())
+        self.assertEqual(2, count)
+
+        # The old state is merged into the newer call, instead of being sent after it.
+        queue = list(self.hook.queue.order_by('created', 'id'))
+        self.assertEqual([5, 6], [call.subject_id for call in queue])
+        self.assertEqual(dict(newer, old_email='old@example.com', avatar_changed=True),
+                         json.loads(queue[0].payload))
+        self.assertEqual('"other"', queue[1].payload)
+
+    def test_dead_letter_keeps_subject(self):
+        call = models.WebhookQueuedCall.objects.create(
+            webhook=self.hook, payload='"call"', subject_id=5)
+        self.assertEqual(5, call.to_dead_letter().subject_id)
+
+
+class WebhookCoalesceTest(WebhookBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.hook.coalesce_events = True
+        self.hook.save()
+
+    def queued_payloads(self, hook=None) -> list:
+        hook = hook or self.hook
+        return [json.loads(call.payload) for call in hook.queue.order_by('created', 'id')]
+
+    def test_coalesce_same_user(self):
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        other = UserModel.objects.create_user('other@user.com', '123456', nickname='other')
+
+        user.email = 'new@user.com'
+        user.save()
+        other.full_name = 'Other User'
+        other.save()
+
+        my_dir = pathlib.Path(__file__).absolute().parent
+        with self.settings(MEDIA_ROOT=my_dir / 'media'):
+            user.avatar = 'badges/t-rex.png'
+            user.save()
+        user.email = 'newer@user.com'
+        user.full_name = 'ဖန်စီဘောင်းဘီ'
+        user.save()
 
-        # Last flush was 3 seconds ago.
-        self.hook.last_flush_attempt = now - datetime.timedelta(seconds=3)
+        # The user's events are merged into the last one, after the other user's.
+        self.assertEqual([
+            {'id': other.id,
+             'old_email': 'other@user.com',
+             'full_name': 'Other User',
+             'email': 'other@user.com',
+             'roles': [],
+             'avatar_changed': False},
+            {'id': user.id,
+             'old_email': 'test@user.com',
+             'full_name': 'ဖန်စီဘောင်းဘီ',
+             'email': 'newer@user.com',
+             'roles': [],
+             'avatar_changed': True},
+        ], self.queued_payloads())
+
+    def test_no_coalescing_by_default(self):
+        plain_hook = models.Webhook.objects.create(name='plain', url=self.HOOK_URL)
+
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        for name in ('first', 'second', 'third'):
+            user.full_name = name
+            user.save()
+
+        self.assertEqual(['first', 'second', 'third'],
+                         [payload['full_name'] for payload in self.queued_payloads(plain_hook)])
+        self.assertEqual(['third'],
+                         [payload['full_name'] for payload in self.queued_payloads()])
+
+    @responses.activate
+    def test_delivered_calls_not_coalesced(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        user.email = 'new@user.com'
+        user.save()
+        self.flush()
+
+        user.email = 'newer@user.com'
+        user.save()
+        self.assertEqual([{'id': user.id,
+                           'old_email': 'new@user.com',
+                           'full_name': '',
+                           'email': 'newer@user.com',
+                           'roles': [],
+                           'avatar_changed': False}],
+                         self.queued_payloads())
+
+    def test_deletion_request_kept(self):
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        self.hook.queue.all().delete()
+        UserModel.objects.filter(id=user.id).update(deletion_requested=True)
+        user_deletion_requested.send(UserModel, users=[user])
+
+        user.full_name = 'Harry'
+        user.save()
+
+        self.assertEqual([{'id': user.id,
+                           'old_email': 'test@user.com',
+                           'full_name': 'Harry',
+                           'email': 'test@user.com',
+                           'roles': [],
+                           'avatar_changed': False,
+                           'deletion_requested': True}],
+                         self.queued_payloads())
+
+    def test_flags_combined(self):
+        older = [{'id': 1, 'avatar_changed': True, 'deletion_requested': False},
+                 {'id': 1, 'avatar_changed': False, 'deletion_requested': True}]
+        merged = outbox.coalesce_user_modified(older, {'id': 1, 'avatar_changed': False})
+        self.assertTrue(merged['avatar_changed'])
+        self.assertTrue(merged['deletion_requested'])
+
+    def test_backoff_kept(self):
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        user.email = 'new@user.com'
+        user.save()
+        next_attempt_at = timezone.now() + datetime.timedelta(minutes=5)
+        self.hook.queue.update(attempts=3, error_code=502, error_msg='Bad Gateway',
+                               next_attempt_at=next_attempt_at)
+
+        user.full_name = 'Changed'
+        user.save()
+
+        call = self.hook.queue.get()
+        self.assertEqual('Changed', json.loads(call.payload)['full_name'])
+        self.assertEqual('test@user.com', json.loads(call.payload)['old_email'])
+        self.assertEqual(3, call.attempts)
+        self.assertEqual(502, call.error_code)
+        self.assertEqual('Bad Gateway', call.error_msg)
+        self.assertEqual(next_attempt_at, call.next_attempt_at)
+
+
+class WebhookBatchTest(WebhookBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.hook.max_batch_size = 2
         self.hook.save()
 
-        # Should be flushed 15 seconds after last flush.
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(datetime.timedelta(seconds=15), flush_delay)
+    def queue_calls(self, count: int):
+        for idx in range(count):
+            models.WebhookQueuedCall.objects.create(webhook=self.hook, payload=json.dumps(idx))
+
+    @responses.activate
+    def test_batches_in_order(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.queue_calls(5)
 
-        flush_time = self.hook.flush_time(now=now)
-        self.assertCloseTo(flush_time, now, seconds=12)
+        self.hook.flush()
+        self.assertEqual(0, self.hook.queue_size())
+        self.assertEqual([[0, 1], [2, 3], [4]],
+                         [json.loads(call.request.body) for call in responses.calls])
 
-    def test_more_queued_47_min_ago_flushed_3_sec_ago(self):
-        now = timezone.now()
-        # Oldest queued call was queued 47 minutes ago.
-        self.queue_call(now - datetime.timedelta(minutes=47))
-        # But there are others that are more recent. They should not have an effect.
-        self.queue_call(now - datetime.timedelta(minutes=13))
-        self.queue_call(now - datetime.timedelta(seconds=10))
-
-        # Last flush was 3 seconds ago.
-        self.hook.last_flush_attempt = now - datetime.timedelta(seconds=3)
+        # Every batch is signed as a whole.
+        for call in responses.calls:
+            mac = hmac.new(self.hook.secret.encode(), call.request.body, hashlib.sha256)
+            self.assertEqual(mac.hexdigest(), call.request.headers['X-Webhook-HMAC'])
+
+    @responses.activate
+    def test_failed_batch_stays_queued(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'error'}, status=500)
+        self.queue_calls(3)
+
+        self.hook.flush()
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual([0, 1], json.loads(responses.calls[0].request.body))
+
+        queue = list(self.hook.queue.order_by('created', 'id'))
+        self.assertEqual([1, 1, 0], [call.attempts for call in queue])
+        self.assertEqual([500, 500, 0], [call.error_code for call in queue])
+        self.hook.refresh_from_db()
+        self.assertEqual(queue[0].next_attempt_at, self.hook.postponed_until)
+
+    @responses.activate
+    def test_single_event_format_by_default(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.hook.max_batch_size = 1
+        self.hook.save()
+        self.queue_calls(2)
+
+        self.hook.flush()
+        self.assertEqual([0, 1], [json.loads(call.request.body) for call in responses.calls])
+
+
+@override_settings(WEBHOOK_COMPRESSION_MIN_SIZE=100)
+class WebhookCompressionTest(WebhookBaseTest):
+    def queue_call(self, payload: str):
+        models.WebhookQueuedCall.objects.create(webhook=self.hook, payload=payload)
+
+    @responses.activate
+    def test_gzip(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.hook.compression = models.COMPRESSION_GZIP
+        self.hook.save()
+        payload = json.dumps({'full_name': 'ဖန်စီဘောင်းဘီ' * 20})
+        self.queue_call(payload)
+
+        self.hook.flush()
+        self.assertEqual(1, len(responses.calls))
+        request = responses.calls[0].request
+        self.assertEqual('gzip', request.headers['Content-Encoding'])
+        body = gzip.decompress(request.body)
+        self.assertEqual(payload.encode(), body)
+        self.assertLess(len(request.body), len(body))
+
+        # The HMAC is computed over the uncompressed body.
+        mac = hmac.new(self.hook.secret.encode(), body, hashlib.sha256)
+        self.assertEqual(mac.hexdigest(), request.headers['X-Webhook-HMAC'])
+
+    @responses.activate
+    def test_deflate(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.hook.compression = models.COMPRESSION_DEFLATE
+        self.hook.save()
+        payload = json.dumps(['payload'] * 20)
+        self.queue_call(payload)
+
+        self.hook.flush()
+        request = responses.calls[0].request
+        self.assertEqual('deflate', request.headers['Content-Encoding'])
+        self.assertEqual(payload.encode(), zlib.decompress(request.body))
+
+    @responses.activate
+    def test_small_payload_uncompressed(self):
+        responses.add(responses.POST, self.HOOK_URL, json={'status': 'success'}, status=200)
+        self.hook.compression = models.COMPRESSION_GZIP
+        self.hook.save()
+        self.queue_call('"payload"')
+
+        self.hook.flush()
+        request = responses.calls[0].request
+        self.assertNotIn('Content-Encoding', request.headers)
+        self.assertEqual(b'"payload"', request.body)
+
+
+class UserChangeTrackingTest(WebhookBaseTest):
+    def setUp(self):
+        super().setUp()
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        self.user_id = user.id
+
+    def test_save_queries(self):
+        user = UserModel.objects.get(id=self.user_id)
+        user.full_name = 'Harry de Bøker'
+
+        # UPDATE of the user, SELECT of the webhooks, INSERT of the queued call.
+        with self.assertNumQueries(3):
+            user.save()
+        self.assertTrue(user.webhook_user_modified)
+        self.assertEqual(['Harry de Bøker'],
+                         [json.loads(call.payload)['full_name'] for call in self.hook.queue.all()])
+
+    def test_unmodified_save_queries(self):
+        user = UserModel.objects.get(id=self.user_id)
+        user.login_count += 1
+        with self.assertNumQueries(1):
+            user.save()
+        self.assertFalse(user.webhook_user_modified)
+        self.assertEqual(0, self.hook.queue_size())
+
+    def test_saved_values_are_remembered(self):
+        user = UserModel.objects.get(id=self.user_id)
+        user.email = 'new@user.com'
+        user.save()
+        user.email = 'newer@user.com'
+        user.save()
+
+        self.assertEqual(['test@user.com', 'new@user.com'],
+                         [json.loads(call.payload)['old_email']
+                          for call in self.hook.queue.order_by('created', 'id')])
+
+    def test_not_loaded_from_db(self):
+        user = UserModel.objects.get(id=self.user_id)
+        copy = UserModel(**{field.attname: getattr(user, field.attname)
+                            for field in UserModel._meta.concrete_fields})
+        copy.full_name = 'Copy'
+        copy.save()
+        self.assertTrue(copy.webhook_user_modified)
+        self.assertEqual(1, self.hook.queue_size())
+
+    def test_deferred_fields(self):
+        user = UserModel.objects.only('id', 'email').get(id=self.user_id)
+        user.full_name = 'Deferred'
+        user.save(update_fields={'full_name'})
+        self.assertTrue(user.webhook_user_modified)
+        self.assertEqual(1, self.hook.queue_size())
+
+
+class WebhookDeltaPayloadTest(WebhookBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.hook.payload_version = 2
+        self.hook.save()
+
+    def queued_payloads(self, hook=None) -> list:
+        hook = hook or self.hook
+        return [json.loads(call.payload) for call in hook.queue.order_by('created', 'id')]
+
+    def test_changed_fields_only(self):
+        user = UserModel.objects.create_user('test@user.com', '123456', full_name='Harry')
+        role = Role.objects.create(name='cloud_subscriber', is_public=True, is_active=True)
+
+        user.email = 'new@user.com'
+        user.save()
+        user.roles.add(role)
+        my_dir = pathlib.Path(__file__).absolute().parent
+        with self.settings(MEDIA_ROOT=my_dir / 'media'):
+            user.avatar = 'badges/t-rex.png'
+            user.full_name = 'Harald'
+            user.save()
+
+        self.assertEqual([
+            {'version': 2,
+             'id': user.id,
+             'old_email': 'test@user.com',
+             'changed_fields': ['email'],
+             'email': 'new@user.com'},
+            {'version': 2,
+             'id': user.id,
+             'old_email': 'new@user.com',
+             'changed_fields': ['roles'],
+             'roles': ['cloud_subscriber']},
+            {'version': 2,
+             'id': user.id,
+             'old_email': 'new@user.com',
+             'changed_fields': ['avatar', 'full_name'],
+             'full_name': 'Harald'},
+        ], self.queued_payloads())
+
+    def test_versions_per_hook(self):
+        full_hook = models.Webhook.objects.create(name='full', url=self.HOOK_URL)
+        user = UserModel.objects.create_user('test@user.com', '123456')
+        user.full_name = 'Harry'
+        user.save()
+
+        self.assertEqual([{'id': user.id,
+                           'old_email': 'test@user.com',
+                           'full_name': 'Harry',
+                           'email': 'test@user.com',
+                           'roles': [],
+                           'avatar_changed': False}],
+                         self.queued_payloads(full_hook))
+        self.assertEqual([{'version': 2,
+                           'id': user.id,
+                           'old_email': 'test@user.com',
+                           'changed_fields': ['full_name'],
+                           'full_name': 'Harry'}],
+                         self.queued_payloads())
+
+    def test_coalesce(self):
+        self.hook.coalesce_events = True
         self.hook.save()
+        user = UserModel.objects.create_user('test@user.com', '123456')
+
+        user.email = 'new@user.com'
+        user.save()
+        user.full_name = 'Harry'
+        user.save()
+        user.email = 'newer@user.com'
+        user.save()
+
+        self.assertEqual([{'version': 2,
+                           'id': user.id,
+                           'old_email': 'test@user.com',
+                           'changed_fields': ['email', 'full_name'],
+                           'email': 'newer@user.com',
+                           'full_name': 'Harry'}],
+                         self.queued_payloads())
 
-        # Should be flushed 15 seconds after last flush.
-        flush_delay = self.hook.flush_delay(now=now)
-        self.assertEqual(datetime.timedelta(seconds=15), flush_delay)
 
-        flush_time = self.hook.flush_time(now=now)
-        self.assertCloseTo(flush_time, now, seconds=12)
+class WebhookFilterTest(WebhookBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.subscriber = Role.objects.create(name='cloud_subscriber', is_public=True)
+        self.network = Role.objects.create(name='network_member', is_public=True)
+        self.user = UserModel.objects.create_user('test@user.com', '123456')
+
+    def queued_payloads(self) -> list:
+        return [json.loads(call.payload) for call in self.hook.queue.order_by('created', 'id')]
+
+    def test_role_events_with_role_filter(self):
+        self.hook.event_types = 'role_granted role_revoked'
+        self.hook.role_filter = 'cloud_subscriber'
+        self.hook.save()
+
+        self.user.email = 'new@user.com'
+        self.user.save()
+        self.user.roles.add(self.network)
+        self.assertEqual(0, self.hook.queue_size())
+
+        self.user.roles.add(self.subscriber)
+        self.user.roles.remove(self.network)
+        self.user.roles.remove(self.subscriber)
+        self.assertEqual([['cloud_subscriber', 'network_member'], []],
+                         [payload['roles'] for payload in self.queued_payloads()])
+
+    def test_event_types(self):
+        self.hook.event_types = 'email_changed role_granted role_revoked'
+        self.hook.save()
+
+        my_dir = pathlib.Path(__file__).absolute().parent
+        with self.settings(MEDIA_ROOT=my_dir / 'media'):
+            self.user.avatar = 'badges/t-rex.png'
+            self.user.full_name = 'Harry'
+            self.user.save()
+        self.assertEqual(0, self.hook.queue_size())
+
+        self.user.email = 'new@user.com'
+        self.user.save()
+        self.assertEqual(['new@user.com'],
+                         [payload['email'] for payload in self.queued_payloads()])
+
+    def test_role_filter_on_other_events(self):
+        self.hook.role_filter = 'cloud_subscriber'
+        self.hook.save()
+        other = UserModel.objects.create_user('other@user.com', '123456', nickname='other')
+        self.user.roles.add(self.subscriber)
+        self.hook.queue.all().delete()
+
+        self.user.full_name = 'Subscriber'
+        self.user.save()
+        other.full_name = 'Not a subscriber'
+        other.save()
+        self.assertEqual(['Subscriber'],
+                         [payload['full_name'] for payload in self.queued_payloads()])
+
+    def test_deletion_requested(self):
+        from bid_main import admin as bid_main_admin
+
+        deletion_hook = models.Webhook.objects.create(
+            name='deletions', url=self.HOOK_URL, event_types='deletion_requested')
+        other_hook = models.Webhook.objects.create(
+            name='emails', url=self.HOOK_URL, event_types='email_changed')
+
+        class FakeModelAdmin:
+            def message_user(self, *args, **kwargs):
+                pass
+
+        request = mock.Mock()
+        request.user = UserModel.objects.create_superuser(
+            'admin@user.com', '123456', nickname='admin')
+        users = UserModel.objects.filter(id=self.user.id)
+        bid_main_admin.request_deletion(FakeModelAdmin(), request, users)
+        # Requesting deletion again should not call the webhooks again.
+        bid_main_admin.request_deletion(FakeModelAdmin(), request, users)
+
+        expect = {'id': self.user.id,
+                  'old_email': 'test@user.com',
+                  'full_name': '',
+                  'email': 'test@user.com',
+                  'roles': [],
+                  'avatar_changed': False,
+                  'deletion_requested': True}
+        self.assertEqual([expect], [json.loads(call.payload) for call in deletion_hook.queue.all()])
+        self.assertEqual([expect], self.queued_payloads())
+        self.assertEqual(0, other_hook.queue_size())
+
+    def test_deletion_request_coalesced(self):
+        from bid_main import admin as bid_main_admin
+
+        self.hook.coalesce_events = True
+        self.hook.save()
+        delta_hook = models.Webhook.objects.create(
+            name='delta', url=self.HOOK_URL, coalesce_events=True,
+            payload_version=payloads.PAYLOAD_DELTA)
+
+        request = mock.Mock()
+        request.user = UserModel.objects.create_superuser(
+            'admin@user.com', '123456', nickname='admin')
+        bid_main_admin.request_deletion(mock.Mock(), request,
+                                        UserModel.objects.filter(id=self.user.id))
+        self.user.refresh_from_db()
+        self.user.full_name = 'Harry'
+        self.user.save()
+
+        self.assertEqual([{'id': self.user.id,
+                           'old_email': 'test@user.com',
+                           'full_name': 'Harry',
+                           'email': 'test@user.com',
+                           'roles': [],
+                           'avatar_changed': False,
+                           'deletion_requested': True}],
+                         self.queued_payloads())
+        self.assertEqual([{'version': 2,
+                           'id': self.user.id,
+                           'old_email': 'test@user.com',
+                           'changed_fields': ['deletion_requested', 'full_name'],
+                           'deletion_requested': True,
+                           'full_name': 'Harry'}],
+                         [json.loads(call.payload) for call in delta_hook.queue.all()])
+
+    def test_validate_event_types(self):
+        self.hook.event_types = 'email_changed user_deleted'
+        with self.assertRaises(ValidationError):
+            self.hook.full_clean()
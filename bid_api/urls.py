@@ -1,6 +1,6 @@
 from django.conf.urls import url
 
-from .views import info, badger, create_user, authenticate
+from .views import info, badger, create_user, authenticate, webhooks
 
 app_name = 'bid_api'
 urlpatterns = [
@@ -8,6 +8,7 @@ urlpatterns = [
     url(r'^me$', info.user_info),
     url(r'^user/(?P<user_id>\d+)$', info.UserInfoView.as_view(), name='user-info-by-id'),
     url(r'^user/(?P<user_id>\d+)/avatar$', info.UserAvatarView.as_view(), name='user-avatar'),
+    url(r'^avatars$', info.BulkAvatarView.as_view(), name='avatars'),
     url(r'^badges/(?P<user_id>\d+)$', info.UserBadgeView.as_view(), name='user-badges-by-id'),
     url(r'^badges/(?P<user_id>\d+)/html$', info.BadgesHTMLView.as_view(), name='user-badges-html'),
     url(r'^badges/(?P<user_id>\d+)/html/(?P<size>[a-z])$', info.BadgesHTMLView.as_view(),
@@ -17,9 +18,11 @@ urlpatterns = [
         badger.BadgerView.as_view(action='grant'), name='badger_grant'),
     url(r'^badger/revoke/(?P<badge>[^/]+)/(?P<email_or_uid>[^/]+)$',
         badger.BadgerView.as_view(action='revoke'), name='badger_revoke'),
+    url(r'^badger/bulk$', badger.BulkBadgerView.as_view(), name='badger_bulk'),
     url(r'^check-user/(?P<email>[^/]+)$', create_user.CheckUserView.as_view(), name='check_user'),
     url(r'^create-user/?$', create_user.CreateUserView.as_view(), name='create_user'),
     url(r'^authenticate/?$', authenticate.AuthenticateView.as_view(), name='authenticate'),
+    url(r'^webhooks/metrics$', webhooks.WebhookMetricsView.as_view(), name='webhook-metrics'),
 ]
 
 # noinspection PyUnresolvedReferences
@@ -2,8 +2,11 @@
 Badger service functionality.
 """
 
+import json
 import logging
+import typing
 
+from django.conf import settings
 from django.db import transaction, IntegrityError
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.contrib.admin.models import LogEntry, ADDITION, DELETION
@@ -12,7 +15,8 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.decorators import method_decorator
 from oauth2_provider.decorators import protected_resource
 
-from bid_main import models as bid_main_models
+from bid_main import badger, models as bid_main_models, role_updates
+from .. import roles as role_changes
 from ..http_responses import HttpResponseUnprocessableEntity
 from .abstract import AbstractAPIView
 
@@ -27,7 +31,8 @@ class BadgerView(AbstractAPIView):
     def post(self, request, badge: str, email_or_uid: str) -> HttpResponse:
         return self.do_badger(request, badge, email_or_uid)
 
-    @transaction.atomic()
+    # Saving the user below also stores the new roles, in a single save.
+    @role_updates.deferred_role_updates()
     def do_badger(self, request, badge: str, email_or_uid: str) -> HttpResponse:
         """Performs the actual badger service, can be called without OAuth token
 
@@ -37,10 +42,7 @@ class BadgerView(AbstractAPIView):
         action = self.action
 
         # See which roles this user can manage.
-        may_manage = {}
-        for role in user.roles.all():
-            for manage_role in role.may_manage_roles.all():
-                may_manage[manage_role.name] = manage_role
+        may_manage = badger.may_manage(user)
 
         if badge not in may_manage:
             log.warning(
@@ -109,3 +111,129 @@ class BadgerView(AbstractAPIView):
             change_message=change_message)
 
         return JsonResponse({'result': 'ok'})
+
+
+class BulkBadgerView(AbstractAPIView):
+    """Grants and revokes many roles in one call.
+
+    Takes a JSON document like
+    `{"operations": [{"action": "grant", "badge": "cloud_subscriber", "user": "a@example.com"}]}`,
+    where `user` is an email address or user ID, and returns the result of
+    every operation, in the same order: "ok", "no-op", "forbidden",
+    "unknown-user" or "invalid". The operations are performed in order, in
+    a single transaction.
+
+    The role changes are written to the database directly, so every user is
+    saved only once, and webhooks get a single call per user.
+    """
+
+    log = log.getChild('BulkBadgerView')
+    actions = {'grant': ADDITION, 'revoke': DELETION}
+
+    @method_decorator(protected_resource(scopes=['badger']))
+    def post(self, request) -> HttpResponse:
+        try:
+            doc = json.loads(request.body)
+            operations = list(doc['operations'])
+        except (ValueError, TypeError, KeyError, AttributeError) as ex:
+            self.log.debug('invalid bulk badger request: %s', ex)
+            return JsonResponse({'_message': 'expected JSON document with "operations" list'},
+                                status=400)
+
+        if len(operations) > settings.BADGER_BULK_MAX_OPERATIONS:
+            return JsonResponse({'_message': f'at most {settings.BADGER_BULK_MAX_OPERATIONS} '
+                                             f'operations can be performed at once'},
+                                status=400)
+
+        results = self.do_bulk(request.user, operations)
+        return JsonResponse({'results': results})
+
+    @staticmethod
+    def parse_operation(operation) -> typing.Optional[typing.Tuple[str, str, str]]:
+        """Returns (action, badge, email or user ID), or None when invalid."""
+        if not isinstance(operation, dict):
+            return None
+        action = operation.get('action')
+        badge = operation.get('badge')
+        email_or_uid = operation.get('user')
+        if action not in BulkBadgerView.actions or not isinstance(badge, str):
+            return None
+        if isinstance(email_or_uid, int) and not isinstance(email_or_uid, bool):
+            email_or_uid = str(email_or_uid)
+        if not isinstance(email_or_uid, str) or not email_or_uid:
+            return None
+        return action, badge, email_or_uid
+
+    @transaction.atomic()
+    def do_bulk(self, user, operations: list) -> typing.List[dict]:
+        """Performs the operations on behalf of the user, returning their results."""
+        parsed = [self.parse_operation(operation) for operation in operations]
+        valid = [operation for operation in parsed if operation is not None]
+
+        # Check each badge only once.
+        may_manage = badger.may_manage(user)
+        roles = {}
+        for badge in {op_badge for _action, op_badge, _email_or_uid in valid}:
+            role = may_manage.get(badge)
+            if role is None:
+                self.log.warning('User %s tried to change role %r, is not allowed to do that',
+                                 user, badge)
+            elif not role.is_active:
+                self.log.warning('User %s tried to change non-active role %r', user, badge)
+            else:
+                roles[badge] = role
+
+        target_users = role_changes.find_users({
+            email_or_uid
+            for _action, op_badge, email_or_uid in valid
+            if op_badge in roles
+        })
+        old_memberships = role_changes.memberships(
+            {target_user.id for target_user in target_users.values()},
+            {role.id for role in roles.values()})
+
+        # Perform the operations on a copy of the memberships, so that
+        # each operation sees the result of the earlier ones.
+        memberships = set(old_memberships)
+        results = []
+        log_entries = []
+        for operation, parsed_op in zip(operations, parsed):
+            result = {'result': 'invalid'}
+            if isinstance(operation, dict):
+                result.update((key, operation.get(key)) for key in ('action', 'badge', 'user'))
+            results.append(result)
+            if parsed_op is None:
+                continue
+
+            action, badge, email_or_uid = parsed_op
+            role = roles.get(badge)
+            if role is None:
+                result['result'] = 'forbidden'
+                continue
+            target_user = target_users.get(email_or_uid)
+            if target_user is None:
+                self.log.warning('User %s tried to %s role %r to nonexistent user %s',
+                                 user, action, badge, email_or_uid)
+                result['result'] = 'unknown-user'
+                continue
+
+            membership = (target_user.id, role.id)
+            if (membership in memberships) == (action == 'grant'):
+                result['result'] = 'no-op'
+                continue
+
+            self.log.info('User %s %ss role %r to user %s', user, action, badge, target_user.email)
+            if action == 'grant':
+                memberships.add(membership)
+                change_message = f'Granted role {badge}.'
+            else:
+                memberships.discard(membership)
+                change_message = f'Revoked role {badge}.'
+            result['result'] = 'ok'
+            log_entries.append(role_changes.log_entry(
+                user, target_user, self.actions[action], change_message))
+
+        role_changes.apply_changes(memberships - old_memberships, old_memberships - memberships,
+                                   set(target_users.values()))
+        LogEntry.objects.bulk_create(log_entries)
+        return results
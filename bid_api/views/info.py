@@ -1,6 +1,8 @@
+import json
 import logging
 import typing
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.http import (JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound)
 from django.shortcuts import render, redirect
@@ -159,6 +161,50 @@ class UserAvatarView(AbstractAPIView):
         return redirect(dbuser.avatar.thumbnail_url())
 
 
+class BulkAvatarView(AbstractAPIView):
+    """Avatar URLs for many users at once.
+
+    This is a public endpoint. It takes a JSON document like
+    `{"user_ids": [1, 2, 3], "size": 64}`, where `size` is optional, and
+    returns a mapping from user ID to the absolute URL of the avatar
+    thumbnail. Unknown user IDs are not included in the response.
+
+    Missing thumbnails are generated while handling the request, which is why
+    only AVATAR_BULK_MAX_USERS users can be requested at once.
+    """
+
+    log = log.getChild('BulkAvatarView')
+
+    def post(self, request) -> HttpResponse:
+        try:
+            doc = json.loads(request.body)
+            user_ids = doc['user_ids']
+            size = int(doc.get('size') or 0)
+            # Anything else would be iterated; "123" would become the IDs 1, 2 and 3.
+            if not isinstance(user_ids, list) or not all(
+                    isinstance(user_id, int) and not isinstance(user_id, bool)
+                    for user_id in user_ids):
+                raise TypeError('"user_ids" must be a list of integers')
+        except (ValueError, TypeError, KeyError, AttributeError) as ex:
+            self.log.debug('invalid bulk avatar request: %s', ex)
+            return JsonResponse({'_message': 'expected JSON document with "user_ids" list '
+                                             'of integers'},
+                                status=400)
+        user_ids = set(user_ids)
+
+        if size and size not in settings.AVATAR_ALLOWED_SIZES_PIXELS:
+            sizes = sorted(settings.AVATAR_ALLOWED_SIZES_PIXELS)
+            return JsonResponse({'_message': f'size must be one of {sizes}'}, status=400)
+        if len(user_ids) > settings.AVATAR_BULK_MAX_USERS:
+            return JsonResponse({'_message': f'at most {settings.AVATAR_BULK_MAX_USERS} '
+                                             f'users can be requested at once'},
+                                status=400)
+
+        users = UserModel.objects.filter(id__in=user_ids).only('id', 'avatar')
+        avatars = {str(user.id): user.avatar.thumbnail_url(size) for user in users}
+        return JsonResponse({'avatars': avatars})
+
+
 class StatsView(AbstractAPIView):
     """Return aggregate statistics."""
 
@@ -0,0 +1,30 @@
+"""Webhook delivery metrics, for monitoring."""
+
+import logging
+
+from django.http import HttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from oauth2_provider.decorators import protected_resource
+
+from .. import metrics
+from .abstract import AbstractAPIView
+
+log = logging.getLogger(__name__)
+
+
+class WebhookMetricsView(AbstractAPIView):
+    """Returns the delivery metrics of all webhooks.
+
+    Returns JSON by default, and the Prometheus text format with ?format=prometheus.
+    """
+
+    @method_decorator(protected_resource(scopes=['metrics']))
+    def get(self, request) -> HttpResponse:
+        collected = metrics.collect()
+        if request.GET.get('format') == 'prometheus':
+            return HttpResponse(metrics.prometheus_text(collected),
+                                content_type='text/plain; version=0.0.4; charset=utf-8')
+        return JsonResponse({
+            'latency_buckets': list(metrics.LATENCY_BUCKETS),
+            'webhooks': collected,
+        })
@@ -8,7 +8,7 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
-from . import models
+from . import models, role_updates, signals
 from .admin_decorators import short_description
 
 # Configure the admin site. Easier than creating our own AdminSite subclass.
@@ -72,7 +72,9 @@ def deactivate(modeladmin, request, queryset):
 
 @short_description('Request deletion of selected users')
 def request_deletion(modeladmin, request, queryset):
+    newly_requested = list(queryset.filter(deletion_requested=False))
     matched_count: int = queryset.update(deletion_requested=True)
+    signals.user_deletion_requested.send(models.User, users=newly_requested)
     _add_change_log(queryset, request, "Marked user as 'deletion requested'")
     modeladmin.message_user(request, f'{matched_count} users marked for deletion',
                             level=messages.WARNING)
@@ -180,6 +182,11 @@ class UserAdmin(BaseUserAdmin):
         email = urllib.parse.quote(user.email)
         return format_html(template, email, email, email, email)
 
+    def save_related(self, request, form, formsets, change):
+        # Update the user once for all changes to its roles.
+        with role_updates.deferred_role_updates():
+            super().save_related(request, form, formsets, change)
+
     def save_formset(self, request, form, formset, change):
         """Sets the note.creator for new notes to the current user."""
         if not issubclass(formset.model, models.UserNote):
@@ -0,0 +1,151 @@
+"""Which roles badger callers may grant and revoke.
+
+The callers of the badger API are a handful of service accounts that make
+many calls, so their permissions are cached:
+
+- per caller, the IDs of its roles;
+- per set of role IDs, the roles that may be managed with them.
+
+Both are keyed by the version of the role catalog, which is bumped whenever
+a role, the roles it may manage, or the roles of a caller change. Which
+users are callers is cached too, so that role changes of other users do not
+bump the version. This way permission checks cost no queries at all once the
+cache is warm.
+"""
+
+import hashlib
+import logging
+import time
+import typing
+
+from django.core.cache import cache
+from django.db import transaction
+
+log = logging.getLogger(__name__)
+
+CACHE_NAMESPACE = 'badger'
+_VERSION_KEY = f'{CACHE_NAMESPACE}:catalog-version'
+
+
+def _catalog_version() -> int:
+    if hasattr(cache, 'bump_namespace'):
+        # Invalidated by bumping the namespace, so the version never changes.
+        return 1
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        # Never bumped, or the version was evicted. Start at a version that
+        # no cached entry can have.
+        version = _new_version()
+        if not cache.add(_VERSION_KEY, version, timeout=None):
+            version = cache.get(_VERSION_KEY, version)
+    return version
+
+
+def _new_version(current: int = 0) -> int:
+    return max(current + 1, int(time.time() * 1_000_000))
+
+
+def _caller_key(version: int, user_id: int) -> str:
+    return f'{CACHE_NAMESPACE}:caller-roles:{version}:{user_id}'
+
+
+def _may_manage_key(version: int, role_ids: typing.FrozenSet[int]) -> str:
+    ids_hash = hashlib.sha1(','.join(str(role_id) for role_id in sorted(role_ids)).encode())
+    return f'{CACHE_NAMESPACE}:may-manage:{version}:{ids_hash.hexdigest()}'
+
+
+def _callers(version: int) -> typing.Tuple[typing.FrozenSet[int], typing.FrozenSet[int]]:
+    """Returns the IDs of the roles that may manage roles, and of the users that have them."""
+    key = f'{CACHE_NAMESPACE}:callers:{version}'
+    callers = cache.get(key)
+    if callers is None:
+        from .models import Role, User
+
+        role_ids = frozenset(Role.objects
+                             .filter(may_manage_roles__isnull=False)
+                             .order_by()
+                             .values_list('id', flat=True))
+        user_ids = frozenset(User.roles.through.objects
+                             .filter(role_id__in=role_ids)
+                             .values_list('user_id', flat=True))
+        callers = (role_ids, user_ids)
+        cache.set(key, callers, timeout=None)
+    return callers
+
+
+def caller_role_ids(user) -> typing.FrozenSet[int]:
+    """Returns the IDs of the user's roles, cached.
+
+    Users that are not callers may manage no roles, so for them this is empty.
+    """
+    version = _catalog_version()
+    _, caller_ids = _callers(version)
+    if user.id not in caller_ids:
+        return frozenset()
+    key = _caller_key(version, user.id)
+    role_ids = cache.get(key)
+    if role_ids is None:
+        role_ids = frozenset(user.roles.values_list('id', flat=True))
+        cache.set(key, role_ids, timeout=None)
+    return role_ids
+
+
+def may_manage(user) -> dict:
+    """Returns the roles the user may grant and revoke, as {name: Role}.
+
+    Inactive roles are included; the caller has to check `is_active`.
+    """
+    from .models import Role
+
+    role_ids = caller_role_ids(user)
+    if not role_ids:
+        return {}
+    key = _may_manage_key(_catalog_version(), role_ids)
+    roles = cache.get(key)
+    if roles is None:
+        roles = {role.name: role
+                 for role in Role.objects.filter(managers__in=role_ids).distinct()}
+        log.debug('caching %d roles manageable by roles %s', len(roles), sorted(role_ids))
+        cache.set(key, roles, timeout=None)
+    return roles
+
+
+def _bump_version():
+    bump_namespace = getattr(cache, 'bump_namespace', None)
+    if bump_namespace is not None:
+        bump_namespace(CACHE_NAMESPACE)
+        return
+
+    # Without namespace support, change the version that is part of every key.
+    # Not with incr(), as that does not keep the timeout on every backend.
+    cache.set(_VERSION_KEY, _new_version(_catalog_version()), timeout=None)
+
+
+def invalidate():
+    """Forgets all cached permissions, in every process.
+
+    Inside a transaction this happens when it commits, so that no other
+    process can cache what it read from the database before the change was
+    committed.
+    """
+    transaction.on_commit(_bump_version)
+
+
+def roles_changed(user_ids: typing.Optional[typing.Iterable[int]],
+                  role_ids: typing.Optional[typing.Iterable[int]] = None):
+    """Forgets the cached permissions when the role changes affect callers.
+
+    That is when any of the users is a caller, or any of the roles may manage
+    roles, as that makes the users callers. For other users this costs no
+    queries once the cache is warm.
+
+    :param user_ids: the users whose roles changed, or None when unknown.
+    :param role_ids: the roles that were granted or revoked, or None when
+        unknown; only roles that were granted matter.
+    """
+    if user_ids is None:
+        invalidate()
+        return
+    managing_role_ids, caller_ids = _callers(_catalog_version())
+    if not caller_ids.isdisjoint(user_ids) or not managing_role_ids.isdisjoint(role_ids or ()):
+        invalidate()
@@ -0,0 +1,312 @@
+"""Two-tier cache backend.
+
+Layers a bounded in-process LRU cache (L1) over a shared cache (L2), so that
+frequently read keys do not cost a round-trip to the shared cache every time.
+The L2 cache is referred to by its alias in settings.CACHES:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'bid_main.cache.TwoTierCache',
+            'LOCATION': 'shared',  # Alias of the L2 cache.
+            'OPTIONS': {
+                'L1_MAX_ENTRIES': 1000,
+                'L1_TIMEOUT': 60,
+                'NAMESPACE_SYNC_INTERVAL': 2,
+            },
+        },
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'cache',
+        },
+    }
+
+Writes and deletes go to both tiers, but only the L1 of the current process
+is updated. Other processes can see the old value until their L1 entry
+expires after L1_TIMEOUT seconds. When that is not acceptable, use a
+namespace: the part of a key before the first colon. Calling
+`bump_namespace(namespace)` invalidates all keys in that namespace, in both
+tiers and in every process; other processes notice the bump within
+NAMESPACE_SYNC_INTERVAL seconds.
+
+L2 keys consist of the namespace version and the key as made by this backend,
+so including its KEY_PREFIX and VERSION.
+"""
+
+import threading
+import time
+import typing
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from .lru import LRUCache
+
+_MISSING = object()
+_NAMESPACE_KEY_PREFIX = 'two-tier-namespace:'
+
+
+class _SharedState:
+    """Process-wide state of a two-tier cache.
+
+    Django creates a cache backend instance per thread, but the L1 cache and
+    its statistics should be shared by all threads of a process.
+    """
+
+    def __init__(self, max_entries: int, timeout: float):
+        self.l1 = LRUCache(max_entries, timeout)
+        self.lock = threading.Lock()
+        self.namespaces: typing.Dict[str, int] = {}
+        self.namespaces_synced_at = 0.0
+        self.stats = {
+            'l1': {'hits': 0, 'misses': 0},
+            'l2': {'hits': 0, 'misses': 0},
+        }
+
+    def count(self, tier: str, hits: int, misses: int):
+        with self.lock:
+            self.stats[tier]['hits'] += hits
+            self.stats[tier]['misses'] += misses
+
+
+_last_namespace_version = 0
+_namespace_version_lock = threading.Lock()
+
+
+def _new_namespace_version(current: typing.Optional[int] = None) -> int:
+    """Returns a namespace version higher than any handed out before.
+
+    Based on the clock, so that a namespace whose version was lost from L2
+    (for example culled by the database cache) does not start over at an old
+    version, which would make stale entries valid again.
+    """
+    global _last_namespace_version
+
+    with _namespace_version_lock:
+        version = max(int(time.time() * 1_000_000), _last_namespace_version + 1, (current or 0) + 1)
+        _last_namespace_version = version
+    return version
+
+
+_shared_states: typing.Dict[typing.Tuple, _SharedState] = {}
+_shared_states_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    def __init__(self, location: str, params: dict):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = location
+        self._l1_timeout = float(options.get('L1_TIMEOUT', 60))
+        self._sync_interval = float(options.get('NAMESPACE_SYNC_INTERVAL', 2))
+
+        state_key = (location, self.key_prefix, self.version)
+        with _shared_states_lock:
+            try:
+                self._state = _shared_states[state_key]
+            except KeyError:
+                max_entries = int(options.get('L1_MAX_ENTRIES', 1000))
+                self._state = _SharedState(max_entries, self._l1_timeout)
+                _shared_states[state_key] = self._state
+
+    @property
+    def l2(self) -> BaseCache:
+        return caches[self._l2_alias]
+
+    @property
+    def _l1(self) -> LRUCache:
+        return self._state.l1
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters per tier, for this process."""
+        with self._state.lock:
+            return {
+                'l1': dict(self._state.stats['l1'], size=len(self._l1)),
+                'l2': dict(self._state.stats['l2']),
+            }
+
+    # Namespace handling.
+
+    @staticmethod
+    def _namespace(key: str) -> str:
+        return key.split(':', 1)[0] if ':' in key else ''
+
+    def _namespace_version(self, namespace: str) -> int:
+        """Returns the current version of the namespace.
+
+        Versions are stored in L2, but only synced every NAMESPACE_SYNC_INTERVAL seconds.
+        """
+        state = self._state
+        now = time.monotonic()
+        with state.lock:
+            must_sync = (namespace not in state.namespaces
+                         or now - state.namespaces_synced_at >= self._sync_interval)
+            if not must_sync:
+                return state.namespaces[namespace]
+            known = set(state.namespaces) | {namespace}
+
+        l2_keys = {self._namespace_key(ns): ns for ns in known}
+        found = self.l2.get_many(l2_keys.keys())
+        for l2_key in l2_keys.keys() - found.keys():
+            # Never bumped, or the version was lost; start at a fresh version.
+            version = _new_namespace_version()
+            if not self.l2.add(l2_key, version, timeout=None):
+                version = self.l2.get(l2_key, version)
+            found[l2_key] = version
+
+        with state.lock:
+            for l2_key, ns in l2_keys.items():
+                state.namespaces[ns] = found[l2_key]
+            state.namespaces_synced_at = now
+            return state.namespaces[namespace]
+
+    def _namespace_key(self, namespace: str) -> str:
+        return self.make_key(_NAMESPACE_KEY_PREFIX + namespace)
+
+    def bump_namespace(self, namespace: str) -> int:
+        """Invalidates all keys in the namespace, in every process.
+
+        :return: the new version of the namespace.
+        """
+        l2_key = self._namespace_key(namespace)
+        # Not incr(), as that does not keep the timeout on every backend.
+        new_version = _new_namespace_version(self.l2.get(l2_key))
+        self.l2.set(l2_key, new_version, timeout=None)
+
+        with self._state.lock:
+            self._state.namespaces[namespace] = new_version
+        return new_version
+
+    # Key conversion.
+
+    def _keys(self, key: str, version=None) -> typing.Tuple[str, str, int]:
+        """Returns the L1 key, the L2 key, and the namespace version for the key."""
+        l1_key = self.make_key(key, version=version)
+        self.validate_key(l1_key)
+        ns_version = self._namespace_version(self._namespace(key))
+        return l1_key, f'{ns_version}:{l1_key}', ns_version
+
+    def _l1_timeout_for(self, timeout) -> typing.Optional[float]:
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return self._l1_timeout
+        return min(timeout, self._l1_timeout)
+
+    def _l1_get(self, l1_key: str, ns_version: int):
+        entry = self._l1.get(l1_key)
+        if entry is None or entry[0] != ns_version:
+            return _MISSING
+        return entry[1]
+
+    def _l1_set(self, l1_key: str, ns_version: int, value, timeout=DEFAULT_TIMEOUT):
+        l1_timeout = self._l1_timeout_for(timeout)
+        if l1_timeout <= 0:
+            self._l1.delete(l1_key)
+            return
+        self._l1.set(l1_key, (ns_version, value), l1_timeout)
+
+    # Django cache API.
+
+    def get(self, key, default=None, version=None):
+        l1_key, l2_key, ns_version = self._keys(key, version)
+        value = self._l1_get(l1_key, ns_version)
+        if value is not _MISSING:
+            self._state.count('l1', 1, 0)
+            return value
+        self._state.count('l1', 0, 1)
+
+        value = self.l2.get(l2_key, _MISSING)
+        if value is _MISSING:
+            self._state.count('l2', 0, 1)
+            return default
+        self._state.count('l2', 1, 0)
+        self._l1_set(l1_key, ns_version, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        l2_lookups = {}
+        for key in keys:
+            l1_key, l2_key, ns_version = self._keys(key, version)
+            value = self._l1_get(l1_key, ns_version)
+            if value is _MISSING:
+                l2_lookups[l2_key] = (key, l1_key, ns_version)
+            else:
+                found[key] = value
+        self._state.count('l1', len(found), len(l2_lookups))
+        if not l2_lookups:
+            return found
+
+        from_l2 = self.l2.get_many(l2_lookups.keys())
+        self._state.count('l2', len(from_l2), len(l2_lookups) - len(from_l2))
+        for l2_key, value in from_l2.items():
+            key, l1_key, ns_version = l2_lookups[l2_key]
+            self._l1_set(l1_key, ns_version, value)
+            found[key] = value
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l1_key, l2_key, ns_version = self._keys(key, version)
+        self.l2.set(l2_key, value, timeout=timeout)
+        self._l1_set(l1_key, ns_version, value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        l2_data = {}
+        for key, value in data.items():
+            l1_key, l2_key, ns_version = self._keys(key, version)
+            l2_data[l2_key] = value
+            self._l1_set(l1_key, ns_version, value, timeout)
+        return self.l2.set_many(l2_data, timeout=timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l1_key, l2_key, ns_version = self._keys(key, version)
+        added = self.l2.add(l2_key, value, timeout=timeout)
+        if added:
+            self._l1_set(l1_key, ns_version, value, timeout)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        l1_key, l2_key, ns_version = self._keys(key, version)
+        touched = self.l2.touch(l2_key, timeout=timeout)
+        value = self._l1_get(l1_key, ns_version)
+        if not touched:
+            self._l1.delete(l1_key)
+        elif value is not _MISSING:
+            self._l1_set(l1_key, ns_version, value, timeout)
+        return touched
+
+    def delete(self, key, version=None):
+        l1_key, l2_key, _ = self._keys(key, version)
+        self._l1.delete(l1_key)
+        self.l2.delete(l2_key)
+
+    def delete_many(self, keys, version=None):
+        l2_keys = []
+        for key in keys:
+            l1_key, l2_key, _ = self._keys(key, version)
+            self._l1.delete(l1_key)
+            l2_keys.append(l2_key)
+        self.l2.delete_many(l2_keys)
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def incr(self, key, delta=1, version=None):
+        # Counters have to be consistent between processes, so always use L2.
+        l1_key, l2_key, _ = self._keys(key, version)
+        self._l1.delete(l1_key)
+        return self.l2.incr(l2_key, delta)
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        self._l1.clear()
+        self.l2.clear()
+        # The namespace versions were stored in L2 too.
+        with self._state.lock:
+            self._state.namespaces.clear()
+
+    def clear_l1(self):
+        """Clears the in-process cache only."""
+        self._l1.clear()
@@ -20,18 +20,19 @@ class AvatarFieldFile(ImageFieldFile):
         """Return the thumbnail URL used when the AvatarField is empty."""
         return cls._make_thumbnail_url(settings.STATIC_URL, settings.AVATAR_DEFAULT_FILENAME)
 
-    def thumbnail_path(self) -> str:
+    def thumbnail_path(self, size: int = 0) -> str:
         """Return the path of the thumbnailed avatar.
 
         The path is relative to MEDIA_ROOT.
 
+        :param size: the size of the thumbnail, or 0 for the default size.
         :return: the path to the thumbnail, or '' if the thumbnail is empty.
         """
 
         if not self:
             return ''
 
-        size = settings.AVATAR_DEFAULT_SIZE_PIXELS
+        size = size or settings.AVATAR_DEFAULT_SIZE_PIXELS
         geometry_string = f'{size}x{size}'
         thumb = sorl.thumbnail.get_thumbnail(
             self.name,
@@ -39,15 +40,17 @@ class AvatarFieldFile(ImageFieldFile):
             crop="center")
         return thumb.name
 
-    def thumbnail_url(self) -> str:
+    def thumbnail_url(self, size: int = 0) -> str:
         """Return the absolute URL of the thumbnailed avatar.
 
         Returns either the URL of the cached thumbnail, or the URL
         of the default avatar (if this one is empty).
+
+        :param size: the size of the thumbnail, or 0 for the default size.
         """
         if not self:
             return self.default_thumbnail_url()
-        return self._make_thumbnail_url(settings.MEDIA_URL, self.thumbnail_path())
+        return self._make_thumbnail_url(settings.MEDIA_URL, self.thumbnail_path(size))
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, ImageFieldFile):
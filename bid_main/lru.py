@@ -0,0 +1,64 @@
+"""In-process LRU cache, shared by the threads of a process."""
+
+import collections
+import threading
+import time
+import typing
+
+DEFAULT_TIMEOUT = object()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with per-entry expiry."""
+
+    def __init__(self, max_size: int, timeout: typing.Optional[float]):
+        """
+        :param max_size: maximum number of entries to keep.
+        :param timeout: default max age of entries in seconds, or None to keep
+            entries until they are evicted.
+        """
+        self.max_size = max_size
+        self.timeout = timeout
+        self._items: typing.MutableMapping[str, typing.Tuple[float, typing.Any]] = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, timeout=DEFAULT_TIMEOUT):
+        """Stores the value.
+
+        :param timeout: max age of this entry in seconds. None keeps the entry
+            until evicted, and the default uses the timeout given to the constructor.
+        """
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        expires = float('inf') if timeout is None else time.monotonic() + timeout
+
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
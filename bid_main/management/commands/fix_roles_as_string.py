@@ -1,36 +1,106 @@
-"""Updates users' public_roles_as_string property based on their roles."""
+"""Updates users' public_roles_as_string property based on their roles.
+
+Users are streamed in chunks, in order of ID. For every chunk, the public
+roles of all its users are fetched with a single query over the User.roles
+through-table, and only the users whose public_roles_as_string differs are
+written, with a single bulk update. Memory use does not depend on the
+number of users.
+"""
+
+import typing
 
-from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 
-from bid_main import models
+UserModel = get_user_model()
 
 
 class Command(BaseCommand):
     help = "Updates users' public_roles_as_string property based on their roles"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=5000,
+                            help='Number of users to check per transaction')
+        parser.add_argument('--webhooks',
+                            action='store_true',
+                            default=False,
+                            help='Call the webhooks for users whose public roles changed')
+        parser.add_argument('--dry-run', '-n',
+                            action='store_true',
+                            default=False,
+                            help='Only report how many users would be updated')
+
     def handle(self, *args, **options):
-        from bid_api import signals
-        from django.db.models.signals import post_save
-
-        post_save.disconnect(signals.modified_user_to_webhooks)
-
-        self.stdout.write('Updating all users.')
-
-        model: models.User = get_user_model()
-        all_users = model.objects.all()
-        user_count = len(all_users)
-        for idx, user in enumerate(all_users):
-            do_print = (
-                (user_count > 250 and idx % 250 == 0) or
-                (250 >= user_count > 100 and idx % 10 == 0) or
-                (user_count <= 100)
-            )
-            if do_print:
-                self.stdout.write(f'   - {idx+1}/{user_count}')
-
-            roles = user.public_roles()
-            user.public_roles_as_string = ' '.join(sorted(roles))
-            user.save(update_fields={'public_roles_as_string'})
-
-        self.stdout.write(self.style.SUCCESS(f'Done, updated {user_count} users.'))
+        chunk_size = max(1, options['chunk_size'])
+        self.webhooks = options['webhooks']
+        self.dry_run = options['dry_run']
+
+        self.stdout.write('Checking all users.')
+        checked = updated = 0
+        last_id = 0
+        while True:
+            count, changed, last_id = self.fix_chunk(last_id, chunk_size)
+            if not count:
+                break
+            checked += count
+            updated += changed
+            if options['verbosity'] > 1:
+                self.stdout.write(f'   - {checked} users checked, up to user {last_id}')
+
+        verb = 'would be' if self.dry_run else 'were'
+        self.stdout.write(self.style.SUCCESS(
+            f'Done, checked {checked} users, {updated} {verb} updated.'))
+
+    @transaction.atomic()
+    def fix_chunk(self, last_id: int, chunk_size: int) -> typing.Tuple[int, int, int]:
+        """Fixes the chunk of users after last_id.
+
+        :returns: the number of users checked, the number of users updated,
+            and the ID of the last user in the chunk.
+        """
+        users = UserModel.objects.filter(id__gt=last_id).order_by('id')
+        if not self.dry_run:
+            # Lock the users, so that concurrent role changes are not overwritten.
+            users = users.select_for_update()
+        chunk = list(users.values_list('id', 'public_roles_as_string')[:chunk_size])
+        if not chunk:
+            return 0, 0, last_id
+        first_id, last_id = chunk[0][0], chunk[-1][0]
+
+        public_roles: typing.Dict[int, typing.List[str]] = {}
+        user_roles = UserModel.roles.through.objects \
+            .filter(user_id__gte=first_id, user_id__lte=last_id,
+                    role__is_public=True, role__is_active=True) \
+            .values_list('user_id', 'role__name')
+        for user_id, role_name in user_roles.iterator():
+            public_roles.setdefault(user_id, []).append(role_name)
+
+        changes = {}
+        for user_id, roles_as_string in chunk:
+            new_roles_as_string = ' '.join(sorted(public_roles.get(user_id, ())))
+            if new_roles_as_string != roles_as_string:
+                changes[user_id] = (roles_as_string, new_roles_as_string)
+        if not changes or self.dry_run:
+            return len(chunk), len(changes), last_id
+
+        if self.webhooks:
+            # The webhook payloads need more than just the roles.
+            changed_users = list(UserModel.objects.filter(id__in=changes.keys()).order_by('id'))
+        else:
+            changed_users = [UserModel(id=user_id) for user_id in sorted(changes)]
+        now = timezone.now()
+        for user in changed_users:
+            user.public_roles_as_string = changes[user.id][1]
+            user.last_update = now
+        UserModel.objects.bulk_update(changed_users, ['public_roles_as_string', 'last_update'])
+
+        if self.webhooks:
+            from bid_api import signals
+
+            signals.roles_changed_to_webhooks(
+                [(user, set(changes[user.id][0].split())) for user in changed_users])
+        return len(chunk), len(changes), last_id
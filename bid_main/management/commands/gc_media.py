@@ -0,0 +1,218 @@
+"""
+Removes media files and thumbnails that are no longer referenced.
+
+Replacing a user's avatar deletes the old original, but not the thumbnails
+sorl-thumbnail generated for it, nor its entries in the thumbnail key-value
+store. Replaced badge images leak in the same way. This command finds those
+orphans and deletes them.
+"""
+
+import datetime
+import typing
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage, Storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from sorl.thumbnail import default as sorl_default
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.kvstores.base import add_prefix
+
+from bid_main import models
+
+
+def walk_storage(storage: Storage, path: str) -> typing.Iterator[str]:
+    """Yields the paths of all files under 'path', recursively."""
+    if not storage.exists(path):
+        return
+    dirs, files = storage.listdir(path)
+    for fname in files:
+        yield f'{path}/{fname}'
+    for dname in dirs:
+        yield from walk_storage(storage, f'{path}/{dname}')
+
+
+class Command(BaseCommand):
+    help = 'Deletes orphaned media files, thumbnails, and thumbnail key-value store entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', '-n',
+                            action='store_true',
+                            default=False,
+                            help='Only report what would be deleted.')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=500,
+                            help='Number of key-value store entries to delete per query.')
+        parser.add_argument('--min-age',
+                            type=int,
+                            default=3600,
+                            help='Files younger than this many seconds, and their key-value '
+                                 'store entries, are never deleted, as they may belong to an '
+                                 'upload that is still in progress.')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = max(1, options['batch_size'])
+        self.verbosity = options['verbosity']
+        self.storage = default_storage
+        self.kvstore = sorl_default.kvstore
+        self.cutoff = timezone.now() - datetime.timedelta(seconds=options['min_age'])
+
+        self.file_batch: typing.List[typing.Tuple[str, Storage]] = []
+        self.scheduled_files: typing.Set[str] = set()
+        self.key_batch: typing.List[str] = []
+        self.scheduled_keys: typing.Set[str] = set()
+        self.freed_bytes = 0
+        self.deleted_files = 0
+        self.deleted_keys = 0
+
+        if self.dry_run:
+            self.stdout.write('Dry run, nothing will be deleted.')
+
+        referenced = self.referenced_files()
+        live_thumbnails = self.gc_kvstore(referenced)
+        self.gc_storage(referenced, live_thumbnails)
+        self.flush()
+
+        verb = 'Would free' if self.dry_run else 'Freed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {self.freed_bytes} bytes by deleting {self.deleted_files} files '
+            f'and {self.deleted_keys} key-value store entries.'))
+
+    def referenced_files(self) -> typing.Set[str]:
+        """Returns the names of all media files that are referenced from the database."""
+        user_model = get_user_model()
+        referenced = set()
+        for model, field in ((user_model, 'avatar'), (models.Role, 'badge_img')):
+            names = model.objects \
+                .exclude(**{f'{field}__isnull': True}) \
+                .exclude(**{field: ''}) \
+                .values_list(field, flat=True) \
+                .iterator()
+            referenced.update(names)
+        if self.verbosity > 1:
+            self.stdout.write(f'Found {len(referenced)} referenced media files.')
+        return referenced
+
+    def gc_kvstore(self, referenced: typing.Set[str]) -> typing.Set[str]:
+        """Removes thumbnails of unreferenced images from the key-value store.
+
+        :return: the names of the thumbnail files that are still in use.
+        """
+        kvstore = self.kvstore
+        live_thumbnails = set()
+        thumb_prefix = sorl_settings.THUMBNAIL_PREFIX
+
+        # Sources that have thumbnails.
+        for source_key in kvstore._find_keys(identity='thumbnails'):
+            source = kvstore._get(source_key)
+            thumb_keys = kvstore._get(source_key, identity='thumbnails') or []
+            is_live = source is not None and (source.name in referenced
+                                              or self.is_young(source.name, source.storage))
+
+            for thumb_key in thumb_keys:
+                thumbnail = kvstore._get(thumb_key)
+                if is_live:
+                    if thumbnail is not None:
+                        live_thumbnails.add(thumbnail.name)
+                    continue
+                if thumbnail is not None:
+                    self.delete_file(thumbnail.name, thumbnail.storage)
+                self.delete_key(add_prefix(thumb_key, 'image'))
+
+            if not is_live:
+                if self.verbosity > 1:
+                    name = source.name if source is not None else source_key
+                    self.stdout.write(f'   - orphaned thumbnails of {name}')
+                self.delete_key(add_prefix(source_key, 'thumbnails'))
+                self.delete_key(add_prefix(source_key, 'image'))
+
+        # Sources without thumbnails, and thumbnails whose source entry is gone.
+        for image_key in kvstore._find_keys(identity='image'):
+            image = kvstore._get(image_key)
+            if image is None:
+                continue
+            if image.name.startswith(thumb_prefix):
+                if image.name in live_thumbnails:
+                    continue
+            elif image.name in referenced:
+                continue
+            if self.is_young(image.name, image.storage):
+                continue
+            self.delete_key(add_prefix(image_key, 'image'))
+
+        return live_thumbnails
+
+    def gc_storage(self, referenced: typing.Set[str], live_thumbnails: typing.Set[str]):
+        """Removes unreferenced files from the upload and thumbnail directories."""
+        user_model = get_user_model()
+        upload_dirs = [
+            user_model._meta.get_field('avatar').upload_to,
+            models.Role._meta.get_field('badge_img').upload_to,
+        ]
+        for upload_dir in upload_dirs:
+            for name in walk_storage(self.storage, upload_dir):
+                if name not in referenced:
+                    self.delete_file(name, self.storage)
+
+        thumb_dir = sorl_settings.THUMBNAIL_PREFIX.rstrip('/')
+        for name in walk_storage(sorl_default.storage, thumb_dir):
+            if name not in live_thumbnails:
+                self.delete_file(name, sorl_default.storage)
+
+    def is_young(self, name: str, storage: Storage) -> bool:
+        """Returns whether the file exists and is younger than --min-age."""
+        try:
+            return storage.get_modified_time(name) >= self.cutoff
+        except FileNotFoundError:
+            return False
+
+    def delete_file(self, name: str, storage: Storage):
+        """Schedules a file for deletion, unless it is too young."""
+        if name in self.scheduled_files:
+            return
+        try:
+            if storage.get_modified_time(name) >= self.cutoff:
+                return
+            size = storage.size(name)
+        except FileNotFoundError:
+            # Already deleted, for example via the key-value store pass.
+            return
+
+        if self.verbosity > 2:
+            self.stdout.write(f'   - file {name} ({size} bytes)')
+        self.freed_bytes += size
+        self.deleted_files += 1
+        self.scheduled_files.add(name)
+        self.file_batch.append((name, storage))
+        if len(self.file_batch) >= self.batch_size:
+            self.flush()
+
+    def delete_key(self, raw_key: str):
+        """Schedules a raw key-value store key for deletion."""
+        if raw_key in self.scheduled_keys:
+            return
+        if self.verbosity > 2:
+            self.stdout.write(f'   - key {raw_key}')
+        self.deleted_keys += 1
+        self.scheduled_keys.add(raw_key)
+        self.key_batch.append(raw_key)
+        if len(self.key_batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Performs the scheduled deletions.
+
+        The key-value store entries are deleted with a single query. Storages
+        cannot delete files in bulk, so those are deleted one by one.
+        """
+        file_batch, self.file_batch = self.file_batch, []
+        key_batch, self.key_batch = self.key_batch, []
+        if self.dry_run:
+            return
+
+        if key_batch:
+            self.kvstore._delete_raw(*key_batch)
+        for name, storage in file_batch:
+            storage.delete(name)
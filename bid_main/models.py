@@ -14,7 +14,7 @@ from django.utils.translation import ugettext_lazy as _
 import sorl.thumbnail
 
 import oauth2_provider.models as oa2_models
-from . import fields
+from . import fields, role_updates
 
 
 class RoleManager(models.Manager):
@@ -229,6 +229,11 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
+    # The values of these fields are remembered when the user is loaded from
+    # the database, so that changes can be detected without querying the
+    # database again. This is used for the webhooks, see bid_api.signals.
+    TRACKED_FIELDS = ('email', 'full_name', 'public_roles_as_string', 'avatar')
+
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
@@ -236,14 +241,58 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __repr__(self) -> str:
         return f'<User id={self.id} email={self.email!r}>'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: cls._tracked_value(name, value)
+            for name, value in zip(field_names, values)
+            if name in cls.TRACKED_FIELDS
+        }
+        return instance
+
+    @staticmethod
+    def _tracked_value(name: str, value):
+        if name == 'avatar':
+            # Either a file or its name; no avatar can be either None or ''.
+            return getattr(value, 'name', value) or ''
+        return value
+
+    def tracked_values(self, field_names: typing.Iterable[str] = TRACKED_FIELDS) -> dict:
+        """Returns the current values of the tracked fields that are not deferred."""
+        deferred = self.get_deferred_fields()
+        return {name: self._tracked_value(name, getattr(self, name))
+                for name in field_names
+                if name in self.TRACKED_FIELDS and name not in deferred}
+
+    def loaded_values(self) -> typing.Optional[dict]:
+        """Returns the tracked field values as they are in the database.
+
+        These are the values as they were loaded, or as they were last saved.
+        Returns None when this user was not loaded from the database.
+        """
+        return getattr(self, '_loaded_values', None)
+
+    def _remember_values(self, field_names: typing.Iterable[str]):
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        loaded.update(self.tracked_values(field_names))
+
     def save(self, *args, **kwargs):
         self.last_update = timezone.now()
         updated_fields = {'last_update'}
 
+        # Save deferred role changes along, before the save signals are sent.
+        kwargs['update_fields'] = role_updates.apply_deferred(self, kwargs.get('update_fields'))
         if kwargs.get('update_fields') is not None:
             kwargs['update_fields'] = set(kwargs['update_fields']).union(updated_fields)
 
-        return super().save(*args, **kwargs)
+        result = super().save(*args, **kwargs)
+        self._remember_values(kwargs.get('update_fields') or self.TRACKED_FIELDS)
+        return result
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._remember_values(fields or self.TRACKED_FIELDS)
 
     def public_roles(self) -> set:
         """Returns public role names.
@@ -0,0 +1,97 @@
+"""Updating public_roles_as_string when the roles of users change.
+
+Normally bid_main.signals.modified_user_role updates and saves the user
+after every change to their roles. Code that makes several changes to the
+roles of a user, and possibly saves the user as well, can run in a
+`deferred_role_updates()` block instead. Then every user is updated once:
+when the user is saved in the block, or otherwise at the end of the block.
+
+The deferral is limited to such blocks, rather than to any surrounding
+transaction: Django has no hook that runs just before a commit, and
+on-commit callbacks run outside the transaction, too late to queue the
+webhook calls in it (see bid_api.outbox). The blocks are used by the badger
+API and the user admin; role changes elsewhere are handled immediately.
+"""
+
+import contextlib
+import logging
+import threading
+import typing
+
+from django.db import transaction
+
+log = logging.getLogger(__name__)
+
+# Within deferred_role_updates(), 'users' maps the IDs of users whose roles
+# changed to the user instances; it is None otherwise.
+_deferred = threading.local()
+
+
+def roles_changed(user) -> bool:
+    """Handles a change to the user's roles.
+
+    :returns: whether the update was deferred.
+    """
+    pending = getattr(_deferred, 'users', None)
+    if pending is None:
+        update_public_roles(user)
+        return False
+    log.debug('deferring update of roles of %s', user)
+    pending[user.id] = user
+    return True
+
+
+def update_public_roles(user):
+    """Updates the user's public_roles_as_string, saving the user if it changed."""
+    new_roles = ' '.join(sorted(user.public_roles()))
+    if new_roles != user.public_roles_as_string:
+        user.public_roles_as_string = new_roles
+        log.debug('saving user %s again for new roles %r', user, new_roles)
+        user.save(update_fields=['public_roles_as_string'])
+    else:
+        log.debug('new roles of %s are old roles: %r', user, new_roles)
+
+
+def apply_deferred(user, update_fields: typing.Optional[typing.Set[str]]) \
+        -> typing.Optional[typing.Set[str]]:
+    """Includes deferred role changes of the user in a save.
+
+    Called by User.save() before saving, so that the save signals (and thus
+    the webhooks) see the new roles.
+
+    :returns: the fields to save, including public_roles_as_string when
+        deferred role changes were applied.
+    """
+    pending = getattr(_deferred, 'users', None)
+    if not pending or user.id not in pending:
+        return update_fields
+    del pending[user.id]
+    user.public_roles_as_string = ' '.join(sorted(user.public_roles()))
+    if update_fields is None:
+        return None
+    return set(update_fields) | {'public_roles_as_string'}
+
+
+@contextlib.contextmanager
+def deferred_role_updates():
+    """Runs the block in a transaction, updating every changed user once.
+
+    Multiple role changes thus result in a single save and a single webhook
+    call per user. Nested blocks are handled by the outermost one.
+
+    Can also be used as decorator.
+    """
+    if getattr(_deferred, 'users', None) is not None:
+        with transaction.atomic():
+            yield
+        return
+
+    _deferred.users = {}
+    try:
+        with transaction.atomic():
+            yield
+            pending, _deferred.users = _deferred.users, None
+            for user_id, user in sorted(pending.items()):
+                update_public_roles(user)
+    finally:
+        _deferred.users = None
@@ -4,13 +4,18 @@ from django.db.models import F
 from django.conf import settings
 from django.core.signals import got_request_exception
 from django.contrib.auth.signals import user_logged_in
-from django.db.models.signals import m2m_changed
-from django.dispatch import receiver
+from django.contrib.flatpages.models import FlatPage
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver, Signal
 
-from . import models
+from . import badger, models, role_updates
+from .views import flatpages
 
 log = logging.getLogger(__name__)
 
+# Sent when deletion of users was requested; 'users' is a list of those users.
+user_deletion_requested = Signal(providing_args=['users'])
+
 
 @receiver(got_request_exception)
 def log_exception(sender, **kwargs):
@@ -53,10 +58,34 @@ def modified_user_role(sender, instance, action, reverse, model, **kwargs):
         return
 
     # User's roles changed, so we have to update their public_roles_as_string.
-    new_roles = ' '.join(sorted(instance.public_roles()))
-    if new_roles != instance.public_roles_as_string:
-        instance.public_roles_as_string = new_roles
-        my_log.debug('    saving user again for new roles %r', new_roles)
-        instance.save(update_fields=['public_roles_as_string'])
+    role_updates.roles_changed(instance)
+
+
+@receiver(post_save, sender=models.Role)
+@receiver(post_delete, sender=models.Role)
+@receiver(m2m_changed, sender=models.Role.may_manage_roles.through)
+def modified_role(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        badger.invalidate()
+
+
+@receiver(m2m_changed, sender=models.User.roles.through)
+def modified_badger_caller_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        # pk_set contains role IDs; it is None when the roles were cleared.
+        badger.roles_changed([instance.id], pk_set)
+    elif action == 'post_clear':
+        # We don't know which users lost the role.
+        badger.roles_changed(None)
     else:
-        my_log.debug('    new roles are old roles: %r', new_roles)
+        badger.roles_changed(pk_set, [instance.id])
+
+
+@receiver(post_save, sender=FlatPage)
+@receiver(post_delete, sender=FlatPage)
+@receiver(m2m_changed, sender=FlatPage.sites.through)
+def modified_flatpage(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        flatpages.invalidate_cache()
@@ -4,6 +4,7 @@ import shutil
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.test import TestCase
+from sorl.thumbnail import default as sorl_default
 
 
 class AvatarModelTest(TestCase):
@@ -25,6 +26,7 @@ class AvatarModelTest(TestCase):
         self.fake_media_cache = self.fake_media_root / 'cache'
         if self.fake_media_cache.exists():
             shutil.rmtree(self.fake_media_cache)
+        sorl_default.kvstore.clear()
 
     def tearDown(self) -> None:
         if self.fake_media_cache.exists():
@@ -0,0 +1,158 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from bid_main import cache, lru
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'bid_main.cache.TwoTierCache',
+        'LOCATION': 'l2',
+        'KEY_PREFIX': 'two-tier-test',
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 3,
+            'L1_TIMEOUT': 60,
+            'NAMESPACE_SYNC_INTERVAL': 0,
+        },
+    },
+    'l2': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'two-tier-test-l2',
+    },
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TwoTierCacheTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = self.make_cache()
+        self.cache.clear()
+        self.cache._state.stats = {'l1': {'hits': 0, 'misses': 0},
+                                   'l2': {'hits': 0, 'misses': 0}}
+
+    def make_cache(self) -> cache.TwoTierCache:
+        return cache.TwoTierCache('l2', TEST_CACHES['default'])
+
+    def other_worker(self) -> cache.TwoTierCache:
+        """Returns a cache that has its own L1, like in another process."""
+        other = self.make_cache()
+        other._state = cache._SharedState(3, 60)
+        return other
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', 'value')
+        self.assertEqual('value', self.cache.get('key'))
+        self.assertEqual({'l1': {'hits': 1, 'misses': 1, 'size': 1},
+                          'l2': {'hits': 0, 'misses': 1}},
+                         self.cache.stats())
+
+    def test_l1_shared_between_instances(self):
+        self.cache.set('key', 'value')
+
+        # Another thread of the same process.
+        other = self.make_cache()
+        self.assertEqual('value', other.get('key'))
+        self.assertEqual(1, other.stats()['l1']['hits'])
+
+    def test_l2_fallback(self):
+        other = self.other_worker()
+        other.set('key', 'value')
+
+        self.assertEqual('value', self.cache.get('key'))
+        self.assertEqual('value', self.cache.get('key'))
+        stats = self.cache.stats()
+        self.assertEqual({'hits': 1, 'misses': 0}, stats['l2'])
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1}, stats['l1'])
+
+    def test_l1_bounded(self):
+        for idx in range(5):
+            self.cache.set(f'key{idx}', idx)
+        self.assertEqual(3, len(self.cache._l1))
+
+        # Evicted keys still come from L2.
+        self.assertEqual(0, self.cache.get('key0'))
+
+    def test_l1_per_key_timeout(self):
+        self.cache.set('short', 'value', timeout=0)
+        self.assertEqual(0, len(self.cache._l1))
+
+    def test_get_many_set_many(self):
+        self.cache.set_many({'a': 1, 'b': 2})
+        other = self.other_worker()
+        other.set('c', 3)
+
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, self.cache.get_many(['a', 'b', 'c', 'd']))
+        stats = self.cache.stats()
+        self.assertEqual({'hits': 2, 'misses': 2}, {k: stats['l1'][k] for k in ('hits', 'misses')})
+        self.assertEqual({'hits': 1, 'misses': 1}, stats['l2'])
+
+    def test_delete(self):
+        self.cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.cache.delete('a')
+        self.cache.delete_many(['b'])
+        self.assertEqual({'c': 3}, self.cache.get_many(['a', 'b', 'c']))
+
+    def test_namespace_bump(self):
+        other = self.other_worker()
+        self.cache.set('ns:key', 'old')
+        self.cache.set('other-ns:key', 'kept')
+        self.assertEqual('old', other.get('ns:key'))
+
+        other.bump_namespace('ns')
+
+        # Both the L1 of this process and L2 should no longer have the old value.
+        self.assertIsNone(self.cache.get('ns:key'))
+        self.assertIsNone(other.get('ns:key'))
+        self.assertEqual('kept', self.cache.get('other-ns:key'))
+
+        self.cache.set('ns:key', 'new')
+        self.assertEqual('new', other.get('ns:key'))
+
+    def test_namespace_version_kept(self):
+        self.cache.bump_namespace('ns')
+        version = self.cache.bump_namespace('ns')
+        l2_key = self.cache._namespace_key('ns')
+        self.assertEqual(version, caches['l2'].get(l2_key))
+        self.assertIsNone(caches['l2']._expire_info[caches['l2'].make_key(l2_key)])
+
+    def test_namespace_version_lost(self):
+        self.cache.set('ns:key', 'old', timeout=None)
+
+        # For example culled by the database cache.
+        caches['l2'].delete(self.cache._namespace_key('ns'))
+
+        # The stale entry must not become valid again.
+        self.assertIsNone(self.other_worker().get('ns:key'))
+
+    def test_touch(self):
+        self.cache.set('key', 'value')
+        self.assertTrue(self.cache.touch('key', timeout=0))
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(self.cache.touch('key'))
+
+    def test_incr(self):
+        self.cache.set('counter', 1)
+        self.assertEqual(3, self.cache.incr('counter', 2))
+        self.assertEqual(3, self.cache.get('counter'))
+        with self.assertRaises(ValueError):
+            self.cache.incr('nonexistant')
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('key', 'first'))
+        self.assertFalse(self.cache.add('key', 'second'))
+        self.assertEqual('first', self.cache.get('key'))
+
+    def test_via_django(self):
+        default_cache = caches['default']
+        self.assertIsInstance(default_cache, cache.TwoTierCache)
+        default_cache.set('key', 'value')
+        l2_key = f'{default_cache._namespace_version("")}:two-tier-test:1:key'
+        self.assertEqual('value', caches['l2'].get(l2_key))
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_no_timeout(self):
+        lru_cache = lru.LRUCache(max_size=2, timeout=None)
+        lru_cache.set('a', 1)
+        self.assertEqual(1, lru_cache.get('a'))
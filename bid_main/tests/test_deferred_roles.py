@@ -0,0 +1,96 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from bid_api.models import Webhook
+from bid_main import role_updates
+from bid_main.models import Role
+
+UserModel = get_user_model()
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class DeferredRoleUpdatesTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.role1 = Role.objects.create(name='role1')
+        self.role2 = Role.objects.create(name='role2')
+        self.private = Role.objects.create(name='private', is_public=False)
+        self.user = UserModel.objects.create_user('user@example.com', '123456',
+                                                  nickname='user')
+        self.hook = Webhook.objects.create(name='hook', url='http://unit.test/')
+
+    def user_updates(self, queries) -> int:
+        table = UserModel._meta.db_table
+        return sum(query['sql'].startswith(f'UPDATE "{table}"') for query in queries)
+
+    def payloads(self) -> list:
+        return [json.loads(call.payload) for call in self.hook.queue.order_by('id')]
+
+    def test_immediate(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.user.roles.add(self.role1)
+            self.user.roles.add(self.role2)
+        self.assertEqual(2, self.user_updates(queries))
+        self.assertEqual(2, len(self.payloads()))
+
+    def test_collapsed_at_end(self):
+        with CaptureQueriesContext(connection) as queries:
+            with role_updates.deferred_role_updates():
+                self.user.roles.add(self.role1)
+                self.user.roles.add(self.role2, self.private)
+                self.user.roles.remove(self.role1)
+                with role_updates.deferred_role_updates():
+                    self.user.roles.add(self.role1)
+                self.assertEqual('', self.user.public_roles_as_string)
+
+        self.assertEqual(1, self.user_updates(queries))
+        self.user.refresh_from_db()
+        self.assertEqual('role1 role2', self.user.public_roles_as_string)
+        self.assertEqual([['role1', 'role2']],
+                         [payload['roles'] for payload in self.payloads()])
+
+    def test_collapsed_into_save(self):
+        with CaptureQueriesContext(connection) as queries:
+            with role_updates.deferred_role_updates():
+                self.user.roles.add(self.role1)
+                self.user.full_name = 'New Name'
+                self.user.save()
+
+        self.assertEqual(1, self.user_updates(queries))
+        self.user.refresh_from_db()
+        self.assertEqual('role1', self.user.public_roles_as_string)
+        self.assertEqual([('New Name', ['role1'])],
+                         [(payload['full_name'], payload['roles'])
+                          for payload in self.payloads()])
+
+    def test_collapsed_into_partial_save(self):
+        with CaptureQueriesContext(connection) as queries:
+            with role_updates.deferred_role_updates():
+                self.user.roles.add(self.role1)
+                self.user.full_name = 'New Name'
+                self.user.save(update_fields={'full_name'})
+
+        self.assertEqual(1, self.user_updates(queries))
+        self.user.refresh_from_db()
+        self.assertEqual('role1', self.user.public_roles_as_string)
+        self.assertEqual([['role1']], [payload['roles'] for payload in self.payloads()])
+
+    def test_private_role(self):
+        with role_updates.deferred_role_updates():
+            self.user.roles.add(self.private)
+        self.assertEqual([], self.payloads())
+
+    def test_rolled_back(self):
+        with self.assertRaises(ValueError):
+            with role_updates.deferred_role_updates():
+                self.user.roles.add(self.role1)
+                raise ValueError('abort')
+
+        # Later role changes are not deferred.
+        self.user.roles.add(self.role2)
+        self.user.refresh_from_db()
+        self.assertEqual('role2', self.user.public_roles_as_string)
@@ -0,0 +1,82 @@
+import io
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from bid_api.models import Webhook
+from bid_main.models import Role
+
+UserModel = get_user_model()
+
+
+@override_settings(WEBHOOK_FLUSH_ON_COMMIT=False)
+class FixRolesAsStringTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.public = Role.objects.create(name='public')
+        self.other = Role.objects.create(name='other')
+        self.private = Role.objects.create(name='private', is_public=False)
+        self.inactive = Role.objects.create(name='inactive', is_active=False)
+
+        self.users = [UserModel.objects.create_user(f'user{idx}@example.com', '123456',
+                                                    nickname=f'user{idx}')
+                      for idx in range(4)]
+        self.users[0].roles.add(self.public, self.other, self.private, self.inactive)
+        self.users[1].roles.add(self.public)
+        self.users[2].roles.add(self.private)
+        # Break some of the strings, bypassing the signals that keep them up to date.
+        UserModel.objects.filter(id=self.users[0].id).update(public_roles_as_string='public')
+        UserModel.objects.filter(id=self.users[2].id).update(public_roles_as_string='private')
+        UserModel.objects.filter(id=self.users[3].id).update(public_roles_as_string='gone')
+
+        self.hook = Webhook.objects.create(name='hook', url='http://unit.test/')
+
+    def fix(self, *args) -> str:
+        out = io.StringIO()
+        call_command('fix_roles_as_string', *args, stdout=out)
+        return out.getvalue()
+
+    def roles_as_string(self) -> list:
+        return list(UserModel.objects.filter(id__in=[user.id for user in self.users])
+                    .order_by('id').values_list('public_roles_as_string', flat=True))
+
+    def test_fix(self):
+        last_update = UserModel.objects.get(id=self.users[1].id).last_update
+        output = self.fix('--chunk-size', '3')
+
+        self.assertEqual(['other public', 'public', '', ''], self.roles_as_string())
+        self.assertIn('3 were updated', output)
+        # Correct users are not written to.
+        self.assertEqual(last_update, UserModel.objects.get(id=self.users[1].id).last_update)
+        self.assertEqual(0, self.hook.queue.count())
+
+    def test_dry_run(self):
+        output = self.fix('--dry-run')
+        self.assertEqual(['public', 'public', 'private', 'gone'], self.roles_as_string())
+        self.assertIn('3 would be updated', output)
+
+    def test_webhooks(self):
+        self.fix('--webhooks')
+        payloads = [json.loads(call.payload) for call in self.hook.queue.order_by('id')]
+        self.assertEqual([(self.users[0].id, ['other', 'public']),
+                          (self.users[2].id, []),
+                          (self.users[3].id, [])],
+                         [(payload['id'], payload['roles']) for payload in payloads])
+
+    def test_queries_per_chunk(self):
+        def count_queries() -> int:
+            UserModel.objects.update(public_roles_as_string='wrong')
+            with CaptureQueriesContext(connection) as queries:
+                self.fix('--chunk-size', '1000')
+            return len(queries)
+
+        few = count_queries()
+        for idx in range(10):
+            user = UserModel.objects.create_user(f'more{idx}@example.com', '123456',
+                                                 nickname=f'more{idx}')
+            user.roles.add(self.public)
+        self.assertEqual(few, count_queries())
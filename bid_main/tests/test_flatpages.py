@@ -0,0 +1,103 @@
+from django.contrib.auth import get_user_model
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+TEST_TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {
+        'loaders': [('django.template.loaders.locmem.Loader', {
+            'flatpages/default.html': '{{ flatpage.title }}: {{ flatpage.content }}',
+            'flatpages/with-csrf.html': '{{ flatpage.title }} {% csrf_token %}',
+            'errors/404.html': 'not found',
+        })],
+        'context_processors': ['django.contrib.auth.context_processors.auth'],
+    },
+}]
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'bid_main.cache.TwoTierCache',
+        'LOCATION': 'l2',
+        'KEY_PREFIX': 'flatpages-test',
+    },
+    'l2': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'flatpages-test-l2',
+    },
+}
+
+
+@override_settings(TEMPLATES=TEST_TEMPLATES, CACHES=TEST_CACHES)
+class FlatPageTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.page = FlatPage.objects.create(url='/about-us/', title='About', content='Us')
+        self.page.sites.add(Site.objects.get_current())
+
+    def test_unknown_url_without_queries(self):
+        # Warm up the index.
+        self.assertEqual(404, self.client.get('/wp-login.php').status_code)
+
+        with self.assertNumQueries(0):
+            resp = self.client.get('/.env')
+        self.assertEqual(404, resp.status_code)
+
+    def test_rendered_page_cache(self):
+        resp = self.client.get('/about-us/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(b'About: Us', resp.content)
+
+        with self.assertNumQueries(0):
+            resp = self.client.get('/about-us/')
+        self.assertEqual(b'About: Us', resp.content)
+
+    def test_invalidate_on_save(self):
+        self.client.get('/about-us/')
+
+        self.page.content = 'Them'
+        self.page.save()
+        self.assertEqual(b'About: Them', self.client.get('/about-us/').content)
+
+        self.page.url = '/about-them/'
+        self.page.save()
+        self.assertEqual(404, self.client.get('/about-us/').status_code)
+        self.assertEqual(200, self.client.get('/about-them/').status_code)
+
+    def test_invalidate_on_delete_and_sites(self):
+        other = FlatPage.objects.create(url='/other/', title='Other', content='Page')
+        self.assertEqual(404, self.client.get('/other/').status_code)
+
+        other.sites.add(Site.objects.get_current())
+        self.assertEqual(200, self.client.get('/other/').status_code)
+
+        other.delete()
+        self.assertEqual(404, self.client.get('/other/').status_code)
+
+    def test_not_cached_for_authenticated_users(self):
+        user = get_user_model().objects.create_user('harry@blender.org', 'secret',
+                                                    nickname='harry')
+        self.client.force_login(user)
+        self.client.get('/about-us/')
+
+        self.client.logout()
+        FlatPage.objects.filter(id=self.page.id).update(content='Changed')
+        self.assertEqual(b'About: Changed', self.client.get('/about-us/').content)
+
+    def test_csrf_pages_not_cached(self):
+        self.page.template_name = 'flatpages/with-csrf.html'
+        self.page.save()
+
+        first = self.client.get('/about-us/').content
+        self.client.cookies.clear()
+        second = self.client.get('/about-us/').content
+        self.assertNotEqual(first, second)
+
+    def test_registration_required(self):
+        self.page.registration_required = True
+        self.page.save()
+
+        resp = self.client.get('/about-us/')
+        self.assertEqual(302, resp.status_code)
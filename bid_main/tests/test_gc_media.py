@@ -0,0 +1,83 @@
+import io
+import pathlib
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+import sorl.thumbnail
+from sorl.thumbnail import default as sorl_default
+from sorl.thumbnail.images import ImageFile
+
+
+class GCMediaTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        my_dir = pathlib.Path(__file__).absolute().parent
+        source_avatar = my_dir / 'media' / 'user-avatars' / 'test-avatar.jpg'
+
+        self.media_root = pathlib.Path(tempfile.mkdtemp(prefix='bid-gc-media-'))
+        avatar_dir = self.media_root / 'user-avatars'
+        avatar_dir.mkdir()
+        shutil.copy(source_avatar, avatar_dir / 'kept.jpg')
+        shutil.copy(source_avatar, avatar_dir / 'orphan.jpg')
+
+        self.settings_modifier = self.settings(MEDIA_ROOT=self.media_root)
+        self.settings_modifier.__enter__()
+        sorl_default.kvstore.clear()
+
+        self.user = get_user_model()(email='example@example.com', nickname='example',
+                                     avatar='user-avatars/kept.jpg')
+        self.user.save()
+
+        self.kept_thumb = sorl.thumbnail.get_thumbnail('user-avatars/kept.jpg', '32x32')
+        self.orphan_thumb = sorl.thumbnail.get_thumbnail('user-avatars/orphan.jpg', '32x32')
+
+    def tearDown(self) -> None:
+        self.settings_modifier.__exit__(None, None, None)
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def gc_media(self, **options) -> str:
+        stdout = io.StringIO()
+        call_command('gc_media', min_age=0, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_dry_run(self):
+        output = self.gc_media(dry_run=True)
+
+        self.assertIn('Would free', output)
+        self.assertTrue((self.media_root / 'user-avatars' / 'orphan.jpg').exists())
+        self.assertTrue(self.orphan_thumb.exists())
+        # Their key-value store entries are still needed too.
+        self.assertIsNotNone(sorl_default.kvstore.get(self.orphan_thumb))
+        self.assertIsNotNone(sorl_default.kvstore.get(ImageFile('user-avatars/orphan.jpg')))
+
+    def test_gc(self):
+        orphan_size = (self.media_root / 'user-avatars' / 'orphan.jpg').stat().st_size
+        expect_freed = orphan_size + self.orphan_thumb.storage.size(self.orphan_thumb.name)
+
+        output = self.gc_media(batch_size=1)
+
+        self.assertIn(f'Freed {expect_freed} bytes by deleting 2 files', output)
+
+        # Orphans should be gone.
+        self.assertFalse((self.media_root / 'user-avatars' / 'orphan.jpg').exists())
+        self.assertFalse(self.orphan_thumb.exists())
+        self.assertIsNone(sorl_default.kvstore.get(self.orphan_thumb))
+        self.assertIsNone(sorl_default.kvstore.get(ImageFile('user-avatars/orphan.jpg')))
+
+        # Referenced files should be untouched.
+        self.assertTrue((self.media_root / 'user-avatars' / 'kept.jpg').exists())
+        self.assertTrue(self.kept_thumb.exists())
+        self.assertIsNotNone(sorl_default.kvstore.get(self.kept_thumb))
+
+    def test_young_files_are_kept(self):
+        stdout = io.StringIO()
+        call_command('gc_media', stdout=stdout)
+
+        self.assertTrue((self.media_root / 'user-avatars' / 'orphan.jpg').exists())
+        self.assertTrue(self.orphan_thumb.exists())
+        # Their key-value store entries are still needed too.
+        self.assertIsNotNone(sorl_default.kvstore.get(self.orphan_thumb))
@@ -0,0 +1,76 @@
+import pathlib
+import tempfile
+
+from django.test import SimpleTestCase
+
+from bid_main import lru, thumbnail_kvstore
+
+
+class ThumbnailKVStoreTest(SimpleTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='bid-kvstore-')
+        self.settings_modifier = self.settings(
+            THUMBNAIL_KVSTORE_SQLITE_PATH=pathlib.Path(self.tmpdir.name) / 'kv.sqlite3',
+            THUMBNAIL_KVSTORE_LRU_SIZE=2,
+        )
+        self.settings_modifier.__enter__()
+        self.kvstore = thumbnail_kvstore.KVStore()
+
+    def tearDown(self) -> None:
+        self.settings_modifier.__exit__(None, None, None)
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.kvstore._get_raw('sorl-thumbnail||image||abc'))
+
+        self.kvstore._set_raw('sorl-thumbnail||image||abc', '{"name": "abc"}')
+        self.assertEqual('{"name": "abc"}', self.kvstore._get_raw('sorl-thumbnail||image||abc'))
+
+        self.kvstore._delete_raw('sorl-thumbnail||image||abc')
+        self.assertIsNone(self.kvstore._get_raw('sorl-thumbnail||image||abc'))
+
+    def test_persisted_between_instances(self):
+        self.kvstore._set_raw('sorl-thumbnail||image||abc', '{"name": "abc"}')
+
+        other = thumbnail_kvstore.KVStore()
+        self.assertEqual('{"name": "abc"}', other._get_raw('sorl-thumbnail||image||abc'))
+
+    def test_find_keys(self):
+        self.kvstore._set_raw('sorl-thumbnail||image||abc', '1')
+        self.kvstore._set_raw('sorl-thumbnail||image||def', '2')
+        self.kvstore._set_raw('sorl-thumbnail||thumbnails||abc', '[]')
+
+        self.assertEqual(['abc', 'def'], sorted(self.kvstore._find_keys('image')))
+        self.assertEqual(['abc'], list(self.kvstore._find_keys('thumbnails')))
+
+    def test_preload(self):
+        for key in ('abc', 'def', 'ghi'):
+            self.kvstore._set_raw(f'sorl-thumbnail||image||{key}', key)
+
+        other = thumbnail_kvstore.KVStore()
+        self.assertEqual(2, other.preload())
+        self.assertEqual(2, len(other.lru))
+
+        # Preloaded entries should be served without touching the disk.
+        other._local.conn.close()
+        self.assertEqual('abc', other._get_raw('sorl-thumbnail||image||abc'))
+
+    def test_lru_bounded(self):
+        cache = lru.LRUCache(max_size=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_lru_timeout(self):
+        cache = lru.LRUCache(max_size=2, timeout=0)
+        cache.set('a', 1)
+        cache.set('b', 2, timeout=60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
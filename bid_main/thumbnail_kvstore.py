@@ -0,0 +1,119 @@
+"""Key-value store for sorl-thumbnail, backed by a local SQLite file.
+
+The default sorl-thumbnail key-value store keeps its data in the database and
+caches it in the Django cache, which means that every thumbnail lookup costs
+one or more round-trips to MySQL. This store keeps the data in an SQLite file
+on local disk (in WAL mode, so that multiple processes can read and write
+concurrently), with a small in-process LRU cache in front of it.
+
+Configure with these settings:
+
+- THUMBNAIL_KVSTORE = 'bid_main.thumbnail_kvstore.KVStore'
+- THUMBNAIL_KVSTORE_SQLITE_PATH: path of the SQLite file.
+- THUMBNAIL_KVSTORE_LRU_SIZE: max number of entries in the in-process cache.
+- THUMBNAIL_KVSTORE_LRU_TIMEOUT: max age in seconds of in-process cache entries.
+  This bounds how long other processes can see a stale entry after a key was
+  changed or deleted.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.kvstores.base import KVStoreBase
+
+from .lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """Returns the smallest string that is larger than all strings starting with 'prefix'."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class KVStore(KVStoreBase):
+    def __init__(self):
+        super().__init__()
+        self.path = str(settings.THUMBNAIL_KVSTORE_SQLITE_PATH)
+        self.lru = LRUCache(settings.THUMBNAIL_KVSTORE_LRU_SIZE,
+                            settings.THUMBNAIL_KVSTORE_LRU_TIMEOUT)
+        self._local = threading.local()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Returns the SQLite connection for the current thread.
+
+        Connections are never shared between threads, nor between processes;
+        a process forked by uWSGI will open its own connection on first use.
+        """
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == pid:
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS kvstore ('
+                     '  key TEXT PRIMARY KEY,'
+                     '  value TEXT NOT NULL'
+                     ') WITHOUT ROWID')
+        self._local.conn = conn
+        self._local.pid = pid
+        return conn
+
+    def preload(self, limit: int = 0) -> int:
+        """Loads entries from disk into the in-process cache.
+
+        Call this at worker start, so that the first requests do not have
+        to hit the disk.
+
+        :param limit: maximum number of entries to load, defaults to the LRU size.
+        :return: the number of loaded entries.
+        """
+        limit = limit or self.lru.max_size
+        prefix = sorl_settings.THUMBNAIL_KEY_PREFIX
+        rows = self.db.execute('SELECT key, value FROM kvstore WHERE key >= ? AND key < ? '
+                               'LIMIT ?', (prefix, _prefix_upper_bound(prefix), limit))
+        count = 0
+        for key, value in rows:
+            self.lru.set(key, value)
+            count += 1
+        log.debug('preloaded %d thumbnail key-value store entries', count)
+        return count
+
+    def clear(self):
+        super().clear()
+        self.lru.clear()
+
+    def _get_raw(self, key):
+        value = self.lru.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        row = self.db.execute('SELECT value FROM kvstore WHERE key = ?', (key,)).fetchone()
+        value = row[0] if row else None
+        # Also cache misses, as those are just as likely to be asked for again.
+        self.lru.set(key, value)
+        return value
+
+    def _set_raw(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO kvstore (key, value) VALUES (?, ?)', (key, value))
+        self.lru.set(key, value)
+
+    def _delete_raw(self, *keys):
+        if not keys:
+            return
+        self.db.executemany('DELETE FROM kvstore WHERE key = ?', [(key,) for key in keys])
+        self.lru.delete(*keys)
+
+    def _find_keys_raw(self, prefix):
+        rows = self.db.execute('SELECT key FROM kvstore WHERE key >= ? AND key < ?',
+                               (prefix, _prefix_upper_bound(prefix)))
+        return [row[0] for row in rows]
@@ -0,0 +1,99 @@
+"""Flatpage view that avoids database queries for unknown URLs.
+
+The flatpage view is hooked up as catch-all URL, so every unmatched request
+(including all scanner and bot traffic) would otherwise cost a query before
+it can 404. Instead, the URLs of the current site's flatpages are kept in an
+index in the cache, and known pages are rendered from a cache as well.
+
+Both live in the 'flatpages' cache namespace, which is invalidated whenever
+a flatpage is saved or deleted; see `bid_main.signals`.
+"""
+
+import hashlib
+import logging
+import typing
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.flatpages.views import render_flatpage
+from django.contrib.sites.models import Site
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponsePermanentRedirect
+
+CACHE_NAMESPACE = 'flatpages'
+log = logging.getLogger(__name__)
+
+
+def _index_key(site_id: int) -> str:
+    return f'{CACHE_NAMESPACE}:index:{site_id}'
+
+
+def _page_key(site_id: int, url: str) -> str:
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    return f'{CACHE_NAMESPACE}:page:{site_id}:{url_hash}'
+
+
+def url_index(site_id: int) -> typing.Dict[str, int]:
+    """Returns a mapping from URL to flatpage ID for all flatpages of the site."""
+    key = _index_key(site_id)
+    index = cache.get(key)
+    if index is None:
+        index = dict(FlatPage.objects.filter(sites=site_id).values_list('url', 'id'))
+        log.debug('caching index of %d flatpages of site %d', len(index), site_id)
+        cache.set(key, index, timeout=None)
+    return index
+
+
+def invalidate_cache():
+    """Forgets the flatpage index and all rendered flatpages."""
+    bump_namespace = getattr(cache, 'bump_namespace', None)
+    if bump_namespace is not None:
+        bump_namespace(CACHE_NAMESPACE)
+        return
+
+    # Without namespace support we can only forget the indices; rendered pages
+    # expire after settings.FLATPAGES_CACHE_TIMEOUT seconds.
+    site_ids = Site.objects.values_list('id', flat=True)
+    cache.delete_many([_index_key(site_id) for site_id in site_ids])
+
+
+def _is_cacheable(request) -> bool:
+    """Only pages rendered for anonymous users without pending messages are the same for all."""
+    return (request.method == 'GET'
+            and not request.user.is_authenticated
+            and not len(messages.get_messages(request)))
+
+
+def flatpage(request, url):
+    """Drop-in replacement for django.contrib.flatpages.views.flatpage."""
+    if not url.startswith('/'):
+        url = '/' + url
+    site_id = get_current_site(request).id
+    index = url_index(site_id)
+
+    if url not in index:
+        if not url.endswith('/') and settings.APPEND_SLASH and url + '/' in index:
+            return HttpResponsePermanentRedirect('%s/' % request.path)
+        raise Http404('No FlatPage matches the given query.')
+
+    cacheable = _is_cacheable(request)
+    page_key = _page_key(site_id, url)
+    if cacheable:
+        content = cache.get(page_key)
+        if content is not None:
+            return HttpResponse(content)
+
+    try:
+        page = FlatPage.objects.get(id=index[url])
+    except FlatPage.DoesNotExist:
+        raise Http404('No FlatPage matches the given query.')
+    response = render_flatpage(request, page)
+
+    # Pages with a CSRF token are specific to the visitor.
+    if (cacheable and response.status_code == 200 and not page.registration_required
+            and not request.META.get('CSRF_COOKIE_USED')):
+        cache.set(page_key, response.content.decode(response.charset),
+                  timeout=settings.FLATPAGES_CACHE_TIMEOUT)
+    return response
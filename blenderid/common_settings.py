@@ -207,22 +207,99 @@ CSRF_FAILURE_VIEW = 'bid_main.views.errors.csrf_failure'
 # being able to use the website.
 PPDATE = datetime.datetime(2018, 5, 18, 0, 0, 0, tzinfo=pytz.utc)
 
-# The cache is used by the thumbnailing system of sorl-thumbnail.
-# Without it, every badge will be resized on every request.
-# Using Redis or Memcached would be preferred, but requires more changes on
-# the www.blender.org server than I (Sybren) want to make now.
+# The default cache keeps often-used items in memory of the current process,
+# and falls back to the shared cache (L2) if they are not there.
+# Using Redis or Memcached for the shared cache would be preferred, but requires
+# more changes on the www.blender.org server than I (Sybren) want to make now.
 CACHES = {
     'default': {
+        'BACKEND': 'bid_main.cache.TwoTierCache',
+        'LOCATION': 'shared',  # Alias of the L2 cache.
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 60,  # seconds
+            'NAMESPACE_SYNC_INTERVAL': 2,  # seconds
+        },
+    },
+    'shared': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'cache',  # The table name.
-    }
+    },
 }
 
+# Deliver queued webhook calls in a background thread as soon as the
+# transaction that queued them commits. The flush_webhooks management command
+# delivers anything that could not be delivered this way.
+WEBHOOK_FLUSH_ON_COMMIT = True
+
+# Failed webhook calls are retried with exponential backoff, starting at the base
+# delay and growing to at most the max delay.
+WEBHOOK_RETRY_BASE_DELAY = 1  # seconds
+WEBHOOK_RETRY_MAX_DELAY = 15 * 60  # seconds
+
+# Undeliverable webhook calls are moved to the dead letters after this many
+# attempts or this many seconds, whichever comes first.
+WEBHOOK_MAX_ATTEMPTS = 100
+WEBHOOK_MAX_AGE = 3 * 24 * 3600  # seconds
+WEBHOOK_ERROR_MSG_MAX_LENGTH = 2000  # characters
+
+# Webhooks with compression enabled only compress request bodies of at least this size.
+WEBHOOK_COMPRESSION_MIN_SIZE = 1024  # bytes
+
+# When at least WEBHOOK_BREAKER_FAILURE_RATE of at least WEBHOOK_BREAKER_MIN_ATTEMPTS
+# calls in the last WEBHOOK_BREAKER_WINDOW seconds failed, no calls are sent to
+# that webhook for WEBHOOK_BREAKER_COOLDOWN seconds.
+WEBHOOK_BREAKER_WINDOW = 60  # seconds
+WEBHOOK_BREAKER_MIN_ATTEMPTS = 5
+WEBHOOK_BREAKER_FAILURE_RATE = 0.5
+WEBHOOK_BREAKER_COOLDOWN = 60  # seconds
+
+# Settings for `flush_webhooks --monitor`, which delivers to this many webhooks
+# concurrently, and waits this long for running deliveries when stopped.
+# It sleeps until the next retry is due, but at most the poll interval, so that
+# calls queued by other processes are noticed.
+WEBHOOK_DELIVERY_CONCURRENCY = 4
+WEBHOOK_DELIVERY_POLL_INTERVAL = 1  # seconds
+WEBHOOK_DELIVERY_SHUTDOWN_TIMEOUT = 30  # seconds
+# Webhook calls reuse HTTP connections; at most this many per host, and idle ones
+# are closed after this many seconds.
+WEBHOOK_HTTP_POOL_SIZE = 4
+WEBHOOK_HTTP_IDLE_TIMEOUT = 30  # seconds
+# Workers lease a webhook for this long (or longer for webhooks with a long timeout)
+# while delivering to it, so that only one worker at a time delivers to a webhook.
+WEBHOOK_LEASE_SECONDS = 60
+
+# Every process publishes its webhook delivery metrics to this cache at most every
+# publish interval, where they are kept for the TTL after the process last published.
+WEBHOOK_METRICS_CACHE = 'shared'
+WEBHOOK_METRICS_PUBLISH_INTERVAL = 10  # seconds
+WEBHOOK_METRICS_TTL = 24 * 3600  # seconds
+
+# Rendered flatpages are cached for anonymous visitors.
+FLATPAGES_CACHE_TIMEOUT = 3600  # seconds
+
+# The thumbnailing system of sorl-thumbnail keeps track of generated thumbnails
+# in a key-value store. Without it, every badge will be resized on every request.
+# This one is stored in an SQLite file on local disk, so that looking up
+# thumbnails does not require any database queries. The file has to be writable
+# by all web and management processes on the host.
+THUMBNAIL_KVSTORE = 'bid_main.thumbnail_kvstore.KVStore'
+THUMBNAIL_KVSTORE_SQLITE_PATH = BASE_DIR / 'thumbnail-kvstore.sqlite3'
+THUMBNAIL_KVSTORE_LRU_SIZE = 10000
+THUMBNAIL_KVSTORE_LRU_TIMEOUT = 300  # seconds
+
 AVATAR_ALLOWED_FILE_EXTS = {'.jpeg', '.jpg', '.png', '.webp'}
 # Make sure this is less than the client_max_body_size nginx setting:
 AVATAR_MAX_SIZE_BYTES = 2 * 1024**2
 AVATAR_DEFAULT_FILENAME = 'assets/img/default_user_avatar.png'
 AVATAR_CONTENT_TYPE = 'image/jpeg'
 AVATAR_DEFAULT_SIZE_PIXELS = 160
+# Sizes that can be requested via the bulk avatar API; each size creates its own thumbnails.
+AVATAR_ALLOWED_SIZES_PIXELS = {32, 64, 128, 160, 256}
+# Missing thumbnails are generated synchronously, so keep this low.
+AVATAR_BULK_MAX_USERS = 25
 THUMBNAIL_FORMAT = 'JPEG'
 THUMBNAIL_QUALITY = 83
+
+# Maximum number of grant/revoke operations per call to the bulk badger API.
+BADGER_BULK_MAX_OPERATIONS = 1000
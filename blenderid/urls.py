@@ -15,11 +15,11 @@ Including another URLconf
 """
 from django.conf.urls import url, include
 from django.contrib import admin
-from django.contrib.flatpages import views as fp_views
 from django.conf import settings
 import django.contrib.staticfiles.views
 
 import bid_main.views.errors as error_views
+import bid_main.views.flatpages as fp_views
 
 urlpatterns = [
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
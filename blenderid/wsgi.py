@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "blenderid.settings")
 
 application = get_wsgi_application()
+
+# Warm up the in-process cache of the thumbnail key-value store, so that the
+# first requests handled by this worker do not have to go to disk.
+from sorl.thumbnail import default as sorl_default  # noqa: E402
+
+if hasattr(sorl_default.kvstore, 'preload'):
+    sorl_default.kvstore.preload()
@@ -0,0 +1,20 @@
+"""Test configuration shared by all apps."""
+
+import pytest
+from django.test.utils import override_settings
+from django.utils.functional import empty
+from sorl.thumbnail import default as sorl_default
+
+
+@pytest.fixture(autouse=True, scope='session')
+def thumbnail_kvstore(tmp_path_factory):
+    """Keeps the thumbnail key-value store of the tests in a temporary file.
+
+    Otherwise tests would fill, and clear, the store of the development server.
+    """
+    path = tmp_path_factory.mktemp('thumbnail-kvstore') / 'kvstore.sqlite3'
+    with override_settings(THUMBNAIL_KVSTORE_SQLITE_PATH=path):
+        # sorl-thumbnail creates the store on first use, so make it do that again.
+        sorl_default.kvstore._wrapped = empty
+        yield
+    sorl_default.kvstore._wrapped = empty
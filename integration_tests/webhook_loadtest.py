@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""Measures webhook delivery throughput, latency and ordering.
+
+Starts local webhook receivers, registers them as webhooks, and then
+modifies users and grants badges to them through the badger, while the
+delivery daemon delivers the resulting calls. When everything has been
+delivered, it reports:
+
+- throughput: delivered events per second;
+- latency: time from the change being committed to the call being received,
+  as p50/p90/p99/max;
+- ordering violations: calls that were received after a call describing a
+  later state of the same user;
+- queue drain time: how long it took to deliver what was still queued after
+  the last change. With --backlog, all changes are made before delivery
+  starts, so this is the time it takes to deliver a backlog.
+
+This runs against the database configured in the Django settings, so use a
+development database. It creates users, roles and webhooks whose names start
+with "loadtest", and deletes them afterwards. As every webhook would receive
+the calls for these users, it refuses to run while other webhooks are enabled.
+
+Example, comparing batched to unbatched delivery to a slow receiver:
+
+    python webhook_loadtest.py --changes 2000 --latency 0.05 --json unbatched.json
+    python webhook_loadtest.py --changes 2000 --latency 0.05 --batch-size 50 --json batched.json
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+import types
+import typing
+
+import webhookreceiver
+
+log = logging.getLogger('webhook_loadtest')
+
+NAME_PREFIX = 'loadtest'
+
+
+def setup_django():
+    repo_root = pathlib.Path(__file__).absolute().parent.parent
+    sys.path.insert(0, str(repo_root))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'blenderid.settings')
+
+    import django
+    django.setup()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--receivers', type=int, default=2,
+                        help='Number of webhook receivers, each registered as a webhook')
+    parser.add_argument('--users', type=int, default=50, help='Number of users to modify')
+    parser.add_argument('--changes', type=int, default=1000,
+                        help='Number of changes to make, user modifications and badge grants')
+    parser.add_argument('--grant-ratio', type=float, default=0.2,
+                        help='Fraction of the changes that are badge grants')
+    parser.add_argument('--badges', type=int, default=10,
+                        help='Number of badges that can be granted')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the receivers take to respond')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many seconds are randomly added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of calls the receivers respond to with an error')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='Fraction of calls the receivers never respond to')
+    parser.add_argument('--hook-timeout', type=int, default=3,
+                        help='Timeout of the webhooks, in seconds')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Maximum number of calls per request (Webhook.max_batch_size)')
+    parser.add_argument('--compression', default='',
+                        help='Webhook.compression: "", "gzip" or "deflate"')
+    parser.add_argument('--payload-version', type=int, default=1,
+                        help='Webhook.payload_version')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Enable coalescing of queued calls (Webhook.coalesce_events)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Number of delivery lanes; defaults to '
+                             'settings.WEBHOOK_DELIVERY_CONCURRENCY')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Maximum number of changes per second; 0 for no limit')
+    parser.add_argument('--backlog', action='store_true',
+                        help='Make all changes before starting delivery, to measure how fast '
+                             'a backlog is delivered')
+    parser.add_argument('--drain-timeout', type=float, default=300,
+                        help='Seconds to wait for the queues to drain')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the random generators, for repeatable runs')
+    parser.add_argument('--json', type=pathlib.Path, dest='json_path',
+                        help='Also write the results as JSON to this file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+class LoadTest:
+    """Sets up the receivers, webhooks, users and badges, and runs the test."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+
+        self.receivers: typing.List[webhookreceiver.WebhookHTTPServer] = []
+        self.hooks = []
+        self.users = []
+        self.badges = []
+        self.manager = None
+
+        # (user ID, full name, roles) -> (change number, monotonic commit time).
+        self.states: typing.Dict[tuple, typing.Tuple[int, float]] = {}
+        self.initial_states: typing.Dict[int, dict] = {}
+        self.changes_started = 0.0
+        self.changes_done = 0.0
+        self.delivery_started = 0.0
+        self.drained = 0.0
+
+    def run(self) -> dict:
+        from django.test.utils import override_settings
+
+        # Leave the delivery to the daemon, like in production.
+        with override_settings(WEBHOOK_FLUSH_ON_COMMIT=False):
+            self.check_other_hooks()
+            try:
+                self.set_up()
+                self.deliver_while(self.make_changes)
+            finally:
+                self.tear_down()
+        return self.report()
+
+    def check_other_hooks(self):
+        from bid_api import models
+
+        others = models.Webhook.objects.filter(enabled=True).exclude(name__startswith=NAME_PREFIX)
+        if others.exists():
+            names = ', '.join(hook.name for hook in others)
+            raise SystemExit(f'Other webhooks are enabled ({names}); they would receive '
+                             f'the calls of the load test. Disable them first.')
+
+    def set_up(self):
+        from django.contrib.auth import get_user_model
+        from bid_api import models
+        from bid_main.models import Role
+
+        args = self.args
+        user_model = get_user_model()
+
+        for idx in range(args.badges):
+            badge, _ = Role.objects.get_or_create(name=f'{NAME_PREFIX}_badge_{idx}', defaults={
+                'is_badge': True, 'is_public': True, 'is_active': True})
+            self.badges.append(badge)
+        manager_role, _ = Role.objects.get_or_create(name=f'{NAME_PREFIX}_manager')
+        manager_role.may_manage_roles.set(self.badges)
+
+        self.manager = user_model.objects.create_user(
+            f'{NAME_PREFIX}-manager@example.com', nickname=f'{NAME_PREFIX}-manager')
+        self.manager.roles.add(manager_role)
+        for idx in range(args.users):
+            user = user_model.objects.create_user(
+                f'{NAME_PREFIX}-{idx}@example.com', nickname=f'{NAME_PREFIX}-{idx}',
+                full_name=f'{NAME_PREFIX} user {idx}')
+            self.users.append(user)
+            self.initial_states[user.id] = {'full_name': user.full_name, 'roles': []}
+
+        # Register the webhooks last, so that they don't receive the above.
+        for idx in range(args.receivers):
+            hook = models.Webhook(name=f'{NAME_PREFIX}-{idx}',
+                                  url='http://127.0.0.1/',
+                                  timeout=args.hook_timeout,
+                                  max_batch_size=args.batch_size,
+                                  compression=args.compression,
+                                  payload_version=args.payload_version,
+                                  coalesce_events=args.coalesce)
+            receiver = webhookreceiver.WebhookHTTPServer(
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                timeout_rate=args.timeout_rate,
+                timeout_sleep=args.hook_timeout + 1,
+                secret=hook.secret,
+                seed=None if args.seed is None else args.seed + idx)
+            receiver.start()
+            hook.url = receiver.url
+            hook.save()
+            self.receivers.append(receiver)
+            self.hooks.append(hook)
+
+    def tear_down(self):
+        from bid_main.models import Role
+
+        # Delete the hooks first, so that deleting the users queues nothing.
+        for hook in self.hooks:
+            hook.delete()
+        for user in self.users:
+            user.delete()
+        if self.manager is not None:
+            self.manager.delete()
+        Role.objects.filter(name__startswith=f'{NAME_PREFIX}_').delete()
+        for receiver in self.receivers:
+            receiver.stop()
+
+    def make_changes(self):
+        from bid_api.views import badger
+
+        args = self.args
+        grant_view = badger.BadgerView(action='grant')
+        request = types.SimpleNamespace(user=self.manager)
+        user_roles: typing.Dict[int, typing.List[str]] = {user.id: [] for user in self.users}
+
+        log.info('making %d changes to %d users', args.changes, len(self.users))
+        self.changes_started = time.monotonic()
+        for change_nr in range(args.changes):
+            user = self.random.choice(self.users)
+            roles = user_roles[user.id]
+            # Every change results in a unique state of the user, so that
+            # the receivers can tell which change a call is about. That's
+            # why badges are only granted, and never revoked.
+            missing = [badge.name for badge in self.badges if badge.name not in roles]
+            if missing and self.random.random() < args.grant_ratio:
+                badge = self.random.choice(missing)
+                resp = grant_view.do_badger(request, badge, str(user.id))
+                if resp.status_code != 200:
+                    raise SystemExit(f'Unable to grant {badge} to {user}: {resp.content}')
+                roles.append(badge)
+                roles.sort()
+                user.refresh_from_db()
+            else:
+                user.full_name = f'{NAME_PREFIX} user {user.id} change {change_nr}'
+                user.save()
+            self.states[(user.id, user.full_name, tuple(roles))] = (change_nr, time.monotonic())
+
+            if args.rate > 0:
+                ahead = (change_nr + 1) / args.rate - (time.monotonic() - self.changes_started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.changes_done = time.monotonic()
+        log.info('changes made in %.1f seconds', self.changes_done - self.changes_started)
+
+    def deliver_while(self, make_changes: typing.Callable[[], None]):
+        """Runs the delivery daemon while making changes, until the queues are empty."""
+        from bid_api import delivery, models
+
+        daemon = delivery.DeliveryDaemon(concurrency=self.args.concurrency,
+                                         poll_interval=0.05,
+                                         shutdown_timeout=self.args.hook_timeout + 1)
+        thread = threading.Thread(target=daemon.run, name='webhook-delivery')
+        if self.args.backlog:
+            make_changes()
+        self.delivery_started = time.monotonic()
+        thread.start()
+        try:
+            if not self.args.backlog:
+                make_changes()
+
+            queue = models.WebhookQueuedCall.objects.filter(webhook__in=self.hooks)
+            deadline = time.monotonic() + self.args.drain_timeout
+            while queue.exists():
+                if time.monotonic() > deadline:
+                    log.error('queues not drained after %s seconds, %d calls left',
+                              self.args.drain_timeout, queue.count())
+                    break
+                time.sleep(0.01)
+            else:
+                self.drained = time.monotonic()
+                log.info('queues drained in %.1f seconds', self.drained - self.changes_done)
+        finally:
+            daemon.stop()
+            thread.join()
+
+    def report(self) -> dict:
+        from bid_api import sessions
+
+        results = {
+            'settings': {key: str(value) if isinstance(value, pathlib.Path) else value
+                         for key, value in vars(self.args).items()},
+            'changes': len(self.states),
+            'change_seconds': self.changes_done - self.changes_started,
+            'drain_seconds': self.drained - self.changes_done if self.drained else None,
+            'connections': sum(stats['count']
+                               for stats in sessions.handshake_stats().values()),
+            'receivers': [],
+        }
+        for hook, receiver in zip(self.hooks, self.receivers):
+            results['receivers'].append(self.analyse(hook, receiver))
+        return results
+
+    def analyse(self, hook, receiver: webhookreceiver.WebhookHTTPServer) -> dict:
+        """Matches the calls received by the receiver with the changes made."""
+        state = {user_id: dict(initial) for user_id, initial in self.initial_states.items()}
+        latest_change: typing.Dict[int, int] = collections.defaultdict(lambda: -1)
+        seen = set()
+        latencies = []
+        out_of_order = duplicates = unknown = 0
+
+        for received_at, event in receiver.received:
+            user_id = event['id']
+            user_state = state.get(user_id)
+            if user_state is None:
+                unknown += 1
+                continue
+            # Version 2 payloads only contain what changed.
+            user_state.update((key, event[key]) for key in ('full_name', 'roles') if key in event)
+            key = (user_id, user_state['full_name'], tuple(user_state['roles']))
+            try:
+                change_nr, committed_at = self.states[key]
+            except KeyError:
+                unknown += 1
+                continue
+
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            latencies.append(received_at - committed_at)
+            if change_nr < latest_change[user_id]:
+                out_of_order += 1
+            latest_change[user_id] = max(change_nr, latest_change[user_id])
+
+        # A user's last change must always be delivered; earlier ones may be
+        # coalesced into it.
+        last_states = {}
+        for key, (change_nr, _) in self.states.items():
+            if change_nr > last_states.get(key[0], (-1, None))[0]:
+                last_states[key[0]] = (change_nr, key)
+        lost = sum(1 for _, key in last_states.values() if key not in seen)
+
+        if receiver.received:
+            # Delivery can only start when both the changes and the daemon started.
+            started = max(self.changes_started, self.delivery_started)
+            throughput = len(seen) / (receiver.received[-1][0] - started)
+        else:
+            throughput = 0.0
+
+        return {
+            'webhook': hook.name,
+            'requests': receiver.requests,
+            'failed_requests': receiver.failed_requests,
+            'events_received': len(receiver.received),
+            'changes_delivered': len(seen),
+            'changes_coalesced': len(self.states) - len(seen),
+            'final_states_lost': lost,
+            'duplicates': duplicates,
+            'unknown': unknown,
+            'ordering_violations': out_of_order,
+            'throughput': throughput,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies, default=None),
+            },
+        }
+
+
+def percentile(values: typing.List[float], pct: float) -> typing.Optional[float]:
+    """Returns the nearest-rank percentile, or None when there are no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def ms(seconds: typing.Optional[float]) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.1f} ms'
+
+
+def print_report(results: dict):
+    print(f'{results["changes"]} changes made in {results["change_seconds"]:.1f} s')
+    if results['drain_seconds'] is None:
+        print('Queues were NOT drained')
+    else:
+        print(f'Queues drained {results["drain_seconds"]:.1f} s after the last change')
+    print(f'{results["connections"]} HTTP connections made')
+    for info in results['receivers']:
+        latency = info['latency']
+        print()
+        print(f'Webhook {info["webhook"]}:')
+        print(f'    requests             : {info["requests"]} ({info["failed_requests"]} failed)')
+        print(f'    events received      : {info["events_received"]}')
+        print(f'    changes delivered    : {info["changes_delivered"]} '
+              f'({info["changes_coalesced"]} coalesced)')
+        print(f'    throughput           : {info["throughput"]:.1f} changes/s')
+        print(f'    latency p50/p90/p99  : {ms(latency["p50"])} / {ms(latency["p90"])} / '
+              f'{ms(latency["p99"])}')
+        print(f'    latency max          : {ms(latency["max"])}')
+        print(f'    ordering violations  : {info["ordering_violations"]}')
+        print(f'    duplicates           : {info["duplicates"]}')
+        print(f'    final states lost    : {info["final_states_lost"]}')
+        if info['unknown']:
+            print(f'    unknown events       : {info["unknown"]}')
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(name)s %(message)s')
+    if not args.verbose:
+        logging.getLogger('bid_api').setLevel(logging.ERROR)
+
+    setup_django()
+    results = LoadTest(args).run()
+    print_report(results)
+    if args.json_path:
+        with args.json_path.open('w') as outfile:
+            json.dump(results, outfile, indent=4)
+        print(f'\nResults written to {args.json_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Local server for receiving webhook calls.
+
+Used by webhook_loadtest.py. It can pretend to be a slow or unreliable
+receiver, by adding latency to every call, and by failing or timing out on
+a fraction of them.
+"""
+
+import gzip
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import typing
+import zlib
+
+
+class WebhookHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'WebhookHTTPServer'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        received_at = time.monotonic()
+
+        behaviour = self.server.behaviour()
+        if behaviour == 'timeout':
+            # Sleep until after the sender gave up, then hang up.
+            time.sleep(self.server.timeout_sleep)
+            self.close_connection = True
+            return
+
+        time.sleep(self.server.latency())
+        if behaviour == 'error':
+            self.respond(500, {'status': 'error'})
+            return
+
+        encoding = self.headers.get('Content-Encoding', '')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+
+        if self.server.secret:
+            mac = hmac.new(self.server.secret.encode(), body, hashlib.sha256)
+            if not hmac.compare_digest(mac.hexdigest(), self.headers.get('X-Webhook-HMAC', '')):
+                self.server.log.warning('invalid HMAC')
+                self.respond(400, {'status': 'invalid HMAC'})
+                return
+
+        payload = json.loads(body)
+        # Batched calls are sent as a JSON array.
+        events = payload if isinstance(payload, list) else [payload]
+        self.server.record(received_at, events)
+        self.respond(200, {'status': 'success'})
+
+    def respond(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookHTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP server on a random port that records the webhook calls it receives.
+
+    :param latency: seconds to wait before responding.
+    :param jitter: up to this many seconds are randomly added to the latency.
+    :param error_rate: fraction of calls that get a 500 Internal Server Error.
+    :param timeout_rate: fraction of calls that never get a response.
+    :param timeout_sleep: how long to stall calls that time out; this should
+        be longer than the timeout of the webhook.
+    :param secret: when given, the HMAC of every call is checked.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, *,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 timeout_rate: float = 0.0,
+                 timeout_sleep: float = 5.0,
+                 secret: str = '',
+                 seed: int = None):
+        self.log = logging.getLogger('%s.%s' % (self.__class__.__module__, self.__class__.__name__))
+
+        self.base_latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_sleep = timeout_sleep
+        self.secret = secret
+        self._random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        # (monotonic time of receipt, event payload) in order of receipt.
+        self.received: typing.List[typing.Tuple[float, dict]] = []
+        self.requests = 0
+        self.failed_requests = 0
+
+        super().__init__(('127.0.0.1', 0), WebhookHTTPHandler)
+        self._thread: typing.Optional[threading.Thread] = None
+        self.log.info('Created webhook receiver at %s', self.url)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/webhook'
+
+    def behaviour(self) -> str:
+        """Returns 'ok', 'error' or 'timeout' for the next call."""
+        with self._lock:
+            self.requests += 1
+            dice = self._random.random()
+            if dice < self.timeout_rate:
+                self.failed_requests += 1
+                return 'timeout'
+            if dice < self.timeout_rate + self.error_rate:
+                self.failed_requests += 1
+                return 'error'
+        return 'ok'
+
+    def latency(self) -> float:
+        with self._lock:
+            return self.base_latency + self._random.uniform(0, self.jitter)
+
+    def record(self, received_at: float, events: typing.List[dict]):
+        with self._lock:
+            self.received.extend((received_at, event) for event in events)
+
+    def event_count(self) -> int:
+        with self._lock:
+            return len(self.received)
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True,
+                                        name=f'webhook-receiver-{self.server_port}')
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()